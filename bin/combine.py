@@ -25,6 +25,10 @@ import os
 import sys
 import argparse
 import glob
+import json
+import zlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
@@ -47,39 +51,366 @@ __description__ = "{} is a program developed and maintained by {}. " \
 
 
 # Constants
+PARTITION_COLUMN = "phenotype"
+BUCKET_COLUMN = "phenotype_bucket"
+PARTITIONING = "partitioning.json"
+OUTPUT_FILE = "part-{}.parquet"
+PHENOTYPE_DICTIONARY = "phenotypes.parquet"
+
+PYARROW_SCHEMA = pa.schema(
+    [("variant", pa.string()),
+     ("phenotype", pa.string()),
+     ("beta", pa.float64()),
+     ("standard_error", pa.float64()),
+     ("i_squared", pa.float64()),
+     ("sample_size", pa.float64())])
+
+OUTPUT_SCHEMA = pa.schema([field for field in PYARROW_SCHEMA if field.name != PARTITION_COLUMN])
+
 
 # Classes
+class PhenotypeFile(object):
+    """
+    Output file of a phenotype. Results are buffered until a row group is
+    complete. The file is written under a temporary name and renamed when
+    complete.
+    """
+
+    def __init__(self, path, row_group_rows):
+        self.path = path
+        self.row_group_rows = row_group_rows
+        self.writer = pq.ParquetWriter(path + ".tmp", OUTPUT_SCHEMA)
+        self.tables = list()
+        self.rows = 0
+
+    def write(self, table):
+        self.tables.append(table)
+        self.rows += table.num_rows
+        if self.rows >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        if self.rows > 0:
+            self.writer.write_table(pa.concat_tables(self.tables), row_group_size=self.row_group_rows)
+        self.tables = list()
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.rename(self.path + ".tmp", self.path)
+
+
+class PhenotypeWriters(object):
+    """
+    Writes results to the folder of every phenotype, keeping at most
+    max_writers files open. When another file has to be opened, the least
+    recently used file is closed, and results of its phenotype that follow
+    are appended to a new file in the folder of the phenotype.
+    """
+
+    def __init__(self, out, max_writers, row_group_rows):
+        self.out = out
+        self.max_writers = max_writers
+        self.row_group_rows = row_group_rows
+        self.writers = OrderedDict()
+        self.files = dict()
+        self.written = dict()
+
+    def write(self, phenotype, table):
+        writer = self.writers.pop(phenotype, None)
+        if writer is None:
+            if len(self.writers) >= self.max_writers:
+                self.writers.popitem(last=False)[1].close()
+            writer = self.open(phenotype)
+        # The most recently used writer is last
+        self.writers[phenotype] = writer
+        writer.write(table)
+        self.written[phenotype] += table.num_rows
+
+    def open(self, phenotype):
+        phenotype_path = os.path.join(self.out, "{}={}".format(PARTITION_COLUMN, phenotype))
+        if phenotype not in self.files:
+            try:
+                os.makedirs(phenotype_path)
+            except OSError:
+                if not os.path.isdir(phenotype_path):
+                    raise
+            # Replace the files of an earlier run
+            for file_name in glob.glob(os.path.join(phenotype_path, OUTPUT_FILE.format("*"))):
+                os.remove(file_name)
+            self.files[phenotype] = 0
+            self.written[phenotype] = 0
+        writer = PhenotypeFile(os.path.join(phenotype_path, OUTPUT_FILE.format(self.files[phenotype])),
+                               self.row_group_rows)
+        self.files[phenotype] += 1
+        return writer
+
+    def close(self):
+        """
+        :return: list with the number of results written for every phenotype
+        """
+        while len(self.writers) > 0:
+            self.writers.popitem(last=False)[1].close()
+        return sorted(self.written.items())
+
 
 # Functions
+def get_buckets(phenotypes, buckets):
+    """
+    Assigns phenotypes to buckets by the CRC32 hash of their names, as in
+    the phenotype partitioned output of the meta-analysis.
+    """
+    hashes = np.array([zlib.crc32(name if isinstance(name, bytes) else str(name).encode("utf-8")) & 0xffffffff
+                       for name in phenotypes], dtype=np.int64)
+    return hashes % buckets
+
+
+def get_data_files(path):
+    return sorted(os.path.join(path, file_name) for file_name in os.listdir(path)
+                  if file_name.endswith(".parquet") and not file_name.startswith(("_", ".")))
+
+
+def discover_partitions(path):
+    """
+    Lists the partitions of the dataset once.
+
+    :return: the partition column, and a dictionary with the folder of
+    every partition value
+    """
+    partition_column = PARTITION_COLUMN
+    if os.path.exists(os.path.join(path, PARTITIONING)):
+        partition_column = BUCKET_COLUMN
+    partitions = dict()
+    for folder_name in os.listdir(path):
+        key, separator, value = folder_name.partition("=")
+        if separator and key == partition_column:
+            partitions[value] = os.path.join(path, folder_name)
+    return partition_column, partitions
+
+
+def is_indexed(path):
+    """
+    Results written with the indexed schema have int32 variant and
+    phenotype codes instead of names.
+    """
+    schema = pq.ParquetFile(path).schema.to_arrow_schema()
+    return any(pa.types.is_integer(schema[schema.get_field_index(name)].type)
+               for name in ("variant", "phenotype") if schema.get_field_index(name) != -1)
+
+
+def read_dictionaries(path, partitions, phenotype_dictionary, mapper):
+    """
+    Reads the names of the variant and phenotype codes, if the dataset
+    has indexed results.
+
+    :param path: dataset folder
+    :param partitions: dictionary with the folder of every partition
+    :param phenotype_dictionary: phenotype dictionary of the run, by
+    default the one in the dataset folder
+    :param mapper: mapper folder of the run
+    :return: dictionary with an array of names per column, or None
+    """
+    files = [file_name for folder in partitions.values() for file_name in get_data_files(folder)[:1]]
+    if len(files) == 0 or not is_indexed(files[0]):
+        return None
+    if phenotype_dictionary is None:
+        phenotype_dictionary = os.path.join(path, PHENOTYPE_DICTIONARY)
+    if not os.path.exists(phenotype_dictionary):
+        raise ValueError("{} has indexed results, specify the phenotype dictionary of the run "
+                         "with --phenotype-dictionary".format(path))
+    if mapper is None:
+        raise ValueError("{} has indexed results, specify the mapper folder of the run "
+                         "with --mapper".format(path))
+    keys = glob.glob(os.path.join(mapper, "keys_*"))
+    if len(keys) != 1:
+        raise ValueError("There should be a single reference keys file in folder {}".format(mapper))
+
+    phenotypes = pq.read_table(phenotype_dictionary).to_pandas()
+    if not np.array_equal(phenotypes["phenotype_index"].values, np.arange(phenotypes.shape[0])):
+        raise ValueError("Phenotype dictionary {} is not complete".format(phenotype_dictionary))
+    return {"variant": np.load(keys[0]).astype(object),
+            "phenotype": phenotypes["phenotype"].values.astype(object)}
+
+
+def decode(table, dictionaries):
+    """
+    Replaces the variant and phenotype codes of indexed results by their
+    names. Columns with names are left as they are.
+    """
+    for name, names in dictionaries.items():
+        index = table.schema.get_field_index(name)
+        if index == -1 or not pa.types.is_integer(table.schema[index].type):
+            continue
+        codes = table.column(index).to_pandas().values
+        table = table.set_column(index, pa.field(name, pa.string()),
+                                 pa.array(names[codes], type=pa.string()))
+    return table
+
+
+def take(table, indices):
+    """
+    Returns the rows of a table at the indices.
+    """
+    indices = pa.array(np.asarray(indices, dtype=np.int64))
+    return pa.Table.from_arrays([pa.concat_arrays(column.chunks).take(indices) for column in table.columns],
+                                table.schema.names)
+
+
+def read_row_groups(files, columns, dictionaries=None):
+    """
+    Reads the files of a partition a row group at a time.
+    """
+    schema = pa.schema([field for name in columns for field in PYARROW_SCHEMA if field.name == name])
+    for file_name in files:
+        parquet_file = pq.ParquetFile(file_name)
+        for index in range(parquet_file.num_row_groups):
+            table = parquet_file.read_row_group(index, columns=columns, use_threads=False)
+            if dictionaries is not None:
+                table = decode(table, dictionaries)
+            if not table.schema.equals(schema):
+                table = table.cast(schema)
+            yield table
+
+
+def combine_phenotype_partition(task):
+    """
+    Copies a phenotype partition to the output.
+    """
+    folder, phenotypes, out, dictionaries, max_writers, row_group_rows = task
+    writers = PhenotypeWriters(out, 1, row_group_rows)
+    for table in read_row_groups(get_data_files(folder), OUTPUT_SCHEMA.names, dictionaries):
+        writers.write(phenotypes[0], table)
+    return writers.close()
+
+
+def combine_bucket_partition(task):
+    """
+    Reads a phenotype bucket once, a row group at a time, and fans its
+    rows out to the outputs of the requested phenotypes in it, or of all
+    phenotypes if none are requested.
+    """
+    folder, phenotypes, out, dictionaries, max_writers, row_group_rows = task
+    writers = PhenotypeWriters(out, max_writers, row_group_rows)
+    partition_index = PYARROW_SCHEMA.get_field_index(PARTITION_COLUMN)
+    for table in read_row_groups(get_data_files(folder), PYARROW_SCHEMA.names, dictionaries):
+        table_phenotypes = np.asarray(table.column(partition_index).to_pandas())
+        rows = np.arange(table.num_rows)
+        if phenotypes is not None:
+            rows = rows[np.isin(table_phenotypes, phenotypes)]
+        if len(rows) == 0:
+            continue
+        # Group the rows by phenotype, keeping the order of the rows of
+        # every phenotype
+        codes, names = pd.factorize(table_phenotypes[rows])
+        order = np.argsort(codes, kind="mergesort")
+        table = take(table.remove_column(partition_index), rows[order])
+        bounds = np.flatnonzero(np.diff(codes[order])) + 1
+        for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(order)]])):
+            writers.write(names[codes[order[start]]], table.slice(start, end - start))
+    return writers.close()
+
+
+def get_tasks(path, phenotypes, out, phenotype_dictionary=None, mapper=None,
+              max_writers=32, row_group_rows=100000):
+    """
+    Determines the partitions to read for the requested phenotypes, and
+    the phenotypes to extract from every partition.
+    """
+    partition_column, partitions = discover_partitions(path)
+    dictionaries = read_dictionaries(path, partitions, phenotype_dictionary, mapper)
+    if partition_column == PARTITION_COLUMN:
+        if phenotypes is None:
+            phenotypes = sorted(partitions)
+        tasks = [(partitions[phenotype], [phenotype], out, dictionaries, max_writers, row_group_rows)
+                 for phenotype in phenotypes if phenotype in partitions]
+        return combine_phenotype_partition, tasks
+
+    with open(os.path.join(path, PARTITIONING)) as partitioning_file:
+        buckets = json.load(partitioning_file)["buckets"]
+    if phenotypes is None:
+        tasks = [(partitions[bucket], None, out, dictionaries, max_writers, row_group_rows)
+                 for bucket in sorted(partitions)]
+        return combine_bucket_partition, tasks
+    per_bucket = dict()
+    for phenotype, bucket in zip(phenotypes, get_buckets(phenotypes, buckets)):
+        per_bucket.setdefault(str(bucket), list()).append(phenotype)
+    tasks = [(partitions[bucket], bucket_phenotypes, out, dictionaries, max_writers, row_group_rows)
+             for bucket, bucket_phenotypes in sorted(per_bucket.items()) if bucket in partitions]
+    return combine_bucket_partition, tasks
+
+
+def read_phenotypes(args):
+    """
+    Returns the requested phenotypes, or None for all phenotypes.
+    """
+    phenotypes = list()
+    if args.pheno is not None:
+        phenotypes.extend(args.pheno)
+    if args.pheno_file is not None:
+        with open(args.pheno_file) as pheno_file:
+            phenotypes.extend(line.strip() for line in pheno_file if line.strip())
+    if "all" in phenotypes:
+        return None
+    # Keep the first occurrence of every phenotype
+    return list(pd.unique(np.array(phenotypes, dtype=object)))
+
 
 # Main
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
     # Process input
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        description="Extracts the results of phenotypes from a partitioned dataset.")
     parser.add_argument('--path')
-    parser.add_argument('--pheno')
+    parser.add_argument('--pheno', nargs='+',
+                        help="phenotypes to extract, or 'all'")
+    parser.add_argument('--pheno-file',
+                        help="file with a phenotype to extract per line")
     parser.add_argument('--out')
+    parser.add_argument('--threads', type=int, default=1,
+                        help="number of partitions to process in parallel, default 1")
+    parser.add_argument('--writers', type=int, default=32,
+                        help="maximum number of open output files per thread, default 32")
+    parser.add_argument('--row-group-rows', type=int, default=100000,
+                        help="number of rows per row group of the output, default 100000")
+    parser.add_argument('--phenotype-dictionary',
+                        help="phenotype dictionary of indexed results, "
+                             "by default {} in the dataset folder".format(PHENOTYPE_DICTIONARY))
+    parser.add_argument('--mapper',
+                        help="mapper folder of the run, to decode the variants of indexed results")
 
     args = parser.parse_args(argv)
+    if args.pheno is None and args.pheno_file is None:
+        parser.error("Specify phenotypes with --pheno or --pheno-file")
+    if args.writers < 1:
+        parser.error("There should be at least one writer")
     # Perform method
 
-    pyarrow_schema = pa.schema(
-        [("variant", pa.string()),
-         ("phenotype", pa.string()),
-         ("beta", pa.float64()),
-         ("standard_error", pa.float64()),
-         ("i_squared", pa.float64()),
-         ("sample_size", pa.float64())])
-
-    pa_table = pq.ParquetDataset(args.path, schema=pyarrow_schema, filters=('phenotype', '=', args.pheno)).read()
-
-    pq.write_to_dataset(
-        table=pa_table,
-        root_path=args.out,
-        partition_cols=["phenotype"]
-    )
+    phenotypes = read_phenotypes(args)
+    function, tasks = get_tasks(args.path, phenotypes, args.out,
+                                args.phenotype_dictionary, args.mapper,
+                                args.writers, args.row_group_rows)
+
+    # Every task keeps at most --writers files open, and holds a row group
+    # of each, so both are bounded by the number of threads
+    pool = ThreadPool(args.threads) if args.threads > 1 else None
+    found = set()
+    try:
+        results = pool.imap_unordered(function, tasks) if pool is not None else (function(task) for task in tasks)
+        for written in results:
+            for phenotype, rows in written:
+                print("Written {} results for phenotype {}".format(rows, phenotype))
+                found.add(phenotype)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for phenotype in phenotypes if phenotypes is not None else list():
+        if phenotype not in found:
+            print("No results for phenotype {}".format(phenotype))
 
     return 0
 
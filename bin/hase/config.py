@@ -3,4 +3,7 @@ import os
 basedir = os.path.abspath(os.path.dirname(__file__))
 MAPPER_CHUNK_SIZE=5000 #TODO (low) move to model
 CONVERTER_SPLIT_SIZE=25000 #TODO (low) move to model
-PYTHON_PATH=None
\ No newline at end of file
+HASE_BLOCK_SIZE=16*1024**2 # memory bound in bytes of the intermediate arrays per tile of the HASE kernel
+PYTHON_PATH=None
+RESULT_ROW_GROUP_SIZE=128*1024**2 # target size in bytes of the row groups of result files
+RESULT_FILE_SIZE=4*1024**3 # size in bytes after which a new result file is started
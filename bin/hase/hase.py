@@ -4,9 +4,11 @@ import sys
 import os
 import numpy as np
 
-from config import MAPPER_CHUNK_SIZE, basedir, CONVERTER_SPLIT_SIZE, PYTHON_PATH
+from config import MAPPER_CHUNK_SIZE, basedir, CONVERTER_SPLIT_SIZE, PYTHON_PATH, HASE_BLOCK_SIZE, \
+    RESULT_ROW_GROUP_SIZE, RESULT_FILE_SIZE
 from hdgwas.meta_classic import CohortAnalyser
-from hdgwas.meta_classic import ClassicMetaAnalyser
+from hdgwas.meta_classic import ClassicMetaAnalyser, SufficientStatisticsStore
+from hdgwas.scheduler import TileScheduler, ChunkQueue
 
 os.environ['HASEDIR'] = basedir
 if PYTHON_PATH is not None:
@@ -27,6 +29,7 @@ from hdgwas.pard import partial_derivatives
 from hdgwas.regression import haseregression
 import pandas as pd
 import time
+from collections import OrderedDict
 from hdgwas.protocol import Protocol
 
 __version__ = '1.1.0'
@@ -56,7 +59,8 @@ def main(argv=None):
     parser.add_argument("-o", "--out", type=str, required=True, help="path to save result folder")
 
     parser.add_argument("-mode", required=True, type=str,
-                        choices=['regression', 'converting', 'single-meta', 'meta-stage', 'meta-classic', 'encoding'],
+                        choices=['regression', 'converting', 'single-meta', 'meta-stage', 'meta-classic',
+                                 'meta-update', 'encoding'],
                         help='Main argument, specify type of analysis'
                              '*****************'
                              'converting - before start to use any kind of analysis you need to convert data, it could take some time, '
@@ -68,6 +72,9 @@ def main(argv=None):
                              '*****************'
                              'meta-stage - if you are the main center of meta-analysis and already got precomputed data from all sites, use it'
                              '*****************'
+                             'meta-update - classic meta-analysis of new cohorts, added to the sufficient statistics '
+                             'that an earlier meta-classic run stored with -save_statistics'
+                             '*****************'
                              'regression - if you want run everything yourself and do not use precomputed data use it'
 
                              'If you want to run single site full association analysis run (1) single-meta mode and then (2) meta-stage'
@@ -147,6 +154,9 @@ def main(argv=None):
     parser.add_argument('-np', action='store_true', default=True, help='Check BLAS/LAPACK/MKL')
     parser.add_argument('-allow_missingness', action='store_true', default=False,
                         help='Flag for using missingness, instead of using default implementation for meta-analysis.')
+    parser.add_argument('-column_major', action='store_true', default=False,
+                        help='Flag to save encoded phenotypes column-major (Fortran order), '
+                             'so that meta-analysis reads only the selected phenotypes from disk')
 
     # TODO (low) save genotype after MAF
     ###
@@ -155,6 +165,74 @@ def main(argv=None):
     parser.add_argument('-cluster', type=str, default='n', choices=['y', 'n'],
                         help=' Is it parallel cluster job, default no')
     parser.add_argument('-node', nargs='+', type=int, help='number of nodes / this node number, example: 10 2 ')
+    parser.add_argument('-node_balance', type=str, default='keys', choices=['keys', 'variants', 'cohorts'],
+                        help='how the mapper is split over the nodes: keys for an equal number of reference variants '
+                             '(default), variants for an equal number of testable variants, cohorts for an equal '
+                             'number of testable variants weighted by the number of cohorts they are present in. '
+                             'With -snp_id_inc / -snp_id_exc, run -plan with -mapper_cache first, which stores '
+                             'the node ranges for all nodes')
+    parser.add_argument('-queue', type=str,
+                        help='folder of a work queue in classic meta-analysis, instead of -cluster / -node. '
+                             'Workers started with the same queue folder, on one machine or many, claim mapper '
+                             'chunks from it until none are left')
+    parser.add_argument('-queue_task_size', type=int, default=20,
+                        help='number of mapper chunks that a worker claims at once from the work queue, default 20. '
+                             'The results of every task are written to their own files')
+    parser.add_argument('-queue_timeout', type=int, default=600,
+                        help='seconds without a heartbeat after which the chunks of a worker are claimed '
+                             'by other workers, default 600')
+    parser.add_argument('-plan', action='store_true', default=False,
+                        help='print the expected workload of every node for -node and -node_balance, '
+                             'and exit without analysing. The node ranges are stored in -mapper_cache')
+    parser.add_argument('-threads', type=int, default=1,
+                        help='number of cohorts to analyse concurrently in classic meta-analysis, default 1. '
+                             'Keep MKL_NUM_THREADS=1 when using this option')
+    parser.add_argument('-prefetch', type=int, default=1,
+                        help='number of genotype and phenotype chunks to read ahead on background threads '
+                             'in classic meta-analysis, default 1. Use 0 to disable prefetching')
+    parser.add_argument('-write_queue', type=int, default=4,
+                        help='number of result tables that can wait for the background writer '
+                             'in classic meta-analysis, default 4. Use 0 to write on the analysis thread')
+    parser.add_argument('-precision', type=str, default='float64', choices=['float64', 'float32'],
+                        help='floating point precision of genotypes, phenotypes and B4 in classic meta-analysis, '
+                             'default float64. The A matrices are always inverted in float64')
+    parser.add_argument('-hase_block_size', type=int, default=HASE_BLOCK_SIZE // 1024 ** 2,
+                        help='memory bound in MB of the intermediate arrays per tile of the HASE kernel '
+                             'in classic meta-analysis, default {}'.format(HASE_BLOCK_SIZE // 1024 ** 2))
+    parser.add_argument('-ph_cache', type=int, default=0,
+                        help='memory budget in MB for caching phenotype chunks across genotype chunks '
+                             'in classic meta-analysis, default 0 (no cache)')
+    parser.add_argument('-mapper_cache', type=str,
+                        help='folder to cache the mapper values filtered by -snp_id_inc / -snp_id_exc, '
+                             'and the node ranges of -node_balance in, reused by later runs with the same filter files')
+    parser.add_argument('-ph_cache_dir', type=str,
+                        help='scratch folder for phenotype chunks that do not fit in the cache memory budget')
+    parser.add_argument('-save_statistics', action='store_true', default=False,
+                        help='save the inverse variance sufficient statistics of the classic meta-analysis, '
+                             'so that new cohorts can be added with -mode meta-update')
+    parser.add_argument('-statistics', type=str, nargs='+',
+                        help='path to the statistics folder(s) of an earlier run, for -mode meta-update. '
+                             'Use the same mapper as in that run')
+    parser.add_argument('-result_schema', type=str, default='names', choices=['names', 'indexed'],
+                        help='schema of the classic meta-analysis results, default names. With indexed, variants '
+                             'are int32 indices in the mapper keys and phenotypes int32 indices in the phenotype '
+                             'dictionary written to the output folder, see hdgwas/results.py for reading these')
+    parser.add_argument('-row_group_size', type=int, default=RESULT_ROW_GROUP_SIZE // 1024 ** 2,
+                        help='target size in MB of the row groups of classic meta-analysis result files, '
+                             'default {}'.format(RESULT_ROW_GROUP_SIZE // 1024 ** 2))
+    parser.add_argument('-result_file_size', type=int, default=RESULT_FILE_SIZE // 1024 ** 2,
+                        help='size in MB after which a new classic meta-analysis result file is started, '
+                             'default {}'.format(RESULT_FILE_SIZE // 1024 ** 2))
+    parser.add_argument('-phenotype_buckets', type=int, default=0,
+                        help='partition classic meta-analysis results into this number of phenotype buckets, '
+                             'written to phenotype_bucket=<bucket> folders, default 0 (not partitioned)')
+    parser.add_argument('-leave_one_out', action='store_true', default=False,
+                        help='in classic meta-analysis, also meta-analyse all cohorts but one for every cohort. '
+                             'Results are written to leave_one_out/<cohort> in the output folder')
+    parser.add_argument('-cohort_groups', type=str,
+                        help='path to tab-delimited file with each row representing a group name followed by '
+                             'the names of its cohorts. In classic meta-analysis every group is also meta-analysed, '
+                             'results are written to groups/<group> in the output folder')
     ###
 
     # ADVANCED SETTINGS
@@ -175,6 +253,29 @@ def main(argv=None):
     print(args)
     os.environ['HASEOUT'] = args.out
 
+    if args.threads < 1:
+        raise ValueError('Number of threads should be at least 1, not {}'.format(args.threads))
+    if args.prefetch < 0:
+        raise ValueError('Prefetch depth should not be negative, not {}'.format(args.prefetch))
+    if args.hase_block_size < 1:
+        raise ValueError('HASE block size should be at least 1 MB, not {}'.format(args.hase_block_size))
+    if args.ph_cache < 0:
+        raise ValueError('Phenotype cache size should not be negative, not {}'.format(args.ph_cache))
+    if args.node_balance != 'keys' and args.mapper_cache is None \
+            and (args.snp_id_inc is not None or args.snp_id_exc is not None):
+        raise ValueError('-node_balance {} with variant filters needs -mapper_cache, '
+                         'to store the node ranges of a -plan run in'.format(args.node_balance))
+    for variant_filter_file in (args.snp_id_inc or []) + (args.snp_id_exc or []):
+        if 'ID' not in pd.read_csv(variant_filter_file, nrows=0).columns:
+            raise ValueError('{} should have an ID column, filtering variants on CHR and bp is not supported'.format(
+                variant_filter_file))
+
+    if args.queue is not None:
+        if args.cluster == 'y':
+            raise ValueError('A work queue (-queue) replaces the cluster settings (-cluster / -node)')
+        if args.queue_task_size < 1 or args.queue_timeout < 1:
+            raise ValueError('Work queue task size and timeout should be at least 1')
+
     if args.cluster == 'y':
         if args.node is not None:
             if args.node[1] > args.node[0]:
@@ -247,6 +348,7 @@ def main(argv=None):
 
         e = Encoder(args.out)
         e.study_name = args.study_name[0]
+        e.column_major = args.column_major
 
         # The following function identifies for every sample what the index of the sample is in each data source.
         # row_index contains the output with in
@@ -383,7 +485,11 @@ def main(argv=None):
         mapper = load_mapper(
             mapper_chunk_size=MAPPER_CHUNK_SIZE, study_name=args.study_name, ref_name=args.ref_name,
             mapper_folder=args.mapper, encoded=args.encoded, cluster=args.cluster, node=args.node,
-            snp_id_inc=args.snp_id_inc, snp_id_exc=args.snp_id_exc)
+            snp_id_inc=args.snp_id_inc, snp_id_exc=args.snp_id_exc, filter_cache=args.mapper_cache,
+            balance=args.node_balance, allow_missingness=args.allow_missingness)
+        if args.plan:
+            print_node_plan(mapper, args.node, args.allow_missingness)
+            return
 
         Analyser = HaseAnalyser()
 
@@ -651,19 +757,32 @@ def main(argv=None):
 
     ################################### CLASSIC META STAGE ##############################
 
-    elif args.mode == 'meta-classic':
+    elif args.mode == 'meta-classic' or args.mode == 'meta-update':
 
         # ARG_CHECKER.check(args,mode='meta-stage')
-        print("starting meta-classic")
+        print("starting {}".format(args.mode))
 
         ##### Init data readers #####
         if args.derivatives is None:
             raise ValueError('For meta-classic analysis partial derivatives data are required!')
 
+        stored_statistics = None
+        if args.mode == 'meta-update':
+            if args.statistics is None:
+                raise ValueError('For meta-update the statistics of an earlier run are required!')
+            if args.leave_one_out or args.cohort_groups is not None:
+                raise ValueError('Leave-one-out and cohort group analyses need all cohorts, '
+                                 'these are not possible in meta-update!')
+            stored_statistics = SufficientStatisticsStore(args.statistics)
+
         mapper = load_mapper(
             mapper_chunk_size=MAPPER_CHUNK_SIZE, study_name=args.study_name, ref_name=args.ref_name,
             mapper_folder=args.mapper, encoded=args.encoded, cluster=args.cluster, node=args.node,
-            snp_id_inc=args.snp_id_inc, snp_id_exc=args.snp_id_exc)
+            snp_id_inc=args.snp_id_inc, snp_id_exc=args.snp_id_exc, filter_cache=args.mapper_cache,
+            balance=args.node_balance, allow_missingness=args.allow_missingness)
+        if args.plan:
+            print_node_plan(mapper, args.node, args.allow_missingness)
+            return
 
         print("loaded mapper")
 
@@ -716,12 +835,15 @@ def main(argv=None):
         with Timer() as t:
             for i, j in enumerate(args.phenotype):
                 phen.append(Reader('phenotype'))
-                phen[i].start(j)
+                phen[i].start(j, mmap_mode='r')
         print("Time to set pheno {} s".format(t.secs))
         meta_phen = MetaPhenotype(phen,
                                   include=args.ph_id_inc,
                                   exclude=args.ph_id_exc,
-                                  allow_missingness=args.allow_missingness)
+                                  allow_missingness=args.allow_missingness,
+                                  cache_size=args.ph_cache * 1024 ** 2,
+                                  cache_dir=args.ph_cache_dir,
+                                  dtype=np.dtype(args.precision))
 
         #print(phen[1].folder._data.id)
 
@@ -771,6 +893,19 @@ def main(argv=None):
                             key
                         ))
 
+        cohort_groups = None
+        if args.cohort_groups:
+
+            cohort_groups = OrderedDict()
+            with open(args.cohort_groups) as opened:
+                for line in opened:
+                    if not line.strip():
+                        continue
+                    split_line = line.strip().split("\t")
+                    if len(split_line) < 2:
+                        raise ValueError('Cohort group {} has no cohorts'.format(split_line[0]))
+                    cohort_groups[split_line[0]] = split_line[1:]
+
         variants_to_log = None
         pheno_to_log = None
         if args.snp_id_log is not None:
@@ -783,48 +918,110 @@ def main(argv=None):
             args.study_name, args.out,
             variants_full_log=variants_to_log, pheno_full_log=pheno_to_log,
             covariate_indices=covariate_indices, maf_threshold=args.maf,
-            t_statistic_threshold=args.thr)
-
-        # Start looping over all genotype chunks
-        # We use while true, since implementing an iterator is apparently
-        # too much work...
-        while True:
-            # We start with an empty chunk...
-            ch = None
+            t_statistic_threshold=args.thr, threads=args.threads,
+            max_block_bytes=args.hase_block_size * 1024 ** 2,
+            save_statistics=args.save_statistics,
+            stored_statistics=stored_statistics,
+            leave_one_out=args.leave_one_out,
+            cohort_groups=cohort_groups,
+            result_schema=args.result_schema,
+            row_group_size=args.row_group_size * 1024 ** 2,
+            result_file_size=args.result_file_size * 1024 ** 2,
+            write_queue=args.write_queue,
+            phenotype_buckets=args.phenotype_buckets,
+            defer_publish=args.queue is not None)
+
+        # Workers of a work queue claim chunks from the queue, and label
+        # their results with their worker name instead of a node number
+        queue = None
+        node = mapper.node[1] if mapper.cluster == 'y' else None
+        if args.queue is not None:
+            queue = ChunkQueue(args.queue, timeout=args.queue_timeout)
+            queue.create(mapper.get_queue_tasks(args.queue_task_size),
+                         metadata={'n_keys': int(mapper.n_keys), 'chunk_size': int(mapper.chunk_size),
+                                   'studies': list(args.study_name)})
+            mapper.queue = queue
+            node = queue.worker
+
+        def genotype_chunks():
+            # Yield all genotype chunks. We use while true, since implementing
+            # an iterator is apparently too much work...
+            while True:
+                # We start with an empty chunk...
+                ch = None
 
-            # Then we check whether or not we are working in an environment
-            # wherein analysis is split over multiple nodes.
+                # Then we check whether or not we are working in an environment
+                # wherein analysis is split over multiple nodes.
 
-            # This determines how the current chunk should be obtained.
-            if mapper.cluster == 'n':
-                variant_indices, keys = mapper.get(
-                    allow_missingness=args.allow_missingness)
-            elif mapper.cluster == 'y':
-                ch = mapper.chunk_pop()
-                if ch is None:
+                # This determines how the current chunk should be obtained.
+                if mapper.cluster == 'n' and queue is None:
+                    variant_indices, keys = mapper.get(
+                        allow_missingness=args.allow_missingness)
+                else:
+                    ch = mapper.chunk_pop()
+                    if ch is None:
+                        break
+                    variant_indices, keys = mapper.get(
+                        chunk_number=ch, allow_missingness=args.allow_missingness)
+                # The range of reference variants of the chunk, that can
+                # span more than one mapper chunk, and the reference
+                # indices of its variants.
+                variant_range = mapper.chunk_range
+                reference_indices = mapper.chunk_key_indices
+
+                # Now we can check if we have looped through all genotype chunks...
+                if isinstance(variant_indices, type(None)):
+                    if queue is not None:
+                        # A task of the queue without testable variants,
+                        # the queue is empty when no chunk can be popped
+                        continue
                     break
-                variant_indices, keys = mapper.get(
-                    chunk_number=ch, allow_missingness=args.allow_missingness)
-
-            # Now we can check if we have looped through all genotype chunks...
-            if isinstance(variant_indices, type(None)):
-                break
 
-            # And we can get the genotypes for this chunk...
-            if is_no_b4_present_in_partial_derivatives:
+                # And we can get the genotypes for this chunk...
                 with Timer() as t_g:
-                    genotype = merge_genotype(gen, variant_indices, mapper)
+                    genotype = merge_genotype(gen, variant_indices, mapper, dtype=np.dtype(args.precision))
                 print("Time to get G {}s".format(t_g.secs))
 
-            # Now analyse the genotype chunk
-            if mapper.cluster == 'y':
-                classic_meta_analyser.analyse_genotype_chunk(
-                    genotype, keys, variant_indices,
-                    chunk=ch, node=mapper.node[1])
-            else:
-                classic_meta_analyser.analyse_genotype_chunk(
-                    genotype, keys, variant_indices)
-
+                yield genotype, keys, variant_indices, ch, variant_range, reference_indices
+
+        # Loop over all genotype chunk x phenotype chunk tiles. The next
+        # genotype and phenotype chunks are read in the background, while
+        # the current tile is analysed.
+        scheduler = TileScheduler(genotype_chunks(), meta_phen, depth=args.prefetch)
+        try:
+            for (genotype, keys, variant_indices, ch, variant_range, reference_indices), \
+                    phenotype_chunks in scheduler:
+                if queue is not None:
+                    # Tasks claimed before the task of this chunk are
+                    # completed, their results are published
+                    classic_meta_analyser.commit_tasks(queue, queue.pop_completed(queue.get_task(ch)))
+                # Now analyse the genotype chunk
+                if node is not None:
+                    classic_meta_analyser.analyse_genotype_chunk(
+                        genotype, keys, variant_indices,
+                        chunk=ch, node=node,
+                        phenotype_chunks=phenotype_chunks,
+                        variant_range=variant_range,
+                        reference_indices=reference_indices)
+                else:
+                    classic_meta_analyser.analyse_genotype_chunk(
+                        genotype, keys, variant_indices,
+                        phenotype_chunks=phenotype_chunks,
+                        variant_range=variant_range,
+                        reference_indices=reference_indices)
+            if queue is not None:
+                classic_meta_analyser.commit_tasks(queue, queue.pop_completed())
+        finally:
+            scheduler.close()
+            try:
+                classic_meta_analyser.close()
+            finally:
+                # Claims of tasks that are not done are released
+                if queue is not None:
+                    queue.close()
+            for genotype_reader in gen:
+                genotype_reader.folder.pool.close()
+            meta_phen.close()
 
     ################################### TO DO EVERYTHING IN ONE GO ##############################
 
@@ -866,16 +1063,14 @@ def main(argv=None):
                 mapper.include = pd.DataFrame.from_csv(args.snp_id_inc[0], index_col=None)
                 print('Include:')
                 print(mapper.include.head())
-                if 'ID' not in mapper.include.columns and (
-                        'CHR' not in mapper.include.columns or 'bp' not in mapper.include.columns):
-                    raise ValueError('{} table does not have ID or CHR,bp columns'.format(args.snp_id_inc[0]))
+                if 'ID' not in mapper.include.columns:
+                    raise ValueError('{} table does not have an ID column'.format(args.snp_id_inc[0]))
             if args.snp_id_exc[0] is not None:
                 mapper.exclude = pd.DataFrame.from_csv(args.snp_id_exc[0], index_col=None)
                 print('Exclude:')
                 print(mapper.exclude.head())
-                if 'ID' not in mapper.exclude.columns and (
-                        'CHR' not in mapper.exclude.columns or 'bp' not in mapper.exclude.columns):
-                    raise ValueError('{} table does not have ID or CHR,bp columns'.format(args.snp_id_exc[0]))
+                if 'ID' not in mapper.exclude.columns:
+                    raise ValueError('{} table does not have an ID column'.format(args.snp_id_exc[0]))
             mapper.load(args.mapper)
             mapper.load_flip(args.mapper)
             mapper.cluster = args.cluster
@@ -911,7 +1106,8 @@ def main(argv=None):
 
 def load_mapper(mapper_chunk_size, study_name, ref_name,
                 mapper_folder, encoded, cluster, node,
-                snp_id_inc=None, snp_id_exc=None):
+                snp_id_inc=None, snp_id_exc=None, filter_cache=None,
+                balance='keys', allow_missingness=False):
     # Create Mapper object. This mapper object makes us able to synchronise across al variants
     # in each of the separate datasets
     mapper = Mapper()
@@ -925,6 +1121,8 @@ def load_mapper(mapper_chunk_size, study_name, ref_name,
         mapper.load_filter_include(snp_id_inc)
     if snp_id_exc is not None:  # If this is not None the argument contains table(s) of snps to exclude
         mapper.load_filter_exclude(snp_id_exc)
+    # Folder to cache the filtered mapper values in, keyed by the hashes of the filter files
+    mapper.filter_cache = filter_cache
     # Load the mapper files for each of the datasets
     mapper.load(mapper_folder)  # Load the mapper files
     # Load the flip files for each of the datasets
@@ -932,8 +1130,31 @@ def load_mapper(mapper_chunk_size, study_name, ref_name,
     # For cluster stuff:
     mapper.cluster = cluster  # Is n by default
     mapper.node = node
+    # Split the mapper over the nodes by reference variants, or by workload
+    mapper.balance = balance
+    mapper.allow_missingness = allow_missingness
     return mapper
 
 
+def print_node_plan(mapper, node, allow_missingness):
+    """
+    Prints the reference indices, testable variants and variant-cohort
+    pairs of every node, and how much the slowest node is expected to
+    exceed the mean.
+    """
+    if node is None:
+        raise ValueError('The number of nodes (-node) is required for a plan!')
+    plan = mapper.get_node_plan(int(node[0]), allow_missingness)
+    print('Plan for {} nodes, balanced by {}'.format(len(plan), mapper.balance))
+    print('\t'.join(['node', 'start', 'finish', 'variants', 'variant_cohorts']))
+    for node_plan in plan:
+        print('\t'.join(str(node_plan[column])
+                        for column in ['node', 'start', 'finish', 'variants', 'variant_cohorts']))
+    for column in ['variants', 'variant_cohorts']:
+        workload = np.array([node_plan[column] for node_plan in plan], dtype=np.float64)
+        print('Maximum {} per node is {:.2f} times the mean'.format(
+            column, workload.max() / workload.mean() if workload.mean() > 0 else 0))
+
+
 if __name__ == '__main__':
     sys.exit(main())
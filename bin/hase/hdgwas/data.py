@@ -13,6 +13,7 @@ import subprocess
 from hdgwas.tools import Mapper, timing, Timer
 import glob
 import shutil
+import tempfile
 from collections import OrderedDict
 
 
@@ -126,7 +127,9 @@ class PhenPool(object):
                 self.folder.read(self.keys[k])
                 r = self.folder._data._data
                 n = indices[(ind == i), 1].flatten()
-                r = r[:, n]
+                # Selecting columns from a memory-mapped file can give a
+                # read-only array, so make sure we can write to it
+                r = np.require(r[:, n], requirements='W')
                 r[:, np.where(n == -1)[0]] = 0
             l = r.shape[0]
             if result is None:
@@ -135,6 +138,61 @@ class PhenPool(object):
         return result
 
 
+class RowStore(object):
+    """
+    Row-addressable genotype store.
+
+    All variants of a study are stored in a single .npy file (variants x samples),
+    which is memory-mapped, so that only the requested rows are read from disk.
+    The offsets file holds the first row in the store of every genotype/*.h5 file.
+    """
+
+    folder = 'genotype_rows'
+
+    def __init__(self, path, name):
+        self.rows = np.load(os.path.join(path, self.folder, name + '.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, self.folder, name + '_offsets.npy'))
+
+    @staticmethod
+    def exists(path, name):
+        return (os.path.isfile(os.path.join(path, RowStore.folder, name + '.npy')) and
+                os.path.isfile(os.path.join(path, RowStore.folder, name + '_offsets.npy')))
+
+    def get(self, file_index, rows):
+        return self.rows[self.offsets[file_index] + rows]
+
+    @staticmethod
+    def convert(path, name):
+        """
+        Converts the genotype/*.h5 files of a study into a row store.
+        """
+        n_files = len(os.listdir(os.path.join(path, 'genotype')))
+        files = [os.path.join(path, 'genotype', str(i) + '_' + name + '.h5') for i in range(n_files)]
+
+        shapes = []
+        for file in files:
+            with h5py.File(file, 'r') as f:
+                shapes.append(f['genotype'].shape)
+                dtype = f['genotype'].dtype
+        if len(set(shape[1] for shape in shapes)) != 1:
+            raise ValueError('Genotype files in {} have different number of samples'.format(path))
+        offsets = np.append(0, np.cumsum([shape[0] for shape in shapes]))[:-1]
+
+        if not os.path.isdir(os.path.join(path, RowStore.folder)):
+            os.mkdir(os.path.join(path, RowStore.folder))
+        rows_path = os.path.join(path, RowStore.folder, name + '.npy')
+        rows = np.lib.format.open_memmap(rows_path + '.tmp', mode='w+', dtype=dtype,
+                                         shape=(np.sum([shape[0] for shape in shapes]), shapes[0][1]))
+        for file, offset, shape in zip(files, offsets, shapes):
+            print('Converting {}'.format(file))
+            with h5py.File(file, 'r') as f:
+                rows[offset:offset + shape[0]] = f['genotype'][...]
+        rows.flush()
+        del rows
+        os.rename(rows_path + '.tmp', rows_path)
+        np.save(os.path.join(path, RowStore.folder, name + '_offsets.npy'), offsets)
+
+
 class Pool(object):
 
     def __init__(self):
@@ -145,6 +203,10 @@ class Pool(object):
         self.inmem = 0
         self.limit = 2
         self.split_size = None
+        self.row_store = None
+        # Open genotype files, least recently used first
+        self.handles = OrderedDict()
+        self.handle_limit = 8
 
     # @timing
     def link(self, n):
@@ -180,6 +242,36 @@ class Pool(object):
                 f.close()
         return r
 
+    def get_dataset(self, key):
+        """
+        Returns the genotype dataset of a file, keeping at most handle_limit files open.
+        """
+        if key in self.handles:
+            f = self.handles.pop(key)
+        else:
+            if len(self.handles) >= self.handle_limit:
+                self.handles.popitem(last=False)[1].close()
+            f = h5py.File(self.paths[key], 'r')
+        self.handles[key] = f
+        return f['genotype']
+
+    def close(self):
+        for f in self.handles.values():
+            f.close()
+        self.handles = OrderedDict()
+
+    @staticmethod
+    def read_rows(dataset, rows, max_gap=16):
+        """
+        Reads rows from a dataset, in the given order. The rows are sorted and
+        read in runs, a run being rows that are at most max_gap rows apart,
+        so every run is read as a single slice.
+        """
+        unique, inverse = np.unique(rows, return_inverse=True)
+        breaks = np.where(np.diff(unique) > max_gap)[0] + 1
+        parts = [dataset[run[0]:run[-1] + 1][run - run[0]] for run in np.split(unique, breaks)]
+        return np.concatenate(parts)[inverse]
+
     # @timing
     def get_chunk(self, indices, impute):
         indices = self.link(indices)
@@ -202,18 +294,22 @@ class Pool(object):
 
                 # We can get the number of samples from loading the first hdf5
                 # path.
-                f = h5py.File(self.paths[0], 'r')
+                if self.row_store is not None:
+                    n_samples = self.row_store.rows.shape[1]
+                else:
+                    n_samples = self.get_dataset(0).shape[1]
 
                 # Lets fill in the empty array with nan values. That should be
                 # very clear.
-                r = np.full((np.sum(ind == i), f['genotype'].shape[1]), np.nan)
-                f.close()
+                r = np.full((np.sum(ind == i), n_samples), np.nan)
+            elif self.row_store is not None:
+                # Read exactly the requested rows
+                n = indices[(ind == i), 1].flatten()
+                r = self.row_store.get(k, n)
             else:
-                f = h5py.File(self.paths[k], 'r')
+                # Read only the requested rows
                 n = indices[(ind == i), 1].flatten()
-                r = f['genotype'][...]
-                r = r[n, :]
-                f.close()
+                r = self.read_rows(self.get_dataset(k), n)
 
             l = r.shape[1]
             if result is None:
@@ -326,9 +422,9 @@ class Hdf5Data(Data):
             self.shape = (len(self.id), self.names.get_storer('probes').nrows)
         if type == 'PLINK':
             l = os.listdir(os.path.join(data_path, 'genotype'))
-            a, b = h5py.File(os.path.join(data_path, 'genotype', l[0]), 'r')['genotype'][...].shape
+            a, b = h5py.File(os.path.join(data_path, 'genotype', l[0]), 'r')['genotype'].shape
             try:
-                c, d = h5py.File(os.path.join(data_path, 'genotype', l[1]), 'r')['genotype'][...].shape
+                c, d = h5py.File(os.path.join(data_path, 'genotype', l[1]), 'r')['genotype'].shape
                 self.gen_split_size = np.max((a, c))  # TODO (middle) not efficient
             except:
                 self.gen_split_size = a
@@ -379,10 +475,129 @@ class ParData(Data):
                    self.C[phen_order], self.a_cov[np.ix_(cov_order, cov_order)]
 
 
+    def get_covariates(self, phen_order=None, cov_order=None):
+        """
+        Returns the partial derivatives that do not depend on the variants:
+        b_cov, C and a_cov.
+        """
+        if phen_order is None or cov_order is None:
+            raise ValueError('PD order is not define!')
+        return self.b_cov[np.ix_(cov_order, phen_order)], \
+               self.C[phen_order], self.a_cov[np.ix_(cov_order, cov_order)]
+
+    def get_variant_dependent_a(self, gen_order=None, cov_order=None):
+        """
+        Returns the variant dependent part of A, for variants in the given order.
+        """
+        if gen_order is None or cov_order is None:
+            raise ValueError('PD order is not define!')
+        a_test_intermediate = self.a_test[np.ix_(gen_order, np.append(cov_order, self.a_test.shape[1] - 1))]
+        a_test_intermediate[gen_order == -1, ...] = 0
+        return self.harmonize_variant_dependent_a(a_test_intermediate)
+
+
+class ChunkCache(object):
+    """
+    Least recently used cache for data chunks with a memory budget in bytes.
+
+    Every entry consists of a numpy array and an arbitrary object (e.g. the
+    names belonging to the array). When the arrays in memory exceed the budget,
+    the least recently used arrays are evicted; if a scratch folder is set they
+    are moved to memory-mapped files in that folder instead of being dropped.
+    The scratch folder can be shared, so every spill file has a unique name,
+    and the files are removed on closing.
+    """
+
+    def __init__(self, size, scratch=None):
+        self.size = size
+        self.scratch = scratch
+        self.entries = OrderedDict()
+        self.in_memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.spilled = 0
+        self.spill_paths = dict()
+        if self.scratch is not None and not os.path.isdir(self.scratch):
+            try:
+                os.makedirs(self.scratch)
+            except OSError:
+                if not os.path.isdir(self.scratch):
+                    raise
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Move the entry to the end, so it is the most recently used
+        entry = self.entries.pop(key)
+        self.entries[key] = entry
+        return entry[0], entry[1]
+
+    def put(self, key, array, value=None):
+        if key in self.entries:
+            self._remove(key)
+        if array.nbytes > self.size:
+            if self.scratch is not None:
+                self.entries[key] = (self._spill(key, array), value, False)
+            return
+        # The cached array is shared with the caller
+        array.flags.writeable = False
+        self.entries[key] = (array, value, True)
+        self.in_memory += array.nbytes
+        while self.in_memory > self.size:
+            self._evict()
+
+    def _evict(self):
+        for key, (array, value, in_memory) in self.entries.items():
+            if in_memory:
+                break
+        self._remove(key)
+        self.evicted += 1
+        if self.scratch is not None:
+            self.entries[key] = (self._spill(key, array), value, False)
+
+    def _remove(self, key):
+        array, value, in_memory = self.entries.pop(key)
+        if in_memory:
+            self.in_memory -= array.nbytes
+        elif key in self.spill_paths:
+            os.remove(self.spill_paths.pop(key))
+
+    def _spill(self, key, array):
+        descriptor, temporary_path = tempfile.mkstemp(
+            prefix='chunk_{}_{}_'.format('_'.join(str(i) for i in np.atleast_1d(key)), os.getpid()),
+            suffix='.npy.tmp', dir=self.scratch)
+        with os.fdopen(descriptor, 'wb') as spill_file:
+            np.save(spill_file, array)
+        path = temporary_path[:-len('.tmp')]
+        os.rename(temporary_path, path)
+        self.spill_paths[key] = path
+        self.spilled += 1
+        return np.load(path, mmap_mode='r')
+
+    def close(self):
+        """
+        Removes the spill files. Arrays that were returned before stay
+        readable while they are in use.
+        """
+        for path in self.spill_paths.values():
+            if os.path.isfile(path):
+                os.remove(path)
+        self.spill_paths = dict()
+        self.entries = OrderedDict()
+        self.in_memory = 0
+
+    def stats(self):
+        return ('{} hits, {} misses, {} evicted, {} spilled to disk, {:.1f} MB in memory'.format(
+            self.hits, self.misses, self.evicted, self.spilled, self.in_memory / 1024. ** 2))
+
+
 class MetaPhenotype(object):
 
     def __init__(self, phen, protocol=None, include=None, exclude=None,
-                 allow_missingness=False):
+                 allow_missingness=False, cache_size=0, cache_dir=None, dtype=np.float64):
         # @timing
         def _check(map, keys, allow_missingness=False):
             values = np.array(map.dic.values())
@@ -398,6 +613,7 @@ class MetaPhenotype(object):
             return result, np.array(map.dic.keys())[~r]
 
         self.chunk_size = 5000
+        self.dtype = dtype
         self.exclude = None
         self.include = None
         self.name = None
@@ -452,6 +668,16 @@ class MetaPhenotype(object):
 
         self.pool = {i: PhenPool(j.folder) for i, j in enumerate(phen)}
 
+        # The same phenotype chunks are read for every genotype chunk,
+        # so keep the assembled chunks in a cache.
+        self.cache = None
+        if cache_size > 0 or cache_dir is not None:
+            self.cache = ChunkCache(cache_size, scratch=cache_dir)
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
     def get(self):
         if self.processed == self.n_phenotypes:
             return None, None
@@ -463,11 +689,17 @@ class MetaPhenotype(object):
             finish = self.n_phenotypes
         self.processed = finish
 
+        if self.cache is not None:
+            cached = self.cache.get((start, finish))
+            if cached is not None:
+                return cached
+
         # Make new phenotype matrix consisting of zeros (for now)
         # Every sample will be represented across the rows
         # Every phenotype in this chunk will represented across the columns
         phenotype = np.zeros(
-            (np.sum([len(self.pool[i].folder._data.id) for i in self.pool]), len(range(start, finish))))
+            (np.sum([len(self.pool[i].folder._data.id) for i in self.pool]), len(range(start, finish))),
+            dtype=self.dtype)
 
         # Now loop over each of the studies. For each study the
         for i, j in enumerate(self.keys):
@@ -486,6 +718,9 @@ class MetaPhenotype(object):
                 phenotype[a:b, :] = ph_tmp
                 a = b
 
+        if self.cache is not None:
+            self.cache.put((start, finish), phenotype, self.phen_names[start:finish])
+
         return phenotype, self.phen_names[start:finish]
 
     def get_phenotype_indices(self, phenotype_names):
@@ -548,6 +783,8 @@ class MetaPhenotype(object):
             # same rate as the phenotypes.
             # Reset the number of processed values for this as well.
             print('All phenotypes processed!')
+            if self.cache is not None:
+                print('Phenotype cache: {}'.format(self.cache.stats()))
             raise StopIteration
         print("Merged phenotype shape {}".format(phenotype.shape))
 
@@ -841,6 +1078,26 @@ class MetaParData(object):
         else:
             return a_test, b_cov, C, a_cov
 
+    def get_single_study_covariates(self, study_name):
+        """
+        Returns b_cov, C and a_cov for a single study. These do not depend
+        on the variants, so these are needed only once per study.
+        """
+        return self.pd[study_name].folder._data.get_covariates(
+            phen_order=self.phen_order[study_name],
+            cov_order=self.cov_order[study_name])
+
+    def get_single_study_variant_dependent_a(self, study_name, study_index, variant_indices):
+        """
+        Returns the variant dependent part of A for a single study.
+        """
+        if len(self.pd) != len(variant_indices):
+            raise ValueError(
+                'There are not equal number od PD and SNPs indexes {}!={}'.format(len(self.pd), len(variant_indices)))
+        return self.pd[study_name].folder._data.get_variant_dependent_a(
+            gen_order=variant_indices[study_index],
+            cov_order=self.cov_order[study_name])
+
     def maf_pard(self, SNPs_index=None):
 
         samples = 0
@@ -980,6 +1237,9 @@ class PLINKHDF5Folder(HDF5Folder):
         self._data = Hdf5Data(self.path, self.name)
         self._id = self._data.id
         self.pool.split_size = self._data.gen_split_size
+        if RowStore.exists(self.path, self.name):
+            print ('Reading genotype rows from {}'.format(os.path.join(self.path, RowStore.folder)))
+            self.pool.row_store = RowStore(self.path, self.name)
 
     def _scan(self):
         pass
@@ -1114,13 +1374,17 @@ class CSVFolder(Folder):
 
 class NPFolder(Folder):
 
-    def __init__(self, path, protected=[]):
+    def __init__(self, path, protected=[], mmap_mode=None):
         super(NPFolder, self).__init__(path)
         self._data = Data()
         self._data.chunk_size = 1000
         self._data.type = np.ndarray
         self._data.format = 'npy'
         self.protected = protected
+        # With a mmap mode the files are memory-mapped instead of read
+        # into memory, so only the selected columns are read from disk.
+        # This works best for files saved in Fortran (column-major) order.
+        self.mmap_mode = mmap_mode
 
         try:
             file_path = os.path.dirname(path)
@@ -1152,7 +1416,7 @@ class NPFolder(Folder):
         # print 'end cache'
         else:
             # print 'reading file {}'.format(file)
-            d = np.load(os.path.join(self.path, file))
+            d = np.load(os.path.join(self.path, file), mmap_mode=self.mmap_mode)
             if not isinstance(d, np.ndarray):
                 raise ValueError('File {} saved not as numpy array'.format(file))
             self._data.processed = 0
@@ -1469,7 +1733,7 @@ class Reader(object):
                 raise ValueError(' {} is not supported format (only {} supported)!'.format(self.format, self.ext))
 
             elif self.format == '.npy' and self.name != 'partial':
-                self.folder = NPFolder(path, protected=['info_dic.npy'])
+                self.folder = NPFolder(path, protected=['info_dic.npy'], mmap_mode=kwargs.get('mmap_mode'))
             # self.folder.protected=['info_dic.npy']
 
             elif self.format == '.npy' and self.name == 'partial':
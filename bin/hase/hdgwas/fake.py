@@ -23,6 +23,7 @@ class Encoder(object):
 		self.study_name=None
 		self.phen_info_dic={}
 		self.phen_info_dic['id']=None
+		self.column_major=False
 		try:
 			print ('Creating directories...')
 			os.mkdir(os.path.join(self.out,'encode_genotype'))
@@ -83,6 +84,9 @@ class Encoder(object):
 		save_path = os.path.join(self.out, save_path)
 		if os.path.isdir(save_path) is False:
 			os.mkdir(save_path)
+		if self.column_major:
+			# Column-major files let memory-mapped readers select phenotypes without reading all columns
+			data=np.asfortranarray(data)
 		np.save(os.path.join(save_path,str(self.npy_iter[save_path])+'_'+self.study_name+ '.npy'),data )
 		if self.phen_info_dic['id'] is None:
 			self.phen_info_dic['id']=np.array(info._data.id)[index]
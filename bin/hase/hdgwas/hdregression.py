@@ -3,6 +3,7 @@ import numpy as np
 import os
 import sys
 from tools import Timer, timer, timing, save_parameters
+import scipy.linalg
 import scipy.linalg.blas as FB
 import h5py
 import gc
@@ -244,21 +245,115 @@ def B_covariates(covariates, phenotype, intercept=True):
         return b_cov
 
 
-def get_a_inverse_extended(a_covariates, variant_dependent_a):
-    n,m = a_covariates.shape
+def invert_a_covariates(a_covariates):
+    """
+    Inverts the constant part of A with a Cholesky decomposition.
+    :param a_covariates: (n_covariates, n_covariates)
+    :return: the inverse, or None if a_covariates is not positive definite
+    """
+    try:
+        return scipy.linalg.cho_solve(
+            scipy.linalg.cho_factor(a_covariates), np.eye(a_covariates.shape[0]))
+    except np.linalg.LinAlgError:
+        return None
+
+
+def get_a_extended(a_covariates, variant_dependent_a):
+    """
+    Assembles the complete, symmetric A matrix of every variant.
+
+    :param a_covariates: (n_covariates, n_covariates) constant part of A
+    :param variant_dependent_a: (n_variants, n_covariates + n_variable, n_variable)
+    or (n_variants, n_covariates + 1) variable part of A
+    :return: A matrices (n_variants, k, k)
+    """
     if variant_dependent_a.ndim == 2:
-        return A_inverse(a_covariates, variant_dependent_a)
+        variant_dependent_a = variant_dependent_a[:, :, np.newaxis]
+    n = a_covariates.shape[0]
     k = n + variant_dependent_a.shape[2]
 
     a_complete = np.zeros((variant_dependent_a.shape[0], k, k))
     a_complete[..., 0:n, 0:n] = a_covariates
     a_complete[..., :, n:k] = variant_dependent_a
-    a_complete = np.triu(a_complete) + np.triu(a_complete, 1).transpose((0,2,1))
+    return np.triu(a_complete) + np.triu(a_complete, 1).transpose((0, 2, 1))
 
-    a_invertible = np.linalg.det(a_complete) != 0
 
-    a_complete[a_invertible] = np.linalg.inv(a_complete[a_invertible])
-    return a_complete, a_invertible
+def get_a_inverse_extended(a_covariates, variant_dependent_a, variable_rows_only=False, rcond=1e-10,
+                           a_covariates_inverse=None):
+    """
+    Inverts the A matrix of every variant.
+
+    The A matrices of all variants share the covariate block, so we invert
+    them blockwise: the covariate block is inverted once with a Cholesky
+    decomposition, after which only the Schur complement of the variable
+    terms has to be inverted per variant. If the covariate block is not
+    positive definite we fall back to an eigen decomposition of every matrix.
+
+    :param a_covariates: (n_covariates, n_covariates) constant part of A
+    :param variant_dependent_a: (n_variants, n_covariates + n_variable, n_variable)
+    or (n_variants, n_covariates + 1) variable part of A
+    :param variable_rows_only: return only the rows of the inverse that belong
+    to the variable terms, which hold the effect estimates
+    :param rcond: matrices with a reciprocal condition (of the Schur complement,
+    relative to the variable terms) at or below this value are not inverted
+    :param a_covariates_inverse: precomputed inverse of a_covariates, if available
+    :return: inverses (n_variants, k, k), or (n_variants, n_variable, k) if
+    variable_rows_only is set, and a boolean array marking invertible matrices.
+    Matrices that are not invertible are returned as is.
+    """
+    a_complete = get_a_extended(a_covariates, variant_dependent_a)
+    n = a_covariates.shape[0]
+    m = a_complete.shape[2] - n
+
+    if a_covariates_inverse is None:
+        a_covariates_inverse = invert_a_covariates(a_covariates)
+    if a_covariates_inverse is None:
+        return _a_inverse_eigen(a_complete, m, variable_rows_only, rcond)
+
+    # w = inv(A_cc) A_cv, and the Schur complement s = A_vv - A_vc w
+    a_cv = a_complete[:, :n, n:]
+    w = np.matmul(a_covariates_inverse, a_cv)
+    schur = a_complete[:, n:, n:] - np.matmul(a_cv.transpose((0, 2, 1)), w)
+
+    # The Schur complement relative to the variable terms tells how much of
+    # the variable terms is not explained by the covariates.
+    scale = np.sqrt(np.diagonal(a_complete[:, n:, n:], axis1=1, axis2=2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative_schur = schur / (scale[:, :, np.newaxis] * scale[:, np.newaxis, :])
+        a_invertible = (np.linalg.eigvalsh(relative_schur)[:, 0] > rcond) & np.all(scale > 0, axis=1)
+
+    schur_inverse = np.linalg.inv(schur[a_invertible])
+    w = w[a_invertible]
+
+    if variable_rows_only:
+        a_inverse = a_complete[:, n:, :]
+        a_inverse[a_invertible, :, :n] = -np.matmul(schur_inverse, w.transpose((0, 2, 1)))
+        a_inverse[a_invertible, :, n:] = schur_inverse
+        return a_inverse, a_invertible
+
+    w_schur_inverse = np.matmul(w, schur_inverse)
+    a_inverse = a_complete
+    a_inverse[a_invertible, :n, :n] = a_covariates_inverse + np.matmul(w_schur_inverse, w.transpose((0, 2, 1)))
+    a_inverse[a_invertible, :n, n:] = -w_schur_inverse
+    a_inverse[a_invertible, n:, :n] = -w_schur_inverse.transpose((0, 2, 1))
+    a_inverse[a_invertible, n:, n:] = schur_inverse
+    return a_inverse, a_invertible
+
+
+def _a_inverse_eigen(a_complete, m, variable_rows_only, rcond):
+    """
+    Inverts every A matrix with an eigen decomposition, marking matrices with
+    a reciprocal condition at or below rcond as not invertible.
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(a_complete)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a_invertible = (eigenvalues[:, 0] / eigenvalues[:, -1]) > rcond
+    a_inverse = a_complete[:, -m:, :] if variable_rows_only else a_complete
+    eigenvectors = eigenvectors[a_invertible]
+    a_inverse[a_invertible] = np.matmul(
+        eigenvectors[:, -m:, :] if variable_rows_only else eigenvectors,
+        eigenvectors.transpose((0, 2, 1)) / eigenvalues[a_invertible][:, :, np.newaxis])
+    return a_inverse, a_invertible
 
 
 # @timing
@@ -406,6 +501,104 @@ def hase_supporting_interactions(b_variable, a_inverse, b_cov, C, number_of_cons
     return t_stat, SE
 
 
+def covariate_residual_sum_of_squares(a_covariates, b_cov, C, a_covariates_inverse=None):
+    """
+    Residual sum of squares of the phenotypes regressed on the covariates only:
+    C - b_cov' inv(A_cov) b_cov.
+    :param a_covariates: (n_covariates, n_covariates)
+    :param b_cov: (n_covariates, n_phenotypes)
+    :param C: (n_phenotypes)
+    :param a_covariates_inverse: precomputed inverse of a_covariates, if available.
+    Otherwise the pseudo-inverse is used.
+    :return: (n_phenotypes)
+    """
+    if a_covariates_inverse is None:
+        a_covariates_inverse = np.linalg.pinv(a_covariates)
+    return C - np.einsum('ij,ij->j', b_cov, np.dot(a_covariates_inverse, b_cov))
+
+
+def hase_fused(b_variable, a_inverse_rows, b_cov, covariate_rss, DF, max_block_bytes=16 * 1024 ** 2):
+    """
+    Computes the t-statistics and standard errors of the genotype effects
+    without materialising inv(A) b for all terms.
+
+    Only the rows of inv(A) that belong to the variable terms are needed. These
+    give the variable effect estimates beta_v directly. The quadratic form
+    b' inv(A) b splits into a covariate-only part, which gives the residual sum of
+    squares of the covariate-only model, and a part for the variable terms:
+
+        RSS = C - b' inv(A) b = covariate_rss - beta_v' inv(R_vv) beta_v
+
+    where R_vv is the variable block of these rows (1 / R_vv for a single
+    variable term).
+
+    Variants and phenotypes are processed in tiles, so that the intermediate
+    arrays of one tile (n_variable + 3 arrays of tile size) take at most
+    max_block_bytes.
+
+    b_variable can be float32. The effect estimates and the residual sums
+    of squares are still computed in float64, as the covariate and genotype
+    parts of the estimates largely cancel for correlated covariates.
+
+    :param b_variable: (n_variable, n_variants, n_phenotypes)
+    :param a_inverse_rows: (n_variants, n_variable, k) rows of inv(A) for the
+    variable terms, the genotype being the last term
+    :param b_cov: (n_covariates, n_phenotypes)
+    :param covariate_rss: (n_phenotypes) residual sum of squares of the
+    covariate-only model
+    :param DF: degrees of freedom
+    :param max_block_bytes: memory bound of the intermediate arrays of a tile
+    :return: t-statistics and standard errors, both (n_variants, 1, n_phenotypes)
+    """
+    with Timer() as t:
+        number_of_variable_terms, number_of_variants, number_of_phenotypes = b_variable.shape
+        number_of_constant_terms = a_inverse_rows.shape[2] - number_of_variable_terms
+
+        # The diagonal element of inv(A) for the genotype
+        a44 = a_inverse_rows[:, -1, -1]
+        if number_of_variable_terms > 1:
+            a_variable_inverse = np.linalg.inv(a_inverse_rows[:, :, number_of_constant_terms:])
+
+        a_inverse_constant = a_inverse_rows[:, :, :number_of_constant_terms]
+        a_inverse_variable = a_inverse_rows[:, :, number_of_constant_terms:]
+
+        t_stat = np.empty((number_of_variants, 1, number_of_phenotypes))
+        SE = np.empty((number_of_variants, 1, number_of_phenotypes))
+
+        # Determine the tile size from the memory bound
+        pairs = max(1, max_block_bytes // (np.dtype(np.float64).itemsize * (number_of_variable_terms + 3)))
+        phenotype_block = max(1, min(number_of_phenotypes, pairs))
+        variant_block = max(1, min(number_of_variants, pairs // phenotype_block))
+
+        for v in range(0, number_of_variants, variant_block):
+            variants = slice(v, v + variant_block)
+            n_v = min(variant_block, number_of_variants - v)
+            for p in range(0, number_of_phenotypes, phenotype_block):
+                phenotypes = slice(p, p + phenotype_block)
+
+                # beta_v = R_c b_cov + R_v b_variable, for all variable terms
+                beta = np.dot(
+                    a_inverse_constant[variants].reshape(n_v * number_of_variable_terms, -1),
+                    b_cov[:, phenotypes]).reshape(n_v, number_of_variable_terms, -1)
+                beta += np.einsum('ijk,kil->ijl', a_inverse_variable[variants], b_variable[:, variants, phenotypes])
+
+                if number_of_variable_terms == 1:
+                    quadratic_form = beta[:, 0, :] ** 2 / a44[variants, np.newaxis]
+                else:
+                    quadratic_form = np.einsum('ijl,ijk,ikl->il', beta, a_variable_inverse[variants], beta)
+
+                residual = np.abs(covariate_rss[np.newaxis, phenotypes] - quadratic_form)
+                standard_error = np.sqrt(residual * a44[variants, np.newaxis])
+
+                t_stat[variants, 0, phenotypes] = np.sqrt(DF) * beta[:, -1, :] / standard_error
+                SE[variants, 0, phenotypes] = standard_error / np.sqrt(DF)
+
+    print("time to compute GWAS for {} phenotypes and {} SNPs .... {} sec".format(number_of_phenotypes,
+                                                                                  number_of_variants,
+                                                                                  t.secs))
+    return t_stat, SE
+
+
 # @timing
 # @save_parameters
 def hase_allow_missingness_supporting_interactions(b_variable, a_inverse, b_cov, C, number_of_constant_terms, DF):
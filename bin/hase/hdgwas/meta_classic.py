@@ -1,6 +1,13 @@
 from __future__ import print_function
 
+import glob
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
@@ -8,23 +15,99 @@ import pyarrow as pa
 import pyarrow.parquet as pq
 
 from hdgwas.hdregression import B4, \
-    get_a_inverse_extended, hase_supporting_interactions, HASE
+    get_a_extended, get_a_inverse_extended, hase_supporting_interactions, HASE, hase_fused, \
+    covariate_residual_sum_of_squares, invert_a_covariates
 from hdgwas.tools import Timer, HaseAnalyser, select_identifiers
+from hdgwas.results import write_phenotype_dictionary, write_partitioning, phenotype_buckets, \
+    get_bucket_path, ParquetSink
+from hdgwas.scheduler import BackgroundWriter
 
 
 class HaseException(Exception):
     pass
 
 
+def make_directory(path):
+    # Other nodes or threads might create the directory at the same time
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+RESULTS_SCHEMA = pa.schema(
+    [("variant", pa.string()),
+     ("phenotype", pa.string()),
+     ("beta", pa.float64()),
+     ("standard_error", pa.float64()),
+     ("i_squared", pa.float64()),
+     ("sample_size", pa.float64())])
+
+PER_COHORT_SCHEMA = pa.schema(
+    [("cohort", pa.string()),
+     ("variant", pa.string()),
+     ("phenotype", pa.string()),
+     ("beta", pa.float64()),
+     ("standard_error", pa.float64()),
+     ("sample_size", pa.float64())])
+
+# Variants are coded by their index in the mapper keys, phenotypes by
+# their index in the phenotype dictionary of the run (see hdgwas.results)
+INDEXED_RESULTS_SCHEMA = pa.schema(
+    [("variant", pa.int32()),
+     ("phenotype", pa.int32()),
+     ("beta", pa.float64()),
+     ("standard_error", pa.float64()),
+     ("i_squared", pa.float64()),
+     ("sample_size", pa.float64())],
+    metadata={"hase.result_schema": "indexed"})
+
+# Sufficient statistics of the inverse variance meta-analysis, as stored
+# with -save_statistics.
+STATISTICS_COLUMNS = ["weights", "weighted_beta", "heterogeneity", "cohorts", "sample_size"]
+
+
+def inverse_variance_meta_analysis(weights, weighted_effect_sizes,
+                                   effect_size_deviations, counts):
+    """
+    Calculates the fixed effect meta-analysis from the sufficient statistics.
+
+    :param weights: sum of the weights (1 / SE^2) of the cohorts
+    :param weighted_effect_sizes: weighted sum of the effect sizes
+    :param effect_size_deviations: Cochran's Q, the weighted sum of squared
+    deviations of the effect sizes from the meta-analysed effect size
+    :param counts: number of cohorts with an effect size
+    :return: meta-analysed effect sizes, standard errors and I2 values.
+    """
+    effect_sizes = weighted_effect_sizes / weights
+    standard_error = np.sqrt(1 / weights)
+
+    # Expected effect size deviations from the mean
+    degrees_of_freedom = counts - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        i_squared = (
+            ((effect_size_deviations - degrees_of_freedom)
+             / effect_size_deviations
+             ) * 100)
+    # I2 is not defined for a single cohort
+    i_squared[counts <= 1] = np.nan
+    return effect_sizes, standard_error, i_squared
+
+
 class ClassicMetaAnalyser:
     def __init__(self, meta_phen, meta_pard, sample_intersection, sample_indices, study_names, out,
                  covariate_indices=None, maf_threshold=0.0, t_statistic_threshold=None, 
                  variants_full_log=None,
-                 pheno_full_log=None):
+                 pheno_full_log=None, threads=1, max_block_bytes=16 * 1024 ** 2,
+                 save_statistics=False, stored_statistics=None,
+                 leave_one_out=False, cohort_groups=None, result_schema="names",
+                 row_group_size=128 * 1024 ** 2, result_file_size=4 * 1024 ** 3,
+                 write_queue=4, phenotype_buckets=0, defer_publish=False):
 
         self.pheno_full_log = (
             pheno_full_log if pheno_full_log is not None else np.array([]))
-        print(self.pheno_full_log)
         self.variants_full_log = (
             variants_full_log if variants_full_log is not None else np.array([]))
         self.t_statistic_threshold = t_statistic_threshold
@@ -34,16 +117,107 @@ class ClassicMetaAnalyser:
         self.cohort_list = self.construct_cohort_list(
             meta_pard, sample_intersection, sample_indices,
             study_names, covariate_indices=covariate_indices,
-            maf_threshold=maf_threshold)
+            maf_threshold=maf_threshold, max_block_bytes=max_block_bytes)
         self.output_type = "parquet"
         self.results = None
         self.results_index = 0
+        # Parquet results are appended to files that stay open, one sink
+        # per output folder and kind of results.
+        self.row_group_size = row_group_size
+        self.result_file_size = result_file_size
+        self.sinks = OrderedDict()
+        # With a work queue, result files are only published after the
+        # worker checked that it still owns the task of the results.
+        self.defer_publish = defer_publish
+        # Results are encoded and written on a background thread, while the
+        # next tile is analysed.
+        self.writer = BackgroundWriter(write_queue, name='result-writer')
+        self._start_time = time.time()
+        # Write the sufficient statistics of every tile, so that cohorts
+        # can be added later on, and add the stored statistics of an
+        # earlier run to the results of the analysed cohorts.
+        self.save_statistics = save_statistics
+        self.stored_statistics = stored_statistics
+        # Sensitivity analyses, done in the same pass. Each of these is
+        # written to its own folder in the output.
+        self.leave_one_out = leave_one_out
+        self.cohort_groups = self.get_cohort_groups(cohort_groups, study_names)
+        # Results either contain the variant and phenotype names, or int32
+        # codes of these.
+        self.result_schema = result_schema
+        self.phenotype_codes = None
+        if result_schema == "indexed":
+            self.phenotype_codes = pd.Index(self.get_phenotype_dictionary())
+            write_phenotype_dictionary(self.out, self.phenotype_codes.values)
+        elif result_schema != "names":
+            raise HaseException('Unknown result schema {}'.format(result_schema))
+        # Results can be partitioned into buckets of phenotypes, written to
+        # their own folders, so that the results of a phenotype can be read
+        # without reading everything.
+        if phenotype_buckets < 0:
+            raise HaseException('The number of phenotype buckets should be at least 0')
+        self.phenotype_buckets = phenotype_buckets
+        self.partitioned_outputs = set()
         self._debug = True
+        # Cohorts are analysed concurrently in a pool of threads. Numpy
+        # releases the GIL within BLAS / LAPACK calls, so the genotype and
+        # phenotype chunks can be shared with the workers without copying.
+        self.threads = threads
+        self._pool = ThreadPool(threads) if threads > 1 else None
+
+    def get_cohort_groups(self, cohort_groups, study_names):
+        """
+        Matches the cohorts of every group to the study indices.
+
+        :param cohort_groups: dictionary with for every group name a list of study names
+        :param study_names: names of the studies in the analysis
+        :return: dictionary with for every group name the set of study indices
+        """
+        groups = OrderedDict()
+        if cohort_groups is None:
+            return groups
+        for group_name, group_study_names in cohort_groups.items():
+            unknown = [name for name in group_study_names if name not in study_names]
+            if len(unknown) != 0:
+                raise HaseException('Cohort group {} contains unknown cohorts: {}'.format(
+                    group_name, ', '.join(unknown)))
+            groups[group_name] = set(study_names.index(name) for name in group_study_names)
+        return groups
+
+    def get_phenotype_dictionary(self):
+        """
+        Returns the phenotype names of the run. An update also contains
+        the phenotypes of the stored statistics.
+        """
+        phenotype_names = list(self.meta_phen.phen_names)
+        if self.stored_statistics is not None:
+            known = set(phenotype_names)
+            phenotype_names.extend(
+                name for name in self.stored_statistics.get_phenotype_names()
+                if name not in known)
+        return np.array(phenotype_names, dtype=object)
+
+    def get_result_labels(self, variant_names, phenotype_names, reference_indices):
+        """
+        Returns the labels of the variants and phenotypes in the results:
+        the names, or in the indexed result schema their codes.
+        """
+        if self.result_schema == "names":
+            return variant_names, phenotype_names
+        if reference_indices is None:
+            raise HaseException('The reference indices of the variants are required for indexed results')
+        phenotype_codes = self.phenotype_codes.get_indexer(phenotype_names)
+        if np.any(phenotype_codes == -1):
+            raise HaseException('Phenotypes are missing in the phenotype dictionary')
+        return np.asarray(reference_indices).astype(np.int32), phenotype_codes.astype(np.int32)
+
+    def get_sensitivity_output_path(self, kind, name):
+        return os.path.join(self.out, kind, name)
 
     @staticmethod
     def construct_cohort_list(meta_pard, sample_intersection, sample_indices,
                               study_names, covariate_indices,
-                              maf_threshold=0.0):
+                              maf_threshold=0.0, max_block_bytes=16 * 1024 ** 2):
         # Build a list of studies / cohorts
         cohort_list = list()
         # Loop through studies / cohort names
@@ -69,7 +243,8 @@ class ClassicMetaAnalyser:
             # Initialize the cohort analysis
             cohort = CohortAnalyser(
                 study_index, study_name, study_row_indices, sample_size,
-                covariate_indices_this_study, maf_threshold=maf_threshold)
+                covariate_indices_this_study, maf_threshold=maf_threshold,
+                max_block_bytes=max_block_bytes)
 
             # Add a dictionary as an index matching phenotypes to
             # indices in the partial derivatives C and b_cov
@@ -80,38 +255,232 @@ class ClassicMetaAnalyser:
         return cohort_list
 
     def analyse_genotype_chunk(self, genotype, variant_names, variant_indices,
-                               chunk=None, node=None):
+                               chunk=None, node=None, phenotype_chunks=None,
+                               variant_range=None, reference_indices=None):
 
-        self.prepare_cohorts(variant_indices, variant_names)
+        if ((variant_range is None or reference_indices is None)
+                and (self.save_statistics or self.stored_statistics is not None)):
+            raise HaseException('The reference variant range and indices of the genotype chunk are '
+                                'required to save or update sufficient statistics')
 
-        for phenotype, phenotype_names, phenotype_indices in self.meta_phen:
+        self.prepare_cohorts(variant_indices, variant_names)
 
-            for cohort in self.cohort_list:
+        stored_statistics = None
+        if self.stored_statistics is not None:
+            stored_statistics = self.stored_statistics.load(variant_range, reference_indices)
+
+        # Phenotype chunks can be supplied by a scheduler that reads them
+        # in the background. Otherwise, we read them here.
+        if phenotype_chunks is None:
+            phenotype_chunks = self.meta_phen
+
+        for phenotype_chunk_index, (phenotype, phenotype_names, phenotype_indices) in enumerate(phenotype_chunks):
+
+            # The cohorts add their results to the accumulator as soon as
+            # they are analysed, so that we never hold the results of all
+            # cohorts at once.
+            accumulator = InverseVarianceAccumulator(
+                (variant_names.shape[0], phenotype_names.shape[0]))
+            if stored_statistics is not None:
+                stored_statistics.add_to(accumulator, phenotype_names)
+            group_accumulators = OrderedDict(
+                (group_name, InverseVarianceAccumulator(accumulator.shape))
+                for group_name in self.cohort_groups)
+            # The leave-one-out results are calculated by removing the
+            # results of a cohort from the sums of all cohorts, so we keep
+            # the results of the cohorts until the tile is meta-analysed.
+            leave_one_out_results = OrderedDict()
+            per_cohort_selection = self.get_per_cohort_selection(
+                variant_names, phenotype_names)
+            per_cohort_results = [None] * len(self.cohort_list)
+
+            def analyse_cohort(cohort):
                 # Now we need to do the analysis with the selected
                 # phenotypes and genotypes
                 cohort.set_phenotype_names(phenotype_names)
                 cohort.set_phenotype_indices(phenotype_indices[cohort.study_index])
-                cohort.analyse(genotype, phenotype)
+                try:
+                    cohort.analyse(genotype, phenotype)
+                except Exception:
+                    # Do not keep the next cohorts waiting for their turn
+                    accumulator.skip(cohort.study_index)
+                    raise
+
+                results = (cohort.analyser.get_betas(),
+                           cohort.analyser.standard_error,
+                           cohort.get_sample_sizes())
+                with accumulator.turn(cohort.study_index):
+                    accumulator.add(*results)
+                    for group_name, group_accumulator in group_accumulators.items():
+                        if cohort.study_index in self.cohort_groups[group_name]:
+                            group_accumulator.add(*results)
+                    if self.leave_one_out:
+                        leave_one_out_results[cohort.study_index] = results
+
+                if per_cohort_selection is not None:
+                    effects_to_report = per_cohort_selection[2]
+                    per_cohort_results[cohort.study_index] = tuple(
+                        statistic[effects_to_report] for statistic in results)
+                cohort.release_results()
+
+            self.map_cohorts(analyse_cohort)
+
+            # Sensitivity analyses are written with the index of the tile
+            self.analyse_sensitivity(variant_names, phenotype_names,
+                                     accumulator, group_accumulators, leave_one_out_results,
+                                     chunk=chunk, node=node,
+                                     reference_indices=reference_indices)
 
             # Now do the classic meta-analysis
-            self.meta_analyse(variant_names, phenotype_names)
+            self.meta_analyse(variant_names, phenotype_names, accumulator,
+                              reference_indices=reference_indices)
             self.save_results(chunk=chunk, node=node)
+            if self.save_statistics:
+                self.save_sufficient_statistics(
+                    self.get_sufficient_statistics(
+                        variant_names, phenotype_names, reference_indices, accumulator),
+                    variant_range, phenotype_chunk_index)
             self.save_results_per_cohort(
                 variant_names, phenotype_names,
+                per_cohort_selection, per_cohort_results,
                 chunk=chunk, node=node)
             if self._debug:
                 self.write_debug()
 
+        # Stored statistics of associations that none of the tiles contains,
+        # for example of phenotypes that the analysed cohorts do not have,
+        # are carried over unchanged.
+        if stored_statistics is not None:
+            self.save_carried_statistics(
+                stored_statistics.get_unused(), variant_range, chunk=chunk, node=node)
+
+    def analyse_sensitivity(self, variant_names, phenotype_names, accumulator,
+                            group_accumulators, leave_one_out_results, chunk=None, node=None,
+                            reference_indices=None):
+        """
+        Meta-analyses the cohort groups, and if requested, all cohorts but one
+        for every cohort.
+
+        :param accumulator: InverseVarianceAccumulator with the results of all cohorts
+        :param group_accumulators: InverseVarianceAccumulator of every cohort group
+        :param leave_one_out_results: effect sizes, standard errors and sample
+        sizes of every cohort to leave out, by study index. These are
+        released once the results without the cohort are written.
+        """
+        for group_name, group_accumulator in group_accumulators.items():
+            self.meta_analyse(variant_names, phenotype_names, group_accumulator,
+                              reference_indices=reference_indices)
+            self.save_results(chunk=chunk, node=node,
+                              out=self.get_sensitivity_output_path("groups", group_name))
+
+        for cohort in self.cohort_list:
+            if cohort.study_index not in leave_one_out_results:
+                continue
+            self.meta_analyse(variant_names, phenotype_names,
+                              accumulator.without(*leave_one_out_results.pop(cohort.study_index)),
+                              reference_indices=reference_indices)
+            self.save_results(chunk=chunk, node=node,
+                              out=self.get_sensitivity_output_path("leave_one_out", cohort.study_name))
+
+    def map_cohorts(self, function):
+        """
+        Applies the function to every cohort, using the thread pool if
+        more than one thread is requested.
+
+        Every cohort only writes to its own CohortAnalyser, so the results
+        do not depend on the number of threads.
+        :param function: function that takes a single CohortAnalyser.
+        :return: list with the return values, in the order of the cohort list.
+        """
+        if self._pool is None:
+            return [function(cohort) for cohort in self.cohort_list]
+        return self._pool.map(function, self.cohort_list)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        # The sinks are closed by the writer, after the results queued before
+        for sink in self.sinks.values():
+            self.writer.submit(sink.close)
+        self.sinks = OrderedDict()
+        self.writer.close()
+        wall_secs = time.time() - self._start_time
+        print("Time writing results {:.3f}s of {:.3f}s wall time ({:.1f}%), waited {:.3f}s for the writer".format(
+            self.writer.busy_secs, wall_secs,
+            100.0 * self.writer.busy_secs / wall_secs if wall_secs > 0 else 0.0,
+            self.writer.blocked_secs))
+
+    def commit_tasks(self, queue, tasks):
+        """
+        Publishes the results of completed tasks of a work queue, and marks
+        the tasks done, after the results queued before are written. When
+        another worker took over one of the tasks, the results are
+        discarded and the tasks released.
+
+        :param queue: ChunkQueue the tasks were claimed from
+        :param tasks: indices of the completed tasks
+        """
+        if len(tasks) != 0:
+            # The sinks are passed on, as these are replaced on closing
+            self.writer.submit(self._commit_tasks, queue, tasks, list(self.sinks.values()))
+
+    def _commit_tasks(self, queue, tasks, sinks):
+        for sink in sinks:
+            sink.close_file()
+        lost_tasks = queue.get_lost_tasks(tasks)
+        if len(lost_tasks) != 0:
+            print('Tasks {} were taken over by other workers, discarding the results of tasks {}'.format(
+                lost_tasks, tasks))
+        # A claim can be taken over after the check, so the results are
+        # only published by the worker that marks the tasks done.
+        elif not queue.finish(tasks):
+            print('Tasks {} were completed by other workers, discarding their results'.format(tasks))
+        else:
+            for sink in sinks:
+                sink.publish()
+            return
+        for sink in sinks:
+            sink.discard()
+        queue.release(tasks)
+
+    def get_sink(self, out, kind, schema, node=None, row_group_size=None):
+        """
+        Returns the sink for the kind of results in the output folder,
+        opening it on first use.
+        """
+        key = (out, kind)
+        if key not in self.sinks:
+            make_directory(out)
+            prefix = '' if node is None else "_".join(['node', str(node), ''])
+            self.sinks[key] = ParquetSink(out, kind, schema, prefix=prefix,
+                                          row_group_size=(self.row_group_size if row_group_size is None
+                                                          else row_group_size),
+                                          file_size=self.result_file_size,
+                                          defer_publish=self.defer_publish)
+        return self.sinks[key]
+
+    def get_tile(self, chunk):
+        return {"chunk": None if chunk is None else [int(i) for i in chunk],
+                "index": self.results_index}
 
     def prepare_cohorts(self, variant_indices, variant_names):
         # First, prepare the genotype data for this chunk, per cohort
-        for cohort in self.cohort_list:
+        def prepare_cohort(cohort):
             print("Preparing cohort named '{}'".format(cohort.study_name))
             cohort.set_variant_names(variant_names)
             # Get the partial derivatives for each study
             with Timer() as t_pd:
-                # Extract the partial derivatives from the data sources
-                a_test, b_cov, C, a_cov = self.meta_pard.get_single_study(
+                # The covariate part of the partial derivatives is the same
+                # for every genotype chunk, so we only need to get it once.
+                if not cohort.has_covariate_partial_derivatives():
+                    b_cov, C, a_cov = self.meta_pard.get_single_study_covariates(
+                        study_name=cohort.study_name)
+                    cohort.set_covariate_partial_derivatives(b_cov, C, a_cov)
+
+                # Extract the variant dependent partial derivatives from the data sources
+                a_test = self.meta_pard.get_single_study_variant_dependent_a(
                     study_name=cohort.study_name,
                     study_index=cohort.study_index,
                     variant_indices=variant_indices)
@@ -119,7 +488,7 @@ class ClassicMetaAnalyser:
             print("Time to get PD {}s".format(t_pd.secs))
 
             # Add the partial derivatives for this cohort
-            cohort.set_partial_derivatives(a_test, b_cov, C, a_cov)
+            cohort.set_variant_dependent_partial_derivatives(a_test)
             # Add the maf filter for this cohort
             cohort.set_observed_maf(self.meta_pard.minor_allele_frequencies_study(
                 SNPs_index=variant_indices,
@@ -131,108 +500,137 @@ class ClassicMetaAnalyser:
             # data structures.
             cohort.finalize_partial_derivatives()
 
-    def meta_analyse(self, variant_names, phenotype_names):
+        self.map_cohorts(prepare_cohort)
+
+    def meta_analyse(self, variant_names, phenotype_names, accumulator, reference_indices=None):
         """
         Meta analysis for all associations.
 
-        For each association, we apply an inverse variance meta analysis.
-
-        For combining the results between cohorts, we complete the matrices
-        with all missing values for ease of use.
+        For each association, we apply an inverse variance meta analysis
+        on the sums that the cohorts added to the accumulator.
         :param variant_names:
         :param phenotype_names:
+        :param accumulator: InverseVarianceAccumulator with the results of
+        all cohorts for the variants and phenotypes.
+        :param reference_indices: indices of the variants in the mapper keys,
+        required for the indexed result schema.
 
         """
-        # We rely on the methods below to return a 3d matrix wherein the
-        # 0th dimension represents the studies / cohorts, the
-        # 1st dimension represents the variants, and the
-        # 2nd dimension represents the phenotypes.
-        effect_sizes = self.get_effect_sizes()
-        standard_error = self.get_standard_error()
-
-        # Missing values are expected to be NaN
-        # We should check which phenotype, variant combinations are NaN in all
-        # cohorts. Then we can remove these from the variant and phenotype names
-        not_all_nan = ~np.all(np.isnan(effect_sizes), axis=0)
-        effect_sizes = effect_sizes[:, not_all_nan]
-        standard_error = standard_error[:, not_all_nan]
-
-        # Now create the cartesian product of all variant, phenotype names
-        test_combinations = np.vstack(
-            (np.repeat(variant_names, phenotype_names.shape[0]),
-             np.tile(phenotype_names, variant_names.shape[0]))).T
-
-        # From these combinations we can remove all that are nan in all cohorts
-        test_combinations = test_combinations[not_all_nan.flatten()]
-
-        # The inverse variance weighted meta-analysis requires calculating
-        # the variance of the effect estimate. We do this by calculating the
-        # 2nd power of the standard error.
-        variance = standard_error ** 2
-
-        # Weight the effect sizes by dividing the effect size by
-        # the variance of the effect estimate.
-        # This is the same thing as multiplying the effect size by
-        # (1 / variance).
-        effect_size_divided_by_variance = effect_sizes / variance
-        effect_size_divided_by_variance_total = np.nansum(
-            effect_size_divided_by_variance, axis=0)
-
-        # Calculate the total weight as the inverse of the variance of the effect
-        # estimate.
-        one_divided_by_variance = 1 / variance
-        one_divided_by_variance_total = np.nansum(one_divided_by_variance, axis=0)
-
-        # The total weighted effect size should be divided still by the
-        # total weight of each of the studies.
-        meta_analysed_effect_sizes = effect_size_divided_by_variance_total / one_divided_by_variance_total
-        meta_analysed_standard_error = np.sqrt(1 / one_divided_by_variance_total)
-
-        # We need to quantify heterogeneity. We do this by calculating I2 values.
-        effect_size_deviations_from_mean = np.power(
-            effect_sizes - meta_analysed_effect_sizes, 2)
-
-        # Weight and sum all effect size deviations from the mean.
-        effect_size_deviations = np.nansum(
-            one_divided_by_variance * effect_size_deviations_from_mean,
-            axis=0)
-
-        # Expected effect size deviations from the mean
-        degrees_of_freedom = (np.sum(~np.isnan(effect_size_deviations_from_mean), axis=0) - 1)
-        with np.errstate(divide='ignore'):
-            i_squared = (
-                ((effect_size_deviations - degrees_of_freedom)
-                 / effect_size_deviations
-                 ) * 100)
-
-        meta_analysis_sample_sizes = np.nansum(
-            self.get_sample_sizes(), axis=0)[not_all_nan]
+        # Associations that are missing in all cohorts are not reported.
+        (not_all_nan, meta_analysed_effect_sizes, meta_analysed_standard_error,
+         i_squared, meta_analysis_sample_sizes) = accumulator.get_results()
 
+        # The variant and phenotype index of every remaining association.
+        # Names are only looked up for the associations that pass the filters.
+        variant_index, phenotype_index = np.nonzero(not_all_nan)
+
+        variant_labels, phenotype_labels = self.get_result_labels(
+            variant_names, phenotype_names, reference_indices)
         self.set_results(meta_analysed_effect_sizes,
                          meta_analysed_standard_error,
                          meta_analysis_sample_sizes,
                          i_squared,
-                         test_combinations)
+                         variant_labels, phenotype_labels,
+                         variant_index, phenotype_index)
 
-    def set_results(self, meta_analysed_effect_sizes, meta_analysed_standard_error,
-                    meta_analysis_sample_sizes, i_squared,
-                    test_combinations):
+    def get_sufficient_statistics(self, variant_names, phenotype_names, reference_indices, accumulator):
+        """
+        Returns a data frame with the sufficient statistics of all
+        associations with at least one cohort.
+        """
+        observed, statistics = accumulator.get_statistics()
+        variant_index, phenotype_index = np.nonzero(observed)
+        statistics_dataframe = pd.DataFrame(
+            dict(zip(STATISTICS_COLUMNS, statistics)),
+            columns=STATISTICS_COLUMNS)
+        statistics_dataframe.insert(0, "variant", variant_names[variant_index])
+        statistics_dataframe.insert(1, "variant_index", reference_indices[variant_index].astype(np.int64))
+        statistics_dataframe.insert(2, "phenotype", phenotype_names[phenotype_index])
+        return statistics_dataframe
+
+    def save_sufficient_statistics(self, statistics, variant_range, name):
+        """
+        Writes sufficient statistics to the statistics folder of the output.
+        Files are named after the reference variant range of the genotype
+        chunk, so that a later update only reads the files that overlap
+        with its chunks.
+        """
+        output_path = SufficientStatisticsStore.get_path(
+            self.out, variant_range, name)
+        make_directory(os.path.dirname(output_path))
+
+        pyarrow_schema = pa.schema(
+            [("variant", pa.string()),
+             ("variant_index", pa.int64()),
+             ("phenotype", pa.string()),
+             ("weights", pa.float64()),
+             ("weighted_beta", pa.float64()),
+             ("heterogeneity", pa.float64()),
+             ("cohorts", pa.int64()),
+             ("sample_size", pa.float64())])
+
+        self.writer.submit(pq.write_table, pa.Table.from_pandas(
+            statistics, pyarrow_schema, preserve_index=False), output_path)
+
+    def save_carried_statistics(self, statistics, variant_range, chunk=None, node=None):
+        """
+        Writes the results, and possibly the sufficient statistics, of
+        stored associations that did not get new cohorts.
+        """
+        if statistics.shape[0] == 0:
+            return
 
-        results_dataframe = pd.DataFrame({
-            "variant": test_combinations[:, 0],
-            "phenotype": test_combinations[:, 1],
-            "beta": meta_analysed_effect_sizes,
-            "standard_error": meta_analysed_standard_error,
-            "i_squared": i_squared,
-            "sample_size": meta_analysis_sample_sizes})
+        print('Carrying over {} stored associations'.format(statistics.shape[0]))
+        meta_analysed_effect_sizes, meta_analysed_standard_error, i_squared = \
+            inverse_variance_meta_analysis(
+                statistics["weights"].values,
+                statistics["weighted_beta"].values,
+                statistics["heterogeneity"].values,
+                statistics["cohorts"].values)
+
+        index = np.arange(statistics.shape[0])
+        variant_labels, phenotype_labels = self.get_result_labels(
+            statistics["variant"].values, statistics["phenotype"].values,
+            statistics["variant_index"].values)
+        self.set_results(meta_analysed_effect_sizes,
+                         meta_analysed_standard_error,
+                         statistics["sample_size"].values,
+                         i_squared,
+                         variant_labels, phenotype_labels,
+                         index, index)
+        self.save_results(chunk=chunk, node=node)
+        if self.save_statistics:
+            self.save_sufficient_statistics(statistics, variant_range, "carried")
 
-        t_statistic_mask = np.full((results_dataframe.shape[0]), True)
+    def set_results(self, meta_analysed_effect_sizes, meta_analysed_standard_error,
+                    meta_analysis_sample_sizes, i_squared,
+                    variant_names, phenotype_names,
+                    variant_index, phenotype_index):
+        """
+        Filters the meta-analysed associations and stores the remaining ones
+        as columns of the results.
 
+        :param variant_names: variant names or codes, of which variant_index
+        gives the one of every association
+        :param phenotype_names: phenotype names or codes, of which
+        phenotype_index gives the one of every association
+        """
+        # Possibly set a threshold on the t-statistic, and drop associations
+        # without samples. This is done on the numbers, before we look up the
+        # names of the associations.
+        mask = meta_analysis_sample_sizes != 0
         if self.t_statistic_threshold is not None and self.t_statistic_threshold != 0:
-            t_statistic_mask = (
-                    np.abs(results_dataframe['beta'] / results_dataframe['standard_error'])
-                    > self.t_statistic_threshold)
-        self.results = results_dataframe[t_statistic_mask]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mask &= (np.abs(meta_analysed_effect_sizes / meta_analysed_standard_error)
+                         > self.t_statistic_threshold)
+
+        self.results = OrderedDict([
+            ("variant", variant_names[variant_index[mask]]),
+            ("phenotype", phenotype_names[phenotype_index[mask]]),
+            ("beta", meta_analysed_effect_sizes[mask]),
+            ("standard_error", meta_analysed_standard_error[mask]),
+            ("i_squared", i_squared[mask]),
+            ("sample_size", meta_analysis_sample_sizes[mask])])
 
     def write_debug(self):
         for cohort in self.cohort_list:
@@ -243,52 +641,87 @@ class ClassicMetaAnalyser:
                     file_path.format(variant_name),
                     a_singular_matrix)
 
-    def save_results(self, chunk=None, node=None):
-
-        print('Saving results to {}'.format(self.out))
-
-        # Possibly set a threshold on p-value or Z score or t-statistic
-        results = self.results.loc[self.results.sample_size != 0]
-        output_path = self.get_output_path(chunk, node)
+    def save_results(self, chunk=None, node=None, out=None):
+        """
+        Saves the results of a tile. Results of sensitivity analyses go to
+        their own output folder, and do not advance the results index.
+        """
+        if out is not None:
+            make_directory(out)
+        print('Saving results to {}'.format(self.out if out is None else out))
 
         if self.output_type == "npy":
-            np.save(output_path, results)
+            self.writer.submit(np.save, self.get_output_path(chunk, node, out=out), pd.DataFrame(self.results))
         elif self.output_type == "pkl":
-            results.to_pickle(output_path)
+            self.writer.submit(pd.DataFrame(self.results).to_pickle, self.get_output_path(chunk, node, out=out))
         elif self.output_type == "parquet":
-            print(results.dtypes)
-
-            pyarrow_schema = pa.schema(
-                [("variant", pa.string()),
-                 ("phenotype", pa.string()),
-                 ("beta", pa.float64()),
-                 ("standard_error", pa.float64()),
-                 ("i_squared", pa.float64()),
-                 ("sample_size", pa.float64())])
-
-            pq.write_table(pa.Table.from_pandas(
-                results, pyarrow_schema), output_path)
-
-        self.results_index += 1
+            schema = RESULTS_SCHEMA if self.result_schema == "names" else INDEXED_RESULTS_SCHEMA
+            if self.phenotype_buckets == 0:
+                self.writer.submit(self.get_sink(self.out if out is None else out, "result", schema, node).write,
+                                   self.get_results_table(schema), tile=self.get_tile(chunk))
+            else:
+                self.save_partitioned_results(schema, chunk, node, self.out if out is None else out)
+
+        if out is None:
+            self.results_index += 1
         self.results = None
 
-    def save_results_per_cohort(
-            self, variant_names, phenotype_names, chunk=None, node=None):
-
-        print('Saving results to {}'.format(self.out))
+    def save_partitioned_results(self, schema, chunk, node, out):
+        """
+        Splits the results over the phenotype buckets, and hands the
+        results of every bucket to the sink of its folder.
+        """
+        if out not in self.partitioned_outputs:
+            write_partitioning(out, self.phenotype_buckets)
+            self.partitioned_outputs.add(out)
+
+        buckets = self.get_phenotype_buckets(self.results["phenotype"])
+        order = np.argsort(buckets, kind="mergesort")
+        # Every bucket buffers its own row group, so together these take
+        # the memory of a single row group.
+        row_group_size = self.row_group_size // self.phenotype_buckets
+        tile = self.get_tile(chunk)
+        for rows in np.split(order, np.flatnonzero(np.diff(buckets[order])) + 1):
+            if len(rows) == 0:
+                continue
+            sink = self.get_sink(get_bucket_path(out, buckets[rows[0]]), "result", schema, node,
+                                 row_group_size=row_group_size)
+            self.writer.submit(sink.write, self.get_results_table(schema, rows), tile=tile)
+
+    def get_phenotype_buckets(self, phenotype_labels):
+        if self.result_schema == "indexed":
+            phenotype_labels = self.phenotype_codes.values[phenotype_labels]
+        return phenotype_buckets(phenotype_labels, self.phenotype_buckets)
+
+    def get_results_table(self, schema, rows=None):
+        """
+        Builds an Arrow table straight from the result columns, possibly
+        of a selection of the rows.
+        """
+        return pa.Table.from_arrays(
+            [pa.array(self.get_result_column(field.name) if rows is None
+                      else self.get_result_column(field.name)[rows], type=field.type)
+             for field in schema],
+            schema=schema)
+
+    def get_result_column(self, name):
+        column = self.results[name]
+        # Arrow keeps the padding of fixed width numpy strings
+        if column.dtype.kind in ('S', 'U'):
+            return column.astype(object)
+        return column
+
+    def get_per_cohort_selection(self, variant_names, phenotype_names):
+        """
+        Determines which associations to report per cohort.
 
+        :return: tuple with the variant selection, the phenotype selection and
+        the (variants, phenotypes) mask of effects to report, or None if there
+        is nothing to report.
+        """
         variant_selection = np.isin(variant_names, self.variants_full_log)
         phenotype_selection = np.isin(phenotype_names, self.pheno_full_log)
 
-        print(variant_selection)
-        print(phenotype_selection)
-
-        # We rely on the methods below to return a 3d matrix wherein the
-        # 0th dimension represents the studies / cohorts, the
-        # 1st dimension represents the variants, and the
-        # 2nd dimension represents the phenotypes.
-
-        
         effects_to_report = np.dot(
             variant_selection[:, None],
             phenotype_selection[None, :])
@@ -305,7 +738,7 @@ class ClassicMetaAnalyser:
             
             if np.sum(effects_to_report) > per_cohort_threshold:
                 Warning("Refusing to write over {} effects for each cohort.".format(per_cohort_threshold))
-                return 
+                return None
 
         elif len(self.variants_full_log) == 0:
             variant_selection = np.array([True] * len(variant_names))
@@ -316,20 +749,29 @@ class ClassicMetaAnalyser:
             
             if np.sum(effects_to_report) > per_cohort_threshold:
                 Warning("Refusing to write over {} effects for each cohort.".format(per_cohort_threshold))
-                return
-
-        print("Per cohort effects to report")
-        print(effects_to_report)
+                return None
 
         if not np.any(effects_to_report):
+            return None
+
+        return variant_selection, phenotype_selection, effects_to_report
+
+    def save_results_per_cohort(
+            self, variant_names, phenotype_names,
+            per_cohort_selection, per_cohort_results, chunk=None, node=None):
+
+        if per_cohort_selection is None:
             return
 
-        effect_sizes = (
-            self.get_effect_sizes()[:, effects_to_report])
-        standard_error = (
-            self.get_standard_error()[:, effects_to_report])
-        sample_sizes = (
-            self.get_sample_sizes()[:, effects_to_report])
+        print('Saving results to {}'.format(self.out))
+
+        variant_selection, phenotype_selection, _ = per_cohort_selection
+
+        # Stack the reported effects of the cohorts, so that the
+        # 0th dimension represents the studies / cohorts, and the
+        # 1st dimension the reported associations.
+        effect_sizes, standard_error, sample_sizes = [
+            np.stack(statistic) for statistic in zip(*per_cohort_results)]
 
         variant_phenotype_multiindex = pd.MultiIndex.from_arrays(
             [np.repeat(variant_names[variant_selection], repeats=phenotype_selection.sum()),
@@ -351,66 +793,315 @@ class ClassicMetaAnalyser:
         output_path = self.get_output_path(chunk, node, per_cohort=True)
 
         if self.output_type == "npy":
-            np.save(output_path, results_per_cohort)
+            self.writer.submit(np.save, output_path, results_per_cohort)
         elif self.output_type == "pkl":
-            results_per_cohort.to_pickle(output_path)
+            self.writer.submit(results_per_cohort.to_pickle, output_path)
         elif self.output_type == "parquet":
+            self.writer.submit(self.get_sink(self.out, "per_cohort", PER_COHORT_SCHEMA, node).write,
+                               pa.Table.from_pandas(results_per_cohort, PER_COHORT_SCHEMA, preserve_index=False),
+                               tile=self.get_tile(chunk))
 
-            pyarrow_schema = pa.schema(
-                [("cohort", pa.string()),
-                 ("variant", pa.string()),
-                 ("phenotype", pa.string()),
-                 ("beta", pa.float64()),
-                 ("standard_error", pa.float64()),
-                 ("sample_size", pa.float64())])
-
-            pq.write_table(pa.Table.from_pandas(
-                results_per_cohort, pyarrow_schema), output_path)
-
-    def get_output_path(self, chunk, node, per_cohort=False):
+    def get_output_path(self, chunk, node, per_cohort=False, out=None):
+        if out is None:
+            out = self.out
         if chunk is None:
             output_path = os.path.join(
-                self.out,
+                out,
                 str(self.results_index)
                 + ('per_cohort.' if per_cohort else 'result.')
                 + self.output_type)
         else:
             output_path = os.path.join(
-                self.out,
+                out,
                 "_".join(['node', str(node), str(chunk[0]), str(chunk[1]), str(self.results_index),
                           ('per_cohort.' if per_cohort else 'result.') + self.output_type]))
         return output_path
 
-    def get_effect_sizes(self):
+    def get_cohort_names(self):
+        return [cohort.study_name for cohort in self.cohort_list]
+
+
+class InverseVarianceAccumulator:
+    """
+    Accumulates the inverse variance weighted sums of the cohorts for every
+    variant, phenotype combination of a tile.
+
+    Cohorts are added one at a time, so the memory needed does not depend
+    on the number of cohorts. For every combination we keep the sum of
+    weights (1 / SE^2), the weighted sum of the effect sizes, Cochran's Q,
+    the number of cohorts with an effect size and the total sample size.
+
+    Q is updated with the deviation of every cohort from the running
+    weighted mean (Chan et al.), instead of being calculated afterwards as
+    sum(w b^2) - sum(w b)^2 / sum(w), which cancels catastrophically when
+    the cohorts have near-identical effect sizes.
+
+    Cohorts can be analysed concurrently. They add their results in the
+    order of their index, so that the sums do not depend on the number of
+    threads.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.weights = np.zeros(shape)
+        self.weighted_effect_sizes = np.zeros(shape)
+        self.effect_size_deviations = np.zeros(shape)
+        self.counts = np.zeros(shape, dtype=np.int64)
+        self.sample_sizes = np.zeros(shape)
+        self._condition = threading.Condition()
+        self._next = 0
+
+    @contextmanager
+    def turn(self, index):
+        """
+        Waits until the cohorts with a lower index have had their turn.
         """
-        Method that returns a matrix of effect sizes.
-        The first dimension represents variants,
-        the second dimension represents the studies / cohorts.
+        with self._condition:
+            while self._next != index:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._next += 1
+                self._condition.notify_all()
+
+    def skip(self, index):
+        with self.turn(index):
+            pass
+
+    def _merge(self, index, weights, weighted_effect_sizes, effect_sizes, effect_size_deviations):
+        """
+        Merges the weighted sums of other cohorts into the combinations
+        selected by the index.
 
-        Missing associations are NA
-        :param association_indices: A 3d matrix with for each study an array of variant indices, indicating at what position
-        variants are located.
-        :return: matrix of effect sizes [assoc, studies]
+        The Q of the merged cohorts is the sum of both Qs and the
+        weighted squared difference of both means.
         """
-        betas = np.stack([cohort.analyser.get_betas() for cohort in self.cohort_list])
-        return betas
+        total_weights = self.weights[index]
+        merged_weights = total_weights + weights
+        with np.errstate(divide='ignore', invalid='ignore'):
+            difference = self.weighted_effect_sizes[index] / total_weights - effect_sizes
+            between = total_weights * weights / merged_weights * difference ** 2
+        self.effect_size_deviations[index] = np.where(
+            total_weights != 0,
+            self.effect_size_deviations[index] + effect_size_deviations + between,
+            effect_size_deviations)
+        self.weights[index] = merged_weights
+        self.weighted_effect_sizes[index] += weighted_effect_sizes
+
+    def add(self, effect_sizes, standard_error, sample_sizes):
+        """
+        Adds the results of a cohort.
 
-    def get_standard_error(self):
+        :param effect_sizes: (variants, phenotypes) effect sizes, NaN if missing
+        :param standard_error: (variants, phenotypes) standard errors
+        :param sample_sizes: (variants, phenotypes) sample sizes, 0 if missing
         """
-        Method that returns a matrix of standard errors of effect sizes.
-        The first dimension represents associations,
-        the second dimension represents the studies / cohorts.
-        :param association_indices: A list with for each study an array of variant indices, indicating at what position
-        variants are located
+        # Missing values are NaN, these do not contribute.
+        observed = ~np.isnan(effect_sizes)
+        effect_sizes = effect_sizes[observed]
+
+        # The inverse variance of the effect estimate is the weight
+        weights = 1 / standard_error[observed] ** 2
+        self._merge(observed, weights, weights * effect_sizes, effect_sizes, 0)
+        self.counts += observed
+        self.sample_sizes += sample_sizes
+
+    def without(self, effect_sizes, standard_error, sample_sizes):
         """
-        standard_errors = np.stack([cohort.analyser.standard_error for cohort in self.cohort_list])
-        return standard_errors
+        Returns a new accumulator with the sums of all cohorts but one, by
+        removing the results of that cohort from the sums.
 
-    def get_sample_sizes(self):
-        return np.stack([cohort.get_sample_sizes() for cohort in self.cohort_list])
+        Q is reduced by the weighted squared difference of the cohort from
+        the mean of the other cohorts, the reverse of the merge in add.
 
-    def get_cohort_names(self):
-        return [cohort.study_name for cohort in self.cohort_list]
+        :param effect_sizes: (variants, phenotypes) effect sizes of the
+        cohort to leave out, NaN if missing
+        :param standard_error: (variants, phenotypes) standard errors
+        :param sample_sizes: (variants, phenotypes) sample sizes, 0 if missing
+        """
+        observed = ~np.isnan(effect_sizes)
+        effect_sizes = effect_sizes[observed]
+        weights = 1 / standard_error[observed] ** 2
+
+        remaining = InverseVarianceAccumulator(self.shape)
+        remaining.weights[...] = self.weights
+        remaining.weighted_effect_sizes[...] = self.weighted_effect_sizes
+        remaining.effect_size_deviations[...] = self.effect_size_deviations
+        remaining.weights[observed] -= weights
+        remaining.weighted_effect_sizes[observed] -= weights * effect_sizes
+        remaining.counts[...] = self.counts - observed
+        remaining.sample_sizes[...] = self.sample_sizes - sample_sizes
+
+        remaining_weights = remaining.weights[observed]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            difference = remaining.weighted_effect_sizes[observed] / remaining_weights - effect_sizes
+            between = remaining_weights * weights / self.weights[observed] * difference ** 2
+        remaining.effect_size_deviations[observed] = np.where(
+            remaining.counts[observed] > 1,
+            np.maximum(self.effect_size_deviations[observed] - between, 0),
+            0)
+        # Combinations of which the cohort was the only one are empty
+        empty = remaining.counts == 0
+        remaining.weights[empty] = 0
+        remaining.weighted_effect_sizes[empty] = 0
+        return remaining
+
+    def add_statistics(self, variants, phenotypes, statistics):
+        """
+        Adds stored sufficient statistics.
+
+        :param variants: variant (row) index of every association
+        :param phenotypes: phenotype (column) index of every association
+        :param statistics: sequence with an array for each of the
+        STATISTICS_COLUMNS, with a value for every association
+        """
+        weights, weighted_effect_sizes, effect_size_deviations, counts, sample_sizes = statistics
+        self._merge((variants, phenotypes), weights, weighted_effect_sizes,
+                    weighted_effect_sizes / weights, effect_size_deviations)
+        self.counts[variants, phenotypes] += counts
+        self.sample_sizes[variants, phenotypes] += sample_sizes
+
+    def get_statistics(self):
+        """
+        :return: tuple of the (variants, phenotypes) mask of combinations
+        with an effect size in at least one cohort, and for these a list
+        with an array for each of the STATISTICS_COLUMNS.
+        """
+        observed = self.counts > 0
+        return observed, [self.weights[observed],
+                          self.weighted_effect_sizes[observed],
+                          self.effect_size_deviations[observed],
+                          self.counts[observed],
+                          self.sample_sizes[observed]]
+
+    def get_results(self):
+        """
+        Calculates the fixed effect meta-analysis.
+
+        :return: tuple of the (variants, phenotypes) mask of combinations
+        with an effect size in at least one cohort, and for these the
+        meta-analysed effect sizes, standard errors, I2 values and sample sizes.
+        """
+        observed, (weights, weighted_effect_sizes, effect_size_deviations,
+                   counts, sample_sizes) = self.get_statistics()
+        effect_sizes, standard_error, i_squared = inverse_variance_meta_analysis(
+            weights, weighted_effect_sizes, effect_size_deviations, counts)
+        return observed, effect_sizes, standard_error, i_squared, sample_sizes
+
+
+class SufficientStatisticsStore:
+    """
+    Sufficient statistics of an earlier classic meta-analysis, written
+    with -save_statistics.
+
+    Files are named after the reference variant range of their genotype
+    chunk, and keep the reference index of every variant. An update should
+    use the same mapper as the run that wrote the statistics, its genotype
+    chunks can differ.
+    """
+
+    folder = "statistics"
+    pattern = re.compile(r'^(\d+)_(\d+)_(\w+)_statistics\.parquet$')
+
+    def __init__(self, paths):
+        self.files = dict()
+        for path in paths:
+            for file_path in glob.glob(os.path.join(path, '*_statistics.parquet')):
+                match = self.pattern.match(os.path.basename(file_path))
+                if match is None:
+                    continue
+                variant_range = (int(match.group(1)), int(match.group(2)))
+                self.files.setdefault(variant_range, []).append(file_path)
+        if len(self.files) == 0:
+            raise ValueError('There are no sufficient statistics in {}'.format(paths))
+        print('Found stored statistics for {} genotype chunks'.format(len(self.files)))
+
+    def get_phenotype_names(self):
+        """
+        Returns the unique phenotype names of all stored statistics.
+        """
+        phenotype_names = set()
+        for files in self.files.values():
+            for file_path in files:
+                phenotype_names.update(
+                    pq.read_table(file_path, columns=["phenotype"]).column(0).to_pandas().unique())
+        return sorted(phenotype_names)
+
+    @classmethod
+    def get_path(cls, out, variant_range, name):
+        return os.path.join(
+            out, cls.folder,
+            "{}_{}_{}_statistics.parquet".format(variant_range[0], variant_range[1], name))
+
+    def load(self, variant_range, reference_indices):
+        """
+        Reads the stored statistics of a genotype chunk.
+
+        :param variant_range: reference variant range of the genotype chunk
+        :param reference_indices: reference indices of the variants in the genotype chunk
+        :return: StoredChunkStatistics
+        """
+        start, finish = variant_range
+        # The genotype chunks of the stored run can be different, so we read
+        # all files that overlap with the chunk and select its variants.
+        files = [file_path
+                 for stored_range, stored_files in sorted(self.files.items())
+                 if stored_range[0] < finish and start < stored_range[1]
+                 for file_path in stored_files]
+        if len(files) == 0:
+            statistics = pd.DataFrame(columns=["variant", "variant_index", "phenotype"] + STATISTICS_COLUMNS)
+        else:
+            statistics = pd.concat([pd.read_parquet(file_path) for file_path in files],
+                                   ignore_index=True)
+            statistics = statistics[(statistics["variant_index"] >= start)
+                                    & (statistics["variant_index"] < finish)]
+        print('Loaded {} stored associations for variants {}-{}'.format(
+            statistics.shape[0], start, finish))
+        return StoredChunkStatistics(statistics, reference_indices)
+
+
+class StoredChunkStatistics:
+    """
+    Stored sufficient statistics of a single genotype chunk, keeping track
+    of the associations that have been added to a tile.
+
+    Variants are matched on their reference index, as variant names need
+    not be unique in the reference.
+    """
+
+    def __init__(self, statistics, reference_indices):
+        self.statistics = statistics
+        self.variant_rows = self.get_variant_rows(
+            statistics["variant_index"].values.astype(np.int64), reference_indices)
+        self.used = np.zeros(statistics.shape[0], dtype=bool)
+
+    @staticmethod
+    def get_variant_rows(stored_indices, reference_indices):
+        """
+        Returns the row in the tile of every stored variant, -1 if the
+        tile does not contain the variant.
+        """
+        reference_indices = np.asarray(reference_indices, dtype=np.int64)
+        if reference_indices.shape[0] == 0:
+            return np.full(stored_indices.shape[0], -1, dtype=np.int64)
+        order = np.argsort(reference_indices)
+        positions = np.searchsorted(reference_indices[order], stored_indices)
+        rows = order[np.minimum(positions, reference_indices.shape[0] - 1)]
+        rows[reference_indices[rows] != stored_indices] = -1
+        return rows
+
+    def add_to(self, accumulator, phenotype_names):
+        phenotype_columns = pd.Index(phenotype_names).get_indexer(self.statistics["phenotype"].values)
+        selected = (self.variant_rows != -1) & (phenotype_columns != -1) & ~self.used
+        accumulator.add_statistics(
+            self.variant_rows[selected], phenotype_columns[selected],
+            [self.statistics[column].values[selected] for column in STATISTICS_COLUMNS])
+        self.used |= selected
+
+    def get_unused(self):
+        return self.statistics[~self.used]
 
 
 class CohortAnalyser:
@@ -441,7 +1132,8 @@ class CohortAnalyser:
     def __init__(self, study_index, study_name, row_index,
                  sample_size, covariate_indices=None,
                  maf_threshold=0.0,
-                 a_test=None, b_cov=None, C=None, a_cov=None):
+                 a_test=None, b_cov=None, C=None, a_cov=None,
+                 max_block_bytes=16 * 1024 ** 2):
         self._covariate_indices = covariate_indices
         self.unknown_dimension_size = 1
         self.sample_size = sample_size
@@ -462,16 +1154,49 @@ class CohortAnalyser:
         self.number_of_constant_terms = None
         self._finalized = False
         self.maf_threshold = maf_threshold
+        self.max_block_bytes = max_block_bytes
+        self._a_cov_selected = None
+        self._a_cov_inverse = None
+        self._b_cov_selected = None
+        self.covariate_rss = None
 
     def set_partial_derivatives(self, a_test, b_cov, C, a_cov):
         """
         Set partial derivatives.
         """
+        self.set_covariate_partial_derivatives(b_cov, C, a_cov)
+        self.set_variant_dependent_partial_derivatives(a_test)
+
+    def set_variant_dependent_partial_derivatives(self, a_test):
+        """
+        Set the partial derivatives that depend on the variants in the genotype chunk.
+        """
+        self._a_test = a_test
+
+    def set_covariate_partial_derivatives(self, b_cov, C, a_cov):
+        """
+        Set the partial derivatives that do not depend on the variants.
+
+        These are the same for every genotype chunk, so the covariate-only terms
+        are computed here, once: the selected covariate part of A and its inverse,
+        the selected covariate part of b, and the residual sums of squares of the
+        phenotypes regressed on the covariates only.
+        """
         self._b_cov = b_cov
         self.C = C
-        self._a_test = a_test
         self._a_cov = a_cov
 
+        covariate_indices = self.get_covariate_indices()
+        self._a_cov_selected = a_cov[np.ix_(covariate_indices, covariate_indices)]
+        self._a_cov_inverse = invert_a_covariates(self._a_cov_selected)
+        self._b_cov_selected = b_cov[covariate_indices, :]
+        self.covariate_rss = covariate_residual_sum_of_squares(
+            self._a_cov_selected, self._b_cov_selected, C,
+            a_covariates_inverse=self._a_cov_inverse)
+
+    def has_covariate_partial_derivatives(self):
+        return self._a_cov_selected is not None
+
     def set_partial_derivatives_phenotype_index(self, index):
         """
         Set partial derivatives phenotype index. :param index: the index should be a dictionary with the names of the
@@ -484,14 +1209,18 @@ class CohortAnalyser:
         a_cov = self.get_a_cov()
         variant_names = self.get_variant_names()
 
-        # Use new A_inverse that supports variable number of non-constant A parts
-        a_inv, a_invertible = get_a_inverse_extended(a_cov, a_test)
+        # Use new A_inverse that supports variable number of non-constant A parts.
+        # We only need the rows belonging to the variable terms.
+        a_inv, a_invertible = get_a_inverse_extended(
+            a_cov, a_test, variable_rows_only=True,
+            a_covariates_inverse=self._a_cov_inverse)
 
         # Update variant indices with all variants for which the matrix
-        # cannot be inverted
+        # cannot be inverted. The inverse holds only the variable rows, so
+        # the complete A matrices of these variants are assembled again.
         self.a_singular = dict(zip(
             variant_names[~a_invertible],
-            a_inv[~a_invertible]))
+            get_a_extended(a_cov, a_test[~a_invertible])))
 
         self.add_variant_filter(a_invertible)
         self.a_inv = a_inv[a_invertible]
@@ -506,8 +1235,7 @@ class CohortAnalyser:
         self.variant_indices[self.variant_indices != -1] = indices_
 
     def get_a_cov(self):
-        return self._a_cov[np.ix_(self.get_covariate_indices(),
-                                  self.get_covariate_indices())]
+        return self._a_cov_selected
 
     def get_a_test(self):
         if self.variant_indices is None:
@@ -599,7 +1327,7 @@ class CohortAnalyser:
         :return: matrix b_cov
         """
         phenotype_indexes_for_partial_derivatives = self.get_phenotype_slicer_for_partial_derivatives()
-        return self._b_cov[np.ix_(self.get_covariate_indices(), phenotype_indexes_for_partial_derivatives)]
+        return self._b_cov_selected[:, phenotype_indexes_for_partial_derivatives]
 
     def get_C(self):
         """
@@ -667,30 +1395,26 @@ class CohortAnalyser:
 
     def _analyse(self, genotype, phenotype):
 
-        # Get partial derivatives
-        C_test = self.get_C()
-        b_cov_test = self.get_b_cov()
+        # Get partial derivatives. The covariate-only terms are precomputed,
+        # so we only need to select the phenotypes.
+        phenotype_slicer = self.get_phenotype_slicer_for_partial_derivatives()
+        b_cov_test = self._b_cov_selected[:, phenotype_slicer]
+        covariate_rss = self.covariate_rss[phenotype_slicer]
+        # The rows of the A inverse belonging to the variable terms
         a_inverse = self.get_a_inverse()
 
-        # Determine the number of constant terms
-        number_of_constant_terms = self.get_number_of_constant_terms()
-
         # Calculate the B4 matrix
         b4 = self.calculate_b4_matrix(genotype, phenotype)
         b_variable = b4[np.newaxis, ...]
 
         # Calculate the degrees of freedom
-        degrees_of_freedom = (self.sample_size - a_inverse.shape[1])
+        degrees_of_freedom = (self.sample_size - a_inverse.shape[2])
 
         print("B4 shape is {}".format(b4.shape))
 
-        # t_stat, standard_error = HASE(
-        #     b_variable[0, ...], a_inverse, b_cov_test, C_test,
-        #     number_of_constant_terms, degrees_of_freedom)
-
-        t_stat, standard_error = hase_supporting_interactions(
-            b_variable, a_inverse, b_cov_test, C_test,
-            number_of_constant_terms, degrees_of_freedom)
+        t_stat, standard_error = hase_fused(
+            b_variable, a_inverse, b_cov_test, covariate_rss,
+            degrees_of_freedom, max_block_bytes=self.max_block_bytes)
 
         self.analyser.t_stat = self.complete_output_with_missingness(t_stat[:, 0, :])
         self.analyser.standard_error = self.complete_output_with_missingness(standard_error[:, 0, :])
@@ -717,6 +1441,14 @@ class CohortAnalyser:
     def set_variant_names(self, variant_names):
         self.analyser.rsid = variant_names
 
+    def release_results(self):
+        """
+        Releases the results of the last phenotype chunk, once these have been
+        added to the meta-analysis.
+        """
+        self.analyser.t_stat = None
+        self.analyser.standard_error = None
+
     def get_sample_sizes(self):
         sample_sizes = np.zeros((self.variant_indices.shape[0], self.phenotype_indices.shape[0]))
         sample_sizes[np.ix_(self.variant_indices != -1, self.phenotype_indices != -1)] = self.sample_size
@@ -0,0 +1,398 @@
+"""
+Writing and reading classic meta-analysis results.
+
+Results are appended to long-lived parquet files by ParquetSink.
+
+Results can be partitioned by phenotype (-phenotype_buckets). Phenotypes
+are then hashed into a fixed number of buckets, and every node writes its
+results of a bucket to the hive style folder phenotype_bucket=<bucket>.
+The results of a single phenotype are read from the files of its bucket
+only.
+
+With the indexed schema (-result_schema indexed), the variant and phenotype
+columns are int32 codes instead of names. Variants are coded by their index
+in the keys of the mapper, phenotypes by their index in a phenotype
+dictionary that is written once per run next to the results. The readers
+here join the names back as Arrow dictionary arrays, so the names are not
+copied for every row.
+"""
+import glob
+import json
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PHENOTYPE_DICTIONARY = 'phenotypes.parquet'
+PART_SUFFIX = '.part'
+PARTITIONING = 'partitioning.json'
+
+RESULT_COLUMNS = ["variant", "phenotype", "beta", "standard_error", "i_squared", "sample_size"]
+
+PHENOTYPE_DICTIONARY_SCHEMA = pa.schema(
+    [("phenotype_index", pa.int32()),
+     ("phenotype", pa.string())])
+
+
+def write_phenotype_dictionary(out, phenotype_names):
+    """
+    Writes the phenotype dictionary of a run to the output folder.
+    Nodes of the same run write identical files, so we write to a temporary
+    file first, and replace the dictionary at once.
+    """
+    path = os.path.join(out, PHENOTYPE_DICTIONARY)
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    table = pa.Table.from_arrays(
+        [pa.array(np.arange(len(phenotype_names), dtype=np.int32)),
+         pa.array(np.asarray(phenotype_names).astype(object), type=pa.string())],
+        schema=PHENOTYPE_DICTIONARY_SCHEMA)
+    pq.write_table(table, temporary_path)
+    os.rename(temporary_path, path)
+    return path
+
+
+def read_phenotype_dictionary(path):
+    """
+    :param path: phenotype dictionary file, or the result folder containing it
+    :return: Arrow array with the phenotype name of every phenotype code
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, PHENOTYPE_DICTIONARY)
+    table = pq.read_table(path)
+    codes = table.column("phenotype_index").to_pandas().values
+    if not np.array_equal(codes, np.arange(len(codes))):
+        raise ValueError('Phenotype dictionary {} is not complete'.format(path))
+    return pa.concat_arrays(table.column("phenotype").chunks)
+
+
+def read_variant_dictionary(mapper_folder):
+    """
+    :param mapper_folder: mapper folder of the run
+    :return: Arrow array with the variant name of every variant code
+    """
+    keys = glob.glob(os.path.join(mapper_folder, 'keys_*'))
+    if len(keys) != 1:
+        raise ValueError('There should be a single reference keys file in folder {}'.format(mapper_folder))
+    return pa.array(np.load(keys[0]).astype(object), type=pa.string())
+
+
+class IndexedResultReader(object):
+    """
+    Reads results written with the indexed schema, with the variant and
+    phenotype codes replaced by dictionary arrays of their names.
+
+    The dictionaries are loaded on first use.
+    """
+
+    def __init__(self, phenotype_dictionary, mapper_folder):
+        self.phenotype_dictionary_path = phenotype_dictionary
+        self.mapper_folder = mapper_folder
+        self._dictionaries = None
+
+    @property
+    def dictionaries(self):
+        if self._dictionaries is None:
+            self._dictionaries = {
+                "variant": read_variant_dictionary(self.mapper_folder),
+                "phenotype": read_phenotype_dictionary(self.phenotype_dictionary_path)}
+        return self._dictionaries
+
+    def read(self, path, columns=None):
+        return self.decode(pq.read_table(path, columns=columns))
+
+    def decode(self, table):
+        """
+        Replaces the int32 variant and phenotype columns of the table by
+        dictionary arrays. Tables with names are returned as they are.
+        """
+        for name, dictionary in self.dictionaries.items():
+            index = table.schema.get_field_index(name)
+            if index == -1 or not pa.types.is_integer(table.schema[index].type):
+                continue
+            column = table.column(index)
+            table = table.set_column(
+                index, pa.field(name, pa.dictionary(column.type, pa.string())),
+                pa.chunked_array(
+                    [pa.DictionaryArray.from_arrays(chunk, dictionary) for chunk in column.chunks],
+                    type=pa.dictionary(column.type, pa.string())))
+        return table
+
+
+def fsync(path):
+    """
+    Flushes a file, or the entries of a directory, to disk.
+    """
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def phenotype_buckets(phenotype_names, buckets):
+    """
+    Assigns phenotypes to buckets by the CRC32 hash of their names, which is
+    the same on every node, and in every Python version.
+
+    :param phenotype_names: array with phenotype names
+    :param buckets: number of buckets
+    :return: int64 array with the bucket of every phenotype name
+    """
+    names, inverse = np.unique(np.asarray(phenotype_names), return_inverse=True)
+    hashes = np.array([zlib.crc32(name if isinstance(name, bytes) else name.encode('utf-8')) & 0xffffffff
+                       for name in names], dtype=np.int64)
+    return (hashes % buckets)[inverse]
+
+
+def get_bucket_path(out, bucket):
+    return os.path.join(out, 'phenotype_bucket={}'.format(bucket))
+
+
+def write_partitioning(out, buckets):
+    """
+    Records the number of phenotype buckets in the output folder, so
+    that readers can find the bucket of a phenotype.
+    """
+    path = os.path.join(out, PARTITIONING)
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'w') as partitioning_file:
+        json.dump({'column': 'phenotype', 'hash': 'crc32', 'buckets': buckets}, partitioning_file)
+    os.rename(temporary_path, path)
+    return path
+
+
+def read_partitioning(out):
+    with open(os.path.join(out, PARTITIONING)) as partitioning_file:
+        return json.load(partitioning_file)
+
+
+def read_phenotype_results(out, phenotype, columns=None, phenotype_dictionary=None):
+    """
+    Reads the results of a single phenotype from phenotype partitioned
+    output, touching only the files of its bucket.
+
+    :param out: output folder with the partitioned results
+    :param phenotype: name of the phenotype
+    :param columns: columns to read, by default all
+    :param phenotype_dictionary: phenotype dictionary of indexed results,
+    by default the one in the output folder
+    :return: data frame with the results of the phenotype
+    """
+    partitioning = read_partitioning(out)
+    bucket = phenotype_buckets([phenotype], partitioning['buckets'])[0]
+    paths = sorted(glob.glob(os.path.join(get_bucket_path(out, bucket), '*_result.parquet')))
+    if columns is not None and "phenotype" not in columns:
+        columns = list(columns) + ["phenotype"]
+    if len(paths) == 0:
+        return pd.DataFrame(columns=columns if columns is not None else RESULT_COLUMNS)
+
+    results = pa.concat_tables([pq.read_table(path, columns=columns) for path in paths]).to_pandas()
+    label = phenotype
+    if results["phenotype"].dtype.kind in ('i', 'u'):
+        # Indexed results contain the codes of the phenotypes
+        dictionary = read_phenotype_dictionary(
+            out if phenotype_dictionary is None else phenotype_dictionary).to_pandas()
+        label = np.flatnonzero(np.asarray(dictionary) == phenotype)
+        if len(label) == 0:
+            return results.iloc[:0]
+        label = label[0]
+    return results[results["phenotype"].values == label].reset_index(drop=True)
+
+
+def table_size(table):
+    """
+    Returns the size in bytes of the buffers of an Arrow table.
+    """
+    return sum(buffer.size
+               for column in table.columns
+               for chunk in column.chunks
+               for buffer in chunk.buffers() if buffer is not None)
+
+
+class ParquetSink(object):
+    """
+    Appends tables to parquet files that stay open for the whole run.
+
+    Tables are buffered until they reach the target row group size, and
+    are then written as a single row group. After a file reaches the
+    maximum file size, the next row group starts a new file.
+
+    Files are named <prefix><part>_<name>.parquet, so they keep the
+    suffix of the per tile result files. They are written with a '.part' suffix and renamed when they are
+    complete, so other jobs never see a file without a footer. Completed
+    files are synced to disk before they are renamed. On closing, a JSON
+    manifest lists the files with their rows and row groups, and the tiles
+    that were written. A sink without any rows writes a single empty file
+    with the schema.
+
+    With defer_publish, completed files keep their '.part' suffix until
+    publish is called, so that a worker of a work queue can discard the
+    results of a task that another worker took over. The worker closes
+    the current file at the end of every task, with close_file.
+    """
+
+    def __init__(self, out, name, schema, prefix='', row_group_size=128 * 1024 ** 2, file_size=4 * 1024 ** 3,
+                 defer_publish=False):
+        self.out = out
+        self.name = name
+        self.prefix = prefix
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.file_size = file_size
+        self.files = []
+        self.tiles = []
+        self._buffer = []
+        self._buffered_rows = 0
+        self._buffered_bytes = 0
+        self._writer = None
+        self._closed = False
+        self.defer_publish = defer_publish
+        self._unpublished = []
+
+    def get_path(self, part):
+        return os.path.join(self.out, '{}{}_{}.parquet'.format(self.prefix, part, self.name))
+
+    def write(self, table, tile=None):
+        """
+        :param table: Arrow table with the schema of the sink
+        :param tile: description of the tile the table belongs to, for the manifest
+        """
+        if self._closed:
+            raise ValueError('Writing to closed sink {}'.format(self.name))
+        if not table.schema.equals(self.schema):
+            table = table.cast(self.schema)
+        if tile is not None:
+            # The buffered tables go to the open file, or else to a new file
+            part = len(self.files) - 1 if self._writer is not None else len(self.files)
+            self.tiles.append(dict(tile, rows=table.num_rows, part=part))
+        if table.num_rows == 0:
+            return
+        self._buffer.append(table)
+        self._buffered_rows += table.num_rows
+        self._buffered_bytes += table_size(table)
+        if self._buffered_bytes >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered tables as a row group.
+        """
+        if self._buffered_rows == 0:
+            return
+        if self._writer is None:
+            self._open_file()
+
+        table = pa.concat_tables(self._buffer)
+        self._writer.write_table(table, row_group_size=table.num_rows)
+        current = self.files[-1]
+        current['rows'] += table.num_rows
+        current['row_groups'] += 1
+        current['bytes'] += self._buffered_bytes
+
+        self._buffer = []
+        self._buffered_rows = 0
+        self._buffered_bytes = 0
+
+        if current['bytes'] >= self.file_size:
+            self._close_file()
+
+    def _open_file(self):
+        self.files.append({'path': os.path.basename(self.get_path(len(self.files))),
+                           'rows': 0, 'row_groups': 0, 'bytes': 0})
+        self._writer = pq.ParquetWriter(
+            self.get_path(len(self.files) - 1) + PART_SUFFIX, self.schema)
+
+    def close_file(self):
+        """
+        Writes the buffered tables, and completes the current file.
+        """
+        self.flush()
+        if self._writer is not None:
+            self._close_file()
+
+    def _close_file(self):
+        self._writer.close()
+        self._writer = None
+        path = os.path.join(self.out, self.files[-1]['path'])
+        fsync(path + PART_SUFFIX)
+        self._publish_file(path)
+
+    def _publish_file(self, path):
+        if self.defer_publish:
+            self._unpublished.append(path)
+            return
+        os.rename(path + PART_SUFFIX, path)
+        fsync(self.out)
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        if self._writer is not None:
+            self._close_file()
+        if len(self.files) == 0:
+            # Jobs expect at least one file, so without any rows we write
+            # an empty file with the schema. It has no results to discard.
+            self._open_file()
+            self._writer.close()
+            self._writer = None
+            path = self.get_path(0)
+            fsync(path + PART_SUFFIX)
+            os.rename(path + PART_SUFFIX, path)
+            fsync(self.out)
+        self._closed = True
+
+        # Files that were never published, after a failure
+        unpublished = set(os.path.basename(path) for path in self._unpublished)
+        for file_entry in self.files:
+            if file_entry['path'] in unpublished:
+                file_entry['published'] = False
+        manifest = {'name': self.prefix + self.name,
+                    'schema': str(self.schema),
+                    'files': self.files,
+                    'tiles': self.tiles}
+        path = os.path.join(self.out, '{}{}_manifest.json'.format(self.prefix, self.name))
+        with open(path + PART_SUFFIX, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.rename(path + PART_SUFFIX, path)
+        fsync(self.out)
+
+    def publish(self):
+        """
+        Renames the files that were completed with defer_publish.
+        """
+        for path in self._unpublished:
+            os.rename(path + PART_SUFFIX, path)
+        if len(self._unpublished) != 0:
+            fsync(self.out)
+        self._unpublished = []
+
+    def discard(self):
+        """
+        Removes the files that were completed with defer_publish since the
+        last publish, and the file that is being written, and removes
+        their tiles from the manifest.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._unpublished.append(os.path.join(self.out, self.files[-1]['path']))
+        self._buffer = []
+        self._buffered_rows = 0
+        self._buffered_bytes = 0
+        discarded = set(os.path.basename(path) for path in self._unpublished)
+        for path in self._unpublished:
+            if os.path.isfile(path + PART_SUFFIX):
+                os.remove(path + PART_SUFFIX)
+        self._unpublished = []
+        discarded_parts = set()
+        for part, file_entry in enumerate(self.files):
+            if file_entry['path'] in discarded:
+                file_entry['discarded'] = True
+                discarded_parts.add(part)
+        self.tiles = [tile for tile in self.tiles if tile['part'] not in discarded_parts]
@@ -0,0 +1,530 @@
+from __future__ import print_function
+
+import bisect
+import errno
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class _End(object):
+    pass
+
+
+END_OF_PASS = _End()
+
+
+class Prefetcher(object):
+    """
+    Iterates an iterable on a background thread, so that reading the next
+    item overlaps with processing the current one.
+
+    At most `depth` items are buffered. Exceptions raised while producing
+    items are passed on to the consumer.
+    """
+
+    def __init__(self, iterable, depth=1, name=None):
+        if depth < 1:
+            raise ValueError('Prefetch depth should be at least 1, got {}'.format(depth))
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(
+            target=self._produce, args=(iter(iterable),), name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        # Wait for space in the queue, but give up when the consumer
+        # closed the prefetcher.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+        except Exception:
+            traceback.print_exc()
+            self._put((None, sys.exc_info()[1]))
+            return
+        self._put((_End, None))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        item, exception = self._queue.get()
+        if exception is not None:
+            self._done = True
+            raise exception
+        if item is _End:
+            self._done = True
+            raise StopIteration
+        return item
+
+    __next__ = next
+
+    def close(self):
+        self._stop.set()
+        self._done = True
+        self._thread.join()
+
+
+class TileScheduler(object):
+    """
+    Schedules genotype chunk x phenotype chunk tiles.
+
+    The next genotype chunk and the next phenotype chunk are read on
+    background threads while the current tile is analysed. Phenotype chunks
+    are read in passes, one pass per genotype chunk; the phenotype reader
+    runs ahead into the pass of the next genotype chunk.
+
+    Iterating the scheduler gives for every genotype chunk a tuple of the
+    genotype chunk and an iterator over the phenotype chunks of its pass.
+    With a depth of 0 nothing is prefetched.
+
+    A pass is only started once its genotype chunk has been read, so that
+    no phenotype chunks are read beyond the pass of the last genotype chunk.
+    """
+
+    def __init__(self, genotype_chunks, phenotype_chunks, depth=1):
+        self.depth = depth
+        self._genotype_chunks = genotype_chunks
+        self._phenotype_chunks = phenotype_chunks
+        self._genotype_prefetcher = None
+        self._phenotype_prefetcher = None
+        # Number of passes that can be started, and whether more follow
+        self._pass_condition = threading.Condition()
+        self._passes_allowed = 0
+        self._last_pass_allowed = False
+        if depth > 0:
+            self._genotype_prefetcher = Prefetcher(
+                self._allow_passes(genotype_chunks), depth, name='genotype-prefetch')
+            self._phenotype_prefetcher = Prefetcher(
+                self._passes(phenotype_chunks), depth, name='phenotype-prefetch')
+
+    def _allow_passes(self, genotype_chunks):
+        try:
+            for genotype_chunk in genotype_chunks:
+                with self._pass_condition:
+                    self._passes_allowed += 1
+                    self._pass_condition.notify_all()
+                yield genotype_chunk
+        finally:
+            self._end_passes()
+
+    def _end_passes(self):
+        with self._pass_condition:
+            self._last_pass_allowed = True
+            self._pass_condition.notify_all()
+
+    def _next_pass(self):
+        """
+        Waits until the next pass can be started.
+
+        :return: False if there is no next pass
+        """
+        with self._pass_condition:
+            while self._passes_allowed == 0 and not self._last_pass_allowed:
+                self._pass_condition.wait(0.1)
+            if self._passes_allowed == 0:
+                return False
+            self._passes_allowed -= 1
+            return True
+
+    def _passes(self, phenotype_chunks):
+        while self._next_pass():
+            for phenotype_chunk in phenotype_chunks:
+                yield phenotype_chunk
+            yield END_OF_PASS
+
+    def _phenotype_pass(self):
+        for phenotype_chunk in self._phenotype_prefetcher:
+            if phenotype_chunk is END_OF_PASS:
+                return
+            yield phenotype_chunk
+
+    def __iter__(self):
+        if self.depth == 0:
+            for genotype_chunk in self._genotype_chunks:
+                yield genotype_chunk, self._phenotype_chunks
+        else:
+            for genotype_chunk in self._genotype_prefetcher:
+                yield genotype_chunk, self._phenotype_pass()
+
+    def close(self):
+        # The phenotype reader does not start another pass
+        with self._pass_condition:
+            self._passes_allowed = 0
+        self._end_passes()
+        for prefetcher in (self._genotype_prefetcher, self._phenotype_prefetcher):
+            if prefetcher is not None:
+                prefetcher.close()
+
+
+class BackgroundWriter(object):
+    """
+    Runs write jobs on a background thread, so that encoding and writing
+    results overlaps with the analysis of the next tile.
+
+    Jobs run in the order they are submitted. At most `depth` jobs are
+    queued; submitting to a full queue waits for the writer. After a job
+    failed the remaining jobs are dropped, and its exception is raised on
+    the next submit or on closing. With a depth of 0 jobs run on the
+    calling thread.
+
+    The time spent in jobs is kept in busy_secs, the time the caller waited
+    for the writer in blocked_secs.
+    """
+
+    def __init__(self, depth=4, name=None):
+        if depth < 0:
+            raise ValueError('Write queue depth should be at least 0, got {}'.format(depth))
+        self.depth = depth
+        self.busy_secs = 0.0
+        self.blocked_secs = 0.0
+        self._failed = False
+        self._exception = None
+        self._thread = None
+        if depth > 0:
+            self._queue = queue.Queue(maxsize=depth)
+            self._thread = threading.Thread(target=self._consume, name=name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self, function, args, kwargs):
+        start = time.time()
+        try:
+            function(*args, **kwargs)
+        finally:
+            self.busy_secs += time.time() - start
+
+    def _consume(self):
+        while True:
+            job = self._queue.get()
+            if job is _End:
+                return
+            if self._failed:
+                continue
+            try:
+                self._run(*job)
+            except Exception:
+                traceback.print_exc()
+                self._failed = True
+                self._exception = sys.exc_info()[1]
+
+    def _raise(self):
+        if self._exception is not None:
+            exception, self._exception = self._exception, None
+            raise exception
+
+    def submit(self, function, *args, **kwargs):
+        self._raise()
+        if self._thread is None:
+            self._run(function, args, kwargs)
+            return
+        start = time.time()
+        self._queue.put((function, args, kwargs))
+        self.blocked_secs += time.time() - start
+
+    def close(self):
+        """
+        Waits for the queued jobs to finish, and stops the writer thread.
+        """
+        if self._thread is not None:
+            start = time.time()
+            self._queue.put(_End)
+            self._thread.join()
+            self._thread = None
+            self.blocked_secs += time.time() - start
+        self._raise()
+
+
+class ChunkQueue(object):
+    """
+    Work queue of mapper chunks in a shared folder. Any number of worker
+    processes, on one machine or many, claim tasks from the queue until
+    none are left, so that idle workers take over the work of slow ones.
+
+    The tasks, ranges of reference indices, are written to tasks.json by
+    the first worker. A worker claims a task by exclusively creating the
+    claim file claims/<task>.<generation>, with the name of the worker as
+    content. Workers touch their file in workers/ on a background thread.
+    When the heartbeat of the owner of a claim is more than `timeout`
+    seconds older than the heartbeat of the worker itself, the claim is
+    stale, and another worker claims the task with the next generation.
+    Comparing the heartbeats of workers, and not the clocks of their
+    machines, keeps this working when the clocks do not agree.
+
+    Tasks are claimed on one thread, and completed on another. After
+    writing the results of a task, a worker checks that its claim was not
+    taken over (get_lost_tasks) and marks the task done (finish), or else
+    discards the results of the task and releases it (release). A claim
+    can still be taken over after this check, so a task is marked done by
+    exclusively creating done/<task>: only the worker that created it
+    publishes the results of the task. Claims that are not done are
+    released on closing. Workers stop when no task
+    can be claimed; tasks of workers that died after the other workers
+    stopped are claimed by starting a worker again.
+    """
+
+    TASKS = 'tasks.json'
+
+    def __init__(self, folder, timeout=600, heartbeat=None, worker=None):
+        self.folder = folder
+        self.timeout = timeout
+        self.heartbeat = timeout / 10.0 if heartbeat is None else heartbeat
+        if worker is None:
+            worker = '{}-{}-{}'.format(socket.gethostname().split('.')[0], os.getpid(), uuid.uuid4().hex[:8])
+        self.worker = worker
+        self.tasks = None
+        self.finished = 0
+        # Generation of the claim of every task of this worker, in the
+        # order of claiming, and the tasks that were passed on to complete
+        self.claims = OrderedDict()
+        self._completing = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        for name in ('claims', 'done', 'workers'):
+            try:
+                os.makedirs(os.path.join(folder, name))
+            except OSError:
+                if not os.path.isdir(os.path.join(folder, name)):
+                    raise
+        self._heartbeat_path = os.path.join(folder, 'workers', self.worker)
+
+    def create(self, tasks, metadata=None):
+        """
+        Writes the tasks to a new queue, or checks that an existing queue
+        has the same tasks, and starts the heartbeat of this worker.
+
+        :param tasks: list with the (start, finish) reference indices of every task
+        :param metadata: dictionary that should be the same for all workers
+        """
+        path = os.path.join(self.folder, self.TASKS)
+        content = {'metadata': metadata or {}, 'tasks': [[int(start), int(finish)] for start, finish in tasks]}
+        if not os.path.isfile(path):
+            # Workers that start at the same time write the same tasks
+            temporary_path = '{}.{}.tmp'.format(path, self.worker)
+            with open(temporary_path, 'w') as tasks_file:
+                json.dump(content, tasks_file)
+            os.rename(temporary_path, path)
+        with open(path) as tasks_file:
+            existing = json.load(tasks_file)
+        if existing != json.loads(json.dumps(content)):
+            raise ValueError('Work queue {} has other tasks than this worker, '
+                             'use the same mapper and settings for all workers'.format(self.folder))
+        self.tasks = [tuple(task) for task in existing['tasks']]
+        self._starts = [task[0] for task in self.tasks]
+        self._touch()
+        self._thread = threading.Thread(target=self._beat, name='queue-heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+        print('Worker {} joined work queue {} with {} tasks'.format(self.worker, self.folder, len(self.tasks)))
+
+    def _touch(self):
+        with open(self._heartbeat_path, 'a'):
+            os.utime(self._heartbeat_path, None)
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                self._touch()
+            except (IOError, OSError):
+                traceback.print_exc()
+
+    def get_claim_path(self, task, generation):
+        return os.path.join(self.folder, 'claims', '{}.{}'.format(task, generation))
+
+    def get_owner(self, task, generation):
+        try:
+            with open(self.get_claim_path(task, generation)) as claim_file:
+                return claim_file.read()
+        except IOError:
+            return None
+
+    def is_stale(self, owner):
+        """
+        A claim is stale when its owner stopped, or when the heartbeat of
+        its owner is older than the timeout.
+        """
+        if owner is None or owner == '' or owner == self.worker:
+            # The claim was released, is being written, or is ours
+            return False
+        try:
+            beat = os.path.getmtime(os.path.join(self.folder, 'workers', owner))
+        except OSError:
+            return True
+        return os.path.getmtime(self._heartbeat_path) - beat > self.timeout
+
+    def get_done_path(self, task):
+        return os.path.join(self.folder, 'done', str(task))
+
+    def _create_claim(self, task, generation):
+        return self._create_exclusive(self.get_claim_path(task, generation))
+
+    def _create_exclusive(self, path):
+        """
+        Creates a file with the name of this worker as content, if it does
+        not exist yet.
+
+        :return: True if this worker created the file
+        """
+        try:
+            descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        try:
+            os.write(descriptor, self.worker.encode('utf-8'))
+        finally:
+            os.close(descriptor)
+        return True
+
+    def claim(self):
+        """
+        Claims the first task that is not done, and not claimed by a
+        live worker.
+
+        :return: (start, finish) reference indices of the task, or None
+        """
+        if self.tasks is None:
+            raise ValueError('Work queue {} has no tasks'.format(self.folder))
+        done = set(os.listdir(os.path.join(self.folder, 'done')))
+        generations = {}
+        for name in os.listdir(os.path.join(self.folder, 'claims')):
+            task, generation = name.split('.')
+            generations[task] = max(generations.get(task, -1), int(generation))
+
+        claimed = set(self.get_claimed())
+        for i in range(len(self.tasks)):
+            task = str(i)
+            if task in done or i in claimed:
+                continue
+            generation = generations.get(task)
+            if generation is None:
+                generation = 0
+            elif self.is_stale(self.get_owner(task, generation)):
+                print('Taking over stale claim of task {}'.format(task))
+                generation += 1
+            else:
+                continue
+            if self._create_claim(task, generation):
+                with self._lock:
+                    self.claims[i] = generation
+                return self.tasks[i]
+        return None
+
+    def get_claimed(self):
+        with self._lock:
+            return list(self.claims)
+
+    def get_task(self, chunk):
+        """
+        :return: index of the task that contains a chunk
+        """
+        return bisect.bisect_right(self._starts, chunk[0]) - 1
+
+    def pop_completed(self, task=None):
+        """
+        Returns the tasks claimed before a task, that have not been
+        returned before. The chunks of a worker are analysed in the order
+        that the tasks were claimed, so these tasks are completed when the
+        first chunk of the task is analysed.
+
+        :param task: index of the task that is analysed, None at the end of the analysis
+        :return: list with task indices
+        """
+        with self._lock:
+            completed = []
+            for i in self.claims:
+                if i == task:
+                    break
+                if i not in self._completing:
+                    completed.append(i)
+            self._completing.update(completed)
+            return completed
+
+    def get_lost_tasks(self, tasks=None):
+        """
+        :param tasks: task indices of this worker, by default all
+        :return: task indices that were claimed by other workers
+        """
+        with self._lock:
+            claims = [(i, self.claims[i]) for i in (self.claims.keys() if tasks is None else tasks)]
+        return [i for i, generation in claims
+                if os.path.exists(self.get_claim_path(i, generation + 1))]
+
+    def finish(self, tasks=None):
+        """
+        Marks tasks of this worker as done. When another worker marked one
+        of the tasks done first, none of the tasks are marked, and the
+        results of the tasks should be discarded.
+
+        :param tasks: task indices, by default all
+        :return: True if the tasks were marked done by this worker
+        """
+        with self._lock:
+            tasks = list(self.claims) if tasks is None else tasks
+        marked = []
+        for i in tasks:
+            if not self._create_exclusive(self.get_done_path(i)):
+                for j in marked:
+                    os.remove(self.get_done_path(j))
+                return False
+            marked.append(i)
+        with self._lock:
+            for i in tasks:
+                del self.claims[i]
+                self._completing.discard(i)
+            self.finished += len(tasks)
+        return True
+
+    def release(self, tasks=None):
+        """
+        Removes claims of this worker that are not done, so that other
+        workers can claim these tasks.
+
+        :param tasks: task indices, by default all
+        """
+        with self._lock:
+            tasks = list(self.claims) if tasks is None else tasks
+            for i in tasks:
+                try:
+                    os.remove(self.get_claim_path(i, self.claims[i]))
+                except OSError:
+                    pass
+                del self.claims[i]
+                self._completing.discard(i)
+
+    def close(self):
+        self.release()
+        print('Worker {} finished {} tasks'.format(self.worker, self.finished))
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if os.path.exists(self._heartbeat_path):
+            os.remove(self._heartbeat_path)
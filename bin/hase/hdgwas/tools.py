@@ -13,6 +13,8 @@ from scipy import stats
 from hash import *
 import glob
 import inspect, itertools
+import json
+import hashlib
 
 
 def timer(func):
@@ -357,6 +359,72 @@ class Checker(object):  # TODO (mid) finish or remove this class
 ########################################################################
 ########################################################################
 ########################################################################
+PACKED_MAPPER = 'packed_mapper.json'
+# Filtering on CHR and bp needs the reference index, which is not supported
+FILTER_COLUMN_SETS = (("ID",),)
+# Number of reference variants to count the workload of at once
+NODE_PLAN_BLOCK_SIZE = 2 ** 20
+
+
+def get_key_order_path(folder, reference_name):
+    return os.path.join(folder, 'key_order_' + reference_name + '.npy')
+
+
+def hash_file(path, block_size=2 ** 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pack_mapper(folder, reference_name, study_names=None, out=None):
+    """
+    Packs a mapper folder into files that can be memory-mapped: the keys as
+    a fixed width string array, the values of all studies as an int32
+    column-major (n_keys, n_studies) array, and the flips as int8 arrays.
+
+    :param folder: mapper folder
+    :param reference_name: reference name of the mapper
+    :param study_names: studies to pack, by default all studies in the folder
+    :param out: folder to write the packed mapper to, by default the mapper folder
+    :return: path of the packed mapper metadata
+    """
+    out = folder if out is None else out
+    prefix = os.path.join(folder, 'values_' + reference_name + '_')
+    if study_names is None:
+        study_names = sorted(path[len(prefix):-len('.npy')] for path in glob.glob(prefix + '*.npy'))
+    if len(study_names) == 0:
+        raise ValueError('There is no mapper data in folder {}'.format(folder))
+
+    keys = np.load(os.path.join(folder, 'keys_' + reference_name + '.npy'))
+    keys = keys.astype('S')
+    np.save(os.path.join(out, 'packed_keys_' + reference_name + '.npy'), keys)
+    np.save(get_key_order_path(out, reference_name), np.argsort(keys, kind='mergesort'))
+
+    values = np.lib.format.open_memmap(
+        os.path.join(out, 'packed_values_' + reference_name + '.npy'), mode='w+',
+        dtype=np.int32, shape=(keys.shape[0], len(study_names)), fortran_order=True)
+    for j, study_name in enumerate(study_names):
+        study_values = np.load(os.path.join(folder, 'values_' + reference_name + '_' + study_name + '.npy'))
+        if study_values.shape[0] != keys.shape[0]:
+            raise ValueError('Number of indexes {} in mapper values of {} is different from keys length {}!'.format(
+                study_values.shape[0], study_name, keys.shape[0]))
+        if study_values.max() > np.iinfo(np.int32).max:
+            raise ValueError('Mapper values of {} do not fit in int32'.format(study_name))
+        values[:, j] = study_values
+        flip = np.load(os.path.join(folder, 'flip_' + reference_name + '_' + study_name + '.npy'))
+        np.save(os.path.join(out, 'packed_flip_' + reference_name + '_' + study_name + '.npy'), flip.astype(np.int8))
+    values.flush()
+    del values
+
+    path = os.path.join(out, PACKED_MAPPER)
+    with open(path, 'w') as metadata_file:
+        json.dump({'reference': reference_name, 'studies': list(study_names), 'n_keys': int(keys.shape[0])},
+                  metadata_file)
+    return path
+
+
 class Mapper(object):
 
     def __init__(self):
@@ -374,6 +442,14 @@ class Mapper(object):
         self.reference = None
         self.include = None
         self.exclude = None
+        # Paths of the variant filter tables. These are only read when the
+        # filtered values are not in the filter cache.
+        self.include_paths = None
+        self.exclude_paths = None
+        self.filter_cache = None
+        self.folder = None
+        self._key_order = None
+        self._sorted_keys = None
         self.include_ind = np.array([], dtype=np.int64)
         self.exclude_ind = np.array([], dtype=np.int64)
         # self.hash=HashTable()
@@ -385,11 +461,36 @@ class Mapper(object):
         self.flip = {}  # keys - study names; values - array, with length equal to number of probes
         self.probes = None
         self.encoded = {}
+        # Range of reference indices of the last chunk returned by get,
+        # and the reference indices of its keys. A chunk can span several
+        # mapper chunks.
+        self.chunk_range = None
+        self.chunk_key_indices = None
+        # Sorted reference indices of the testable variants, computed once
+        # after filtering, with and without missingness allowed.
+        self.testable_indices = {}
+        # Range of reference indices of the chunks of this node
+        self.key_range = None
+        # How the reference indices are split over the nodes: 'keys' for an
+        # equal number of reference variants, 'variants' for an equal number
+        # of testable variants, and 'cohorts' for an equal number of
+        # variant-cohort pairs of testable variants.
+        self.balance = 'keys'
+        self.allow_missingness = False
+        # Work queue that chunks are claimed from, instead of the chunks of
+        # a node, see ChunkQueue in scheduler.py
+        self.queue = None
 
     def chunk_pop(self):
+        if self.queue is not None:
+            return self.pop_queued_chunk()
+
         if self.chunk_pool is None and self.cluster is None:
             raise ValueError('Cluster settings are not defined!')
 
+        if self.chunk_pool is None and self.balance != 'keys':
+            self.chunk_pool = self.get_balanced_chunk_pool()
+
         if self.chunk_pool is None:
             self.chunk_pool = []
             if self.node is None:
@@ -418,6 +519,10 @@ class Mapper(object):
                 if (self.n_keys - N * self.node[0]) != 0:
                     self.chunk_pool.append([self.chunk_pool[-1][1], self.n_keys])
             self.chunk_pool = self.chunk_pool[::-1]
+            # Chunks are only taken from the pool of this node, so only
+            # this range of the mapper is needed
+            self.key_range = (min(ch[0] for ch in self.chunk_pool), max(ch[1] for ch in self.chunk_pool))
+            self.testable_indices = {}
 
         if len(self.chunk_pool) != 0:
             ch = self.chunk_pool.pop()
@@ -518,6 +623,21 @@ class Mapper(object):
                 self.dic[k] = self.dic[k] + [-1]
 
     # @timing
+    def get_packed_metadata(self, folder):
+        """
+        Returns the metadata of the packed mapper in the folder, if it has
+        one for the reference and all studies.
+        """
+        path = os.path.join(folder, PACKED_MAPPER)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as metadata_file:
+            metadata = json.load(metadata_file)
+        if metadata['reference'] != self.reference_name \
+                or any(name not in metadata['studies'] for name in self.genotype_names):
+            return None
+        return metadata
+
     def load_flip(self, folder, encode=None):
 
         if folder is None:
@@ -528,19 +648,28 @@ class Mapper(object):
         if self.reference_name is None:
             raise ValueError('Reference name for mapper is not defined!')
 
-        if len(glob.glob(folder + 'flip_*')) == 0:
+        if len(glob.glob(folder + 'flip_*')) == 0 and self.get_packed_metadata(folder) is None:
             raise ValueError('There is no flip mapper data in folder {}'.format(folder))
 
+        # The int8 flips of a packed mapper are memory-mapped
+        if self.get_packed_metadata(folder) is not None:
+            def load(name):
+                return np.load(os.path.join(folder, 'packed_flip_' + self.reference_name + '_' + name + '.npy'),
+                               mmap_mode='r')
+        else:
+            def load(name):
+                return np.load(os.path.join(folder, 'flip_' + self.reference_name + '_' + name + '.npy'))
+
         for j, i in enumerate(self.genotype_names):
             if encode is not None:
                 self.encoded[i] = encode[j]
                 if encode[j] == 0:
-                    self.flip[i] = np.load(os.path.join(folder, 'flip_' + self.reference_name + '_' + i + '.npy'))
+                    self.flip[i] = load(i)
                 elif encode[j] == 1:
-                    flip = np.load(os.path.join(folder, 'flip_' + self.reference_name + '_' + i + '.npy'))
-                    self.flip[i] = np.ones(flip.shape[0])
+                    flip = load(i)
+                    self.flip[i] = np.ones(flip.shape[0], dtype=flip.dtype)
             else:
-                self.flip[i] = np.load(os.path.join(folder, 'flip_' + self.reference_name + '_' + i + '.npy'))
+                self.flip[i] = load(i)
 
     # @timing
     def load(self, folder):
@@ -552,6 +681,47 @@ class Mapper(object):
         if self.reference_name is None:
             raise ValueError('Reference name for mapper is not defined!')
 
+        if self.genotype_names is None:
+            raise ValueError('Genotype names are not defined!')
+
+        metadata = self.get_packed_metadata(folder)
+        if metadata is not None:
+            self.load_packed(folder, metadata)
+        else:
+            self.load_arrays(folder)
+
+        if self.n_keys != self.values.shape[0]:
+            raise ValueError(
+                'Number of indexes {} in mapper values is different from keys length {}!'.format(self.values.shape[0],
+                                                                                                 self.n_keys))
+
+        self.n_study = self.values.shape[1]
+        if self.n_keys < self.n_study:
+            print ('WARNING!!! Normally should be more test values that studies! Check your saved data for Mapper')
+
+        print ('You loaded values for {} studies and {} test values'.format(self.n_study, self.n_keys))
+
+        self.folder = folder
+
+    def load_packed(self, folder, metadata):
+        """
+        Memory-maps a packed mapper, so that only the parts of the mapper
+        that are used are read. The values are mapped copy-on-write, as
+        filtering modifies them.
+        """
+        self.keys = np.load(os.path.join(folder, 'packed_keys_' + self.reference_name + '.npy'), mmap_mode='r')
+        self.n_keys = self.keys.shape[0]
+        values = np.load(os.path.join(folder, 'packed_values_' + self.reference_name + '.npy'), mmap_mode='c')
+        # Mapper values should always maintain the same order as the order of study names. Consecutive studies
+        # are a view of the packed values, other selections are copied.
+        columns = [metadata['studies'].index(name) for name in self.genotype_names]
+        if columns == list(range(columns[0], columns[0] + len(columns))):
+            self.values = values[:, columns[0]:columns[0] + len(columns)]
+        else:
+            self.values = values[:, columns]
+        print('Memory-mapped packed mapper in folder {}'.format(folder))
+
+    def load_arrays(self, folder):
         if len(glob.glob(folder + 'keys_*')) == 0:
             raise ValueError('There is no mapper data in folder {}'.format(folder))
 
@@ -566,30 +736,12 @@ class Mapper(object):
         if len(values) == 0:
             raise ValueError('There is no mapper data in folder {}'.format(folder))
 
-        if self.genotype_names is None:
-            raise ValueError('Genotype names are not defined!')
-
         self.values = np.zeros((self.n_keys, len(self.genotype_names)))
         # Mapper files should always maintain the same order as the order of study names, so they stay aligned
         # with all other data structures.
         for j, i in enumerate(self.genotype_names):
             self.values[:, j] = np.load(os.path.join(folder, 'values_' + self.reference_name + '_' + i + '.npy'))
 
-        if self.n_keys != self.values.shape[0]:
-            raise ValueError(
-                'Number of indexes {} in mapper values is different from keys length {}!'.format(self.values.shape[0],
-                                                                                                 self.n_keys))
-
-        self.n_study = self.values.shape[1]
-        if self.n_keys < self.n_study:
-            print ('WARNING!!! Normally should be more test values that studies! Check your saved data for Mapper')
-
-        print ('You loaded values for {} studies and {} test values'.format(self.n_study, self.n_keys))
-
-        if self.include is not None or self.exclude is not None:
-            self.reference = Reference(self.reference_name)
-            self.reference.load_index()
-
     # @timing
     def get_old(self, chunk_number=None):
 
@@ -612,6 +764,12 @@ class Mapper(object):
             self.processed = finish
 
         with Timer() as t_q:
+            # Only filtering on CHR and bp needs the reference index
+            if self.reference is None and any(
+                    variant_filter is not None and 'ID' not in variant_filter.columns
+                    for variant_filter in (self.include, self.exclude)):
+                self.reference = Reference(self.reference_name)
+                self.reference.load_index()
             if self.include is not None:
                 if len(self.include_ind) == 0:
                     if 'ID' in self.include.columns:
@@ -714,92 +872,29 @@ class Mapper(object):
             finish = self.processed \
                      + self.chunk_size if (self.processed + self.chunk_size) < self.n_keys else self.n_keys
             self.processed = finish
+        first_start = start
 
         with Timer() as t_q:
 
             if not self.is_filtered:
-
-                # Now, depending on the presence of a grouping by dataset,
-                # either set all unwanted variants in 'values' to -1, or
-                # only do this for values unwanted per group.
-                #
-
-                # First make a dictionary with keys and indices
-                key_index_dictionary = dict(zip(self.keys, range(0, len(self.keys))))
-                print("Finished making key:index dictionary of size: {}".format(len(key_index_dictionary)))
-
-                if self.include is not None:
-                    if 'ID' in self.include.columns:
-                        # Now select the indices for those keys that should be included.
-                        print("Subsetting mapper to include specified variants. (n = {})".format(self.include.shape[0]))
-                        self.include['indices'] = self.include.ID.apply(lambda x: key_index_dictionary.get(x, (-1)))
-                        print("Retrieved all indices of variants that should be included!")
-                        self.include = self.include[self.include['indices'] != -1]
-                        print("Number of variants that remain after excluding variants not in mapper: {}".format(self.include.shape[0]))
-                    elif 'CHR' in self.include.columns and 'bp' in self.include.columns:
-                        raise NotImplementedError()
-                        # TODO: check first if this works as expected
-
-                        # self.query_include = self.reference.index.select(
-                        #     'reference', where='CHR=self.include.CHR & bp=self.include.bp')
-                        # self.include['indices'] = self.query_include.index
-                    if "cohort" not in self.include.index.names:
-                        self.include = pd.concat(
-                            [self.include]*self.values.shape[1],
-                            keys=np.arange(self.values.shape[1]),
-                            names=["cohort", "row"])
-
-                    new_values = np.full_like(self.values, -1)
-                    new_values[
-                        self.include.indices,
-                        self.include.index.get_level_values("cohort").values] = (
-                        self.values[
-                            self.include.indices,
-                            self.include.index.get_level_values("cohort").values])
-
-                    self.values = new_values
-
-
-                if self.exclude is not None:
-                    if 'ID' in self.exclude.columns:
-                        # Now select the indices for those keys that should be included.
-                        self.exclude['indices'] = self.exclude.ID.apply(lambda x: key_index_dictionary.get(x, (-1)))
-                        self.exclude = self.exclude[self.exclude['indices'] != -1]
-                    elif 'CHR' in self.exclude.columns and 'bp' in self.exclude.columns:
-                        raise NotImplementedError()
-                        # TODO: check first if this works as expected
-
-                        # self.query_exclude = self.reference.index.select(
-                        #     'reference', where='CHR=self.include.CHR & bp=self.include.bp')
-                        # self.exclude['indices'] = self.query_exclude.index
-                    if "cohort" not in self.exclude.index.names:
-                        self.exclude = pd.concat(
-                            [self.exclude]*self.values.shape[1],
-                            keys=np.arange(self.values.shape[1]),
-                            names=["cohort", "row"])
-
-                    self.values[self.exclude.indices, self.exclude.index.get_level_values("cohort").values] = -1
+                self.filter_values()
                 self.is_filtered = True
+                self.testable_indices = {}
+
+            testable_indices = self.get_testable_indices(allow_missingness)
 
         print("Time to select SNPs {}s".format(t_q.secs))
 
-        if allow_missingness:
-            # Get the indices for those values that are present in ANY studies
-            # Values that are greater than -1 are present
-            all_indices_for_values_with_all_studies_available = np.where(
-                (self.values[:, :] > -1).any(axis=1))[0]
-        else:
-            # Get the indices for those values that are present in ALL studies
-            # Values that are greater than -1 are present
-            all_indices_for_values_with_all_studies_available = np.where(
-                (self.values[:, :] > -1).all(axis=1))[0]
+        # The testable variants from the start of the chunk on. The number
+        # of these before a finish is found by binary search.
+        first_testable = np.searchsorted(testable_indices, start)
 
-        all_indices_for_values_with_all_studies_available = all_indices_for_values_with_all_studies_available[
-            all_indices_for_values_with_all_studies_available >= start]
+        def count_testable(finish):
+            return np.searchsorted(testable_indices, finish) - first_testable
 
         # Loop over chunks, popping them, while the current chunk does not contain more than self.chunk_size values.
 
-        while np.sum(all_indices_for_values_with_all_studies_available < finish) < self.chunk_size:
+        while count_testable(finish) < self.chunk_size:
             if self.processed == self.n_keys:
                 break
 
@@ -810,6 +905,10 @@ class Mapper(object):
                                                              < self.n_keys else self.n_keys
                 self.processed = finish
             else:
+                if self.queue is not None and len(self.chunk_pool) == 0:
+                    # The next task of the queue does not follow on from
+                    # this one, its variants in between belong to other workers
+                    break
                 ch = self.chunk_pop()
                 if ch is not None:
                     start = ch[0]
@@ -819,7 +918,7 @@ class Mapper(object):
 
         # Give back the latest chunk if there will be over 1.5 times self.chunk in the values
 
-        if np.sum(all_indices_for_values_with_all_studies_available < finish) > 1.5 * self.chunk_size:
+        if count_testable(finish) > 1.5 * self.chunk_size:
             if chunk_number is None:
                 self.processed = self.processed = start
                 finish = start
@@ -828,10 +927,12 @@ class Mapper(object):
                 self.chunk_pool.append(ch)
                 finish = ch[0]
 
-        indices_for_values_with_all_studies_available = all_indices_for_values_with_all_studies_available[
-            all_indices_for_values_with_all_studies_available < finish]
+        indices_for_values_with_all_studies_available = testable_indices[
+            first_testable:np.searchsorted(testable_indices, finish)]
 
         keys = self.keys[indices_for_values_with_all_studies_available]
+        self.chunk_range = (first_start, finish)
+        self.chunk_key_indices = indices_for_values_with_all_studies_available
 
         indexes = self.values[indices_for_values_with_all_studies_available, :]
 
@@ -840,6 +941,180 @@ class Mapper(object):
 
         return [indexes[:, i].astype(np.int64) for i in range(self.n_study)], keys
 
+    def get_testable_indices(self, allow_missingness=False):
+        """
+        Returns the sorted reference indices of the variants that can be
+        tested: present in any study if missingness is allowed, or else
+        present in all studies. Values that are greater than -1 are present.
+        """
+        if allow_missingness not in self.testable_indices:
+            # A node only needs the variants in the range of its chunks
+            start, finish = (0, self.n_keys) if self.key_range is None else self.key_range
+            present = np.asarray(self.values[start:finish]) > -1
+            self.testable_indices[allow_missingness] = start + np.flatnonzero(
+                present.any(axis=1) if allow_missingness else present.all(axis=1))
+        return self.testable_indices[allow_missingness]
+
+    def pop_queued_chunk(self):
+        """
+        Pops the next chunk of the task claimed from the work queue, and
+        claims a new task when these are all popped.
+        """
+        if self.chunk_pool is None:
+            self.chunk_pool = []
+        if len(self.chunk_pool) == 0:
+            task = self.queue.claim()
+            if task is None:
+                return None
+            start, finish = task
+            self.chunk_pool = [[i, min(i + self.chunk_size, finish)]
+                               for i in range(start, finish, self.chunk_size)][::-1]
+        return self.chunk_pool.pop()
+
+    def get_queue_tasks(self, task_chunks):
+        """
+        Splits the reference indices into tasks for a work queue.
+
+        :param task_chunks: number of mapper chunks per task
+        :return: list with the (start, finish) reference indices of every task
+        """
+        task_size = task_chunks * self.chunk_size
+        return [(i, min(i + task_size, self.n_keys)) for i in range(0, self.n_keys, task_size)]
+
+    def get_balanced_chunk_pool(self):
+        """
+        Returns the chunks of this node, in the order they are popped, with
+        the node ranges split by workload instead of by reference indices.
+        """
+        if self.node is None:
+            raise ValueError('cluster setting not defined! (number of nodes / this node number) ')
+        self.node = [int(i) for i in self.node]
+        start, finish = self.get_node_ranges(self.node[0], self.allow_missingness)[self.node[1] - 1]
+        print('Node {} of {} analyses reference indices {}-{}'.format(self.node[1], self.node[0], start, finish))
+        self.key_range = (start, finish)
+        self.testable_indices = {}
+        return [[i, min(i + self.chunk_size, finish)] for i in range(start, finish, self.chunk_size)][::-1]
+
+    def get_workload(self, start, finish, allow_missingness=False):
+        """
+        Counts the work in a range of reference indices.
+
+        :return: boolean array that is True for the testable variants, and
+        int64 array with the number of cohorts of every testable variant
+        """
+        present = np.asarray(self.values[start:finish]) > -1
+        cohorts = present.sum(axis=1)
+        testable = cohorts > 0 if allow_missingness else cohorts == self.n_study
+        return testable, np.where(testable, cohorts, 0)
+
+    def get_key_weights(self, start, finish, allow_missingness=False):
+        testable, cohorts = self.get_workload(start, finish, allow_missingness)
+        return cohorts if self.balance == 'cohorts' else testable.astype(np.int64)
+
+    def filter_all_values(self):
+        """
+        Filters the values of all nodes, which the workload of every node
+        is counted from.
+        """
+        if self.is_filtered:
+            return
+        key_range = self.key_range
+        self.key_range = None
+        try:
+            self.filter_values()
+        finally:
+            self.key_range = key_range
+        self.is_filtered = True
+        self.testable_indices = {}
+
+    def get_node_ranges(self, nodes, allow_missingness=False, plan=False):
+        """
+        Splits the reference indices over the nodes. With the 'variants'
+        balance every node gets about the same number of testable variants,
+        with the 'cohorts' balance about the same number of variant-cohort
+        pairs, as the time to analyse a variant grows with its cohorts.
+
+        The ranges are cached in the filter cache folder, if there is one.
+        With variant filters the workload can only be counted after
+        filtering the values of all nodes, so this is left to a plan, of
+        which the nodes read the cached ranges.
+
+        :param plan: count the workload, also if the values are filtered
+        :return: list with the (start, finish) reference indices of every node
+        """
+        if self.balance == 'keys':
+            N = self.n_keys / nodes
+            if N < 1:
+                raise ValueError('Too many nodes! Change chunk size in mapper')
+            return [(N * i, N * (i + 1) if i + 1 < nodes else self.n_keys) for i in range(nodes)]
+
+        cache_path = self.get_node_ranges_cache_path(nodes, allow_missingness)
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path) as cache_file:
+                return [tuple(node_range) for node_range in json.load(cache_file)]
+        if self.has_filters() and not plan:
+            raise ValueError('The node ranges for {} nodes balanced by {} are not in the mapper cache, '
+                             'run a plan (-plan) with the same filters first'.format(nodes, self.balance))
+
+        self.filter_all_values()
+        blocks = range(0, self.n_keys, NODE_PLAN_BLOCK_SIZE)
+        block_weights = np.array(
+            [self.get_key_weights(i, min(i + NODE_PLAN_BLOCK_SIZE, self.n_keys), allow_missingness).sum()
+             for i in blocks], dtype=np.int64)
+        cumulative = np.cumsum(block_weights)
+        total = cumulative[-1] if len(blocks) != 0 else 0
+
+        bounds = [0]
+        weights = None
+        for node in range(1, nodes):
+            # The node ends after the variant that brings the weight of
+            # this and earlier nodes to its share of the total weight
+            target = total * node / float(nodes)
+            block = np.searchsorted(cumulative, target)
+            if target == 0 or block == len(blocks):
+                bounds.append(bounds[-1])
+                continue
+            if weights is None or weights[0] != block:
+                start = blocks[block]
+                weights = (block, cumulative[block] - block_weights[block] + np.cumsum(
+                    self.get_key_weights(start, min(start + NODE_PLAN_BLOCK_SIZE, self.n_keys), allow_missingness)))
+            bound = blocks[block] + np.searchsorted(weights[1], target) + 1
+            bounds.append(max(int(bound), bounds[-1]))
+        bounds.append(self.n_keys)
+        node_ranges = [(bounds[i], bounds[i + 1]) for i in range(nodes)]
+
+        if cache_path is not None:
+            try:
+                os.makedirs(self.filter_cache)
+            except OSError:
+                if not os.path.isdir(self.filter_cache):
+                    raise
+            temporary_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(temporary_path, 'w') as cache_file:
+                json.dump(node_ranges, cache_file)
+            os.rename(temporary_path, cache_path)
+        return node_ranges
+
+    def get_node_plan(self, nodes, allow_missingness=False):
+        """
+        Returns the expected workload of every node, with the reference
+        indices, testable variants and variant-cohort pairs of the node.
+        """
+        node_ranges = self.get_node_ranges(nodes, allow_missingness, plan=True)
+        self.filter_all_values()
+        plan = []
+        for node, (start, finish) in enumerate(node_ranges):
+            variants = 0
+            cohorts = 0
+            for i in range(start, finish, NODE_PLAN_BLOCK_SIZE):
+                testable, testable_cohorts = self.get_workload(
+                    i, min(i + NODE_PLAN_BLOCK_SIZE, finish), allow_missingness)
+                variants += int(testable.sum())
+                cohorts += int(testable_cohorts.sum())
+            plan.append({'node': node + 1, 'start': start, 'finish': finish,
+                         'variants': variants, 'variant_cohorts': cohorts})
+        return plan
+
     def get_all(self, name, nonempty=True):
         ind = self.genotype_names.index(name)
         indexes = self.values[:, ind]
@@ -851,10 +1126,181 @@ class Mapper(object):
         return indexes
 
     def load_filter_exclude(self, paths):
-        self.exclude = self.load_variant_filter_dataframes(paths, (("ID",), ("CHR", "bp")))
+        self.exclude_paths = paths
 
     def load_filter_include(self, paths):
-        self.include = self.load_variant_filter_dataframes(paths, (("ID",), ("CHR", "bp")))
+        self.include_paths = paths
+
+    def has_filters(self):
+        return any(variant_filter is not None for variant_filter in
+                   (self.include, self.exclude, self.include_paths, self.exclude_paths))
+
+    def get_key_order(self):
+        """
+        Returns the order that sorts the keys, to look up keys by binary
+        search. The order is persisted next to the mapper, and computed
+        when it is missing or older than the keys.
+        """
+        if self._key_order is not None:
+            return self._key_order
+        path = None if self.folder is None else get_key_order_path(self.folder, self.reference_name)
+        if path is not None and os.path.isfile(path):
+            key_order = np.load(path, mmap_mode='r')
+            keys_paths = glob.glob(os.path.join(self.folder, '*keys_' + self.reference_name + '.npy'))
+            if key_order.shape[0] == self.n_keys \
+                    and all(os.path.getmtime(path) >= os.path.getmtime(keys) for keys in keys_paths):
+                self._key_order = key_order
+                return key_order
+        print('Sorting {} mapper keys'.format(self.n_keys))
+        self._key_order = np.argsort(self.get_fixed_width_keys(), kind='mergesort')
+        if path is not None:
+            # Nodes share the mapper folder, so the order is written to a
+            # file of this process first, and renamed when it is complete.
+            temporary_path = '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+            try:
+                np.save(temporary_path, self._key_order)
+                os.rename(temporary_path, path)
+            except (IOError, OSError):
+                print('Could not save mapper key order to {}'.format(path))
+                if os.path.isfile(temporary_path):
+                    os.remove(temporary_path)
+        return self._key_order
+
+    def get_fixed_width_keys(self):
+        """
+        Returns the keys as fixed width strings, which numpy sorts and
+        searches without comparing Python objects.
+        """
+        if self.keys.dtype.kind in ('S', 'U'):
+            return self.keys
+        return self.keys.astype('S')
+
+    def get_key_indices(self, ids):
+        """
+        Looks up the reference indices of variant ids.
+
+        :param ids: array with variant ids
+        :return: int64 array with the reference index of every id, -1 for ids that are not in the mapper
+        """
+        ids = np.asarray(ids)
+        indices = np.full(ids.shape[0], -1, dtype=np.int64)
+        if ids.shape[0] == 0 or self.n_keys == 0:
+            return indices
+        key_order = self.get_key_order()
+        sorted_keys = self.get_sorted_keys()
+        # Longer ids can not match fixed width keys, and would be truncated
+        ids = ids.astype(sorted_keys.dtype.kind)
+        candidates = np.arange(ids.shape[0])
+        candidates = candidates[np.char.str_len(ids) <= sorted_keys.dtype.itemsize
+                                // np.dtype(sorted_keys.dtype.kind + '1').itemsize]
+        ids = ids[candidates].astype(sorted_keys.dtype)
+        # The sort is stable, so the last of duplicate keys is the last in
+        # the mapper, which is the one that a lookup by dictionary finds.
+        positions = np.searchsorted(sorted_keys, ids, side='right') - 1
+        found = sorted_keys[np.maximum(positions, 0)] == ids
+        found &= positions >= 0
+        indices[candidates[found]] = key_order[positions[found]]
+        return indices
+
+    def get_sorted_keys(self):
+        if self._sorted_keys is None:
+            self._sorted_keys = self.get_fixed_width_keys()[self.get_key_order()]
+        return self._sorted_keys
+
+    def get_filter_cache_path(self, start, finish):
+        """
+        Returns the path of the cached filtered values, keyed by the hashes
+        of the filter files, the mapper, the studies and the range of the
+        mapper.
+        """
+        if self.filter_cache is None or self.include is not None or self.exclude is not None:
+            return None
+        return os.path.join(self.filter_cache, 'filtered_values_{}.npy'.format(
+            self.get_cache_digest([int(start), int(finish)])))
+
+    def get_node_ranges_cache_path(self, nodes, allow_missingness):
+        if self.filter_cache is None or self.include is not None or self.exclude is not None:
+            return None
+        return os.path.join(self.filter_cache, 'node_ranges_{}.json'.format(
+            self.get_cache_digest(['node_ranges', self.balance, bool(allow_missingness), int(nodes)])))
+
+    def get_cache_digest(self, parameters):
+        """
+        Returns the SHA-1 of the mapper, the studies and the contents of
+        the filter files, with additional parameters of the cached data.
+        The mapper files are too large to hash, these are identified by
+        their size and modification time.
+        """
+        mapper_files = sorted(
+            glob.glob(os.path.join(self.folder, '*keys_' + self.reference_name + '.npy'))
+            + glob.glob(os.path.join(self.folder, '*values_' + self.reference_name + '*.npy')))
+        digest = hashlib.sha1()
+        digest.update(json.dumps([os.path.realpath(self.folder), self.reference_name, list(self.genotype_names),
+                                  int(self.n_keys)] + list(parameters)).encode('utf-8'))
+        digest.update(json.dumps([[os.path.basename(path), os.path.getsize(path), os.path.getmtime(path)]
+                                  for path in mapper_files]).encode('utf-8'))
+        for kind, paths in (('include', self.include_paths), ('exclude', self.exclude_paths)):
+            digest.update(json.dumps([kind, [hash_file(path) for path in paths or []]]).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_filter_indices(self, variant_filter):
+        """
+        Returns the reference indices of the variants in a filter table, and
+        the cohort of every variant, or None if the filter applies to all
+        cohorts.
+        """
+        if 'ID' not in variant_filter.columns:
+            raise ValueError('Variant filters should have an ID column, filtering on CHR and bp is not supported')
+        indices = self.get_key_indices(variant_filter.ID.values)
+        cohorts = None
+        if "cohort" in variant_filter.index.names:
+            cohorts = variant_filter.index.get_level_values("cohort").values[indices != -1]
+        return indices[indices != -1], cohorts
+
+    def filter_values(self):
+        """
+        Sets the values of the variants that are not included, or that are
+        excluded, to -1. Only the range of this node is filtered.
+
+        A single filter table applies to all cohorts. With several filter
+        tables, there is a table for every cohort.
+        """
+        if not self.has_filters():
+            return
+        start, finish = (0, self.n_keys) if self.key_range is None else self.key_range
+        values = self.values[start:finish]
+
+        cache_path = self.get_filter_cache_path(start, finish)
+        if cache_path is not None and os.path.isfile(cache_path):
+            print('Loading filtered mapper values from {}'.format(cache_path))
+            values[:] = np.load(cache_path, mmap_mode='r')
+            return
+
+        for kind, variant_filter, paths in (('include', self.include, self.include_paths),
+                                            ('exclude', self.exclude, self.exclude_paths)):
+            if variant_filter is None and paths is None:
+                continue
+            if variant_filter is None:
+                variant_filter = self.load_variant_filter_dataframes(paths, FILTER_COLUMN_SETS)
+            indices, cohorts = self.get_filter_indices(variant_filter)
+            print("Number of variants to {} that are in the mapper: {}".format(kind, indices.shape[0]))
+
+            in_range = (indices >= start) & (indices < finish)
+            for cohort in range(self.values.shape[1]):
+                selected = in_range if cohorts is None else in_range & (cohorts == cohort)
+                listed = np.zeros(finish - start, dtype=bool)
+                listed[indices[selected] - start] = True
+                values[listed if kind == 'exclude' else ~listed, cohort] = -1
+
+        if cache_path is not None:
+            try:
+                os.makedirs(self.filter_cache)
+            except OSError:
+                if not os.path.isdir(self.filter_cache):
+                    raise
+            temporary_path = '{}.{}.tmp.npy'.format(cache_path[:-len('.npy')], os.getpid())
+            np.save(temporary_path, np.asarray(values))
+            os.rename(temporary_path, cache_path)
 
     @staticmethod
     def load_variant_filter_dataframes(paths, column_sets=None):
@@ -1129,7 +1575,7 @@ def study_indexes(args=None,
 
 
 # @timing
-def merge_genotype(genotype, variant_indices, mapper, flip_flag=True):
+def merge_genotype(genotype, variant_indices, mapper, flip_flag=True, dtype=np.float64):
     if variant_indices is None:
         gen = genotype[0].get_next()
         if gen is not None:
@@ -1140,7 +1586,7 @@ def merge_genotype(genotype, variant_indices, mapper, flip_flag=True):
         if len(genotype) != len(variant_indices):
             raise ValueError('There are not equal number of genotypes and SNPs indexes {}!={}'.format(len(genotype),
                                                                                                       len(variant_indices)))
-        gen = np.zeros((len(variant_indices[0]), np.sum([i.folder._data.id.shape[0] for i in genotype])))
+        gen = np.zeros((len(variant_indices[0]), np.sum([i.folder._data.id.shape[0] for i in genotype])), dtype=dtype)
         a = 0
         b = 0
         for i in range(0, len(genotype)):
@@ -0,0 +1,49 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hdgwas.data import ChunkCache
+
+
+class ChunkCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_caches_share_scratch_folder(self):
+        # Two cohorts, or workers, with the same chunk bounds
+        caches = [ChunkCache(100, scratch=self.folder) for _ in range(2)]
+        for i, cache in enumerate(caches):
+            cache.put((0, 10), np.full(10, i, dtype=np.float64), 'first')
+            cache.put((10, 20), np.full(10, i + 10, dtype=np.float64), 'second')
+        self.assertEqual(len(os.listdir(self.folder)), 2)
+        for i, cache in enumerate(caches):
+            array, value = cache.get((0, 10))
+            np.testing.assert_array_equal(array, i)
+            self.assertEqual(value, 'first')
+            self.assertEqual(cache.get((10, 20))[0][0], i + 10)
+
+        caches[0].close()
+        self.assertEqual(len(os.listdir(self.folder)), 1)
+        self.assertEqual(caches[1].get((0, 10))[0][0], 1)
+        caches[1].close()
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_replaced_entry_removes_spill_file(self):
+        cache = ChunkCache(0, scratch=self.folder)
+        cache.put((0, 10), np.zeros(10))
+        cache.put((0, 10), np.ones(10))
+        self.assertEqual(len(os.listdir(self.folder)), 1)
+        np.testing.assert_array_equal(cache.get((0, 10))[0], 1)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hdgwas.hdregression import hase_fused, get_a_extended, get_a_inverse_extended, invert_a_covariates, \
+    covariate_residual_sum_of_squares
+
+
+class HaseFusedPrecisionTest(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        n_samples, n_variants, n_phenotypes = 2000, 50, 40
+        # Two nearly collinear covariates, with which the genotypes and
+        # phenotypes are strongly correlated
+        covariate = random.normal(size=n_samples)
+        covariates = np.column_stack([np.ones(n_samples), covariate,
+                                      covariate + 1e-2 * random.normal(size=n_samples)])
+        genotype = random.binomial(2, 0.3, size=(n_samples, n_variants)) + 9 * covariate[:, np.newaxis]
+        phenotype = 3 + 10 * covariate[:, np.newaxis] + random.normal(size=(n_samples, n_phenotypes))
+
+        a_covariates = covariates.T.dot(covariates)
+        self.b_cov = covariates.T.dot(phenotype)
+        self.covariate_rss = covariate_residual_sum_of_squares(
+            a_covariates, self.b_cov, np.sum(phenotype ** 2, axis=0), invert_a_covariates(a_covariates))
+        self.a_inverse = get_a_inverse_extended(
+            a_covariates, np.column_stack([covariates.T.dot(genotype).T, np.sum(genotype ** 2, axis=0)]),
+            variable_rows_only=True)[0]
+        self.b4 = genotype.T.dot(phenotype)[np.newaxis]
+        self.degrees_of_freedom = n_samples - covariates.shape[1] - 1
+
+        self.reference = np.array([
+            np.linalg.lstsq(np.column_stack([covariates, genotype[:, i]]), phenotype, rcond=None)[0][-1]
+            for i in range(n_variants)])
+
+    def hase_fused(self, dtype):
+        t_stat, standard_error = hase_fused(
+            self.b4.astype(dtype), self.a_inverse, self.b_cov, self.covariate_rss, self.degrees_of_freedom,
+            max_block_bytes=64 * 1024)
+        return t_stat[:, 0, :] * standard_error[:, 0, :], standard_error[:, 0, :]
+
+    def test_float64(self):
+        beta, standard_error = self.hase_fused(np.float64)
+        self.assertLess(np.max(np.abs(beta - self.reference) / standard_error), 1e-6)
+
+    def test_float32(self):
+        beta, standard_error = self.hase_fused(np.float32)
+        expected_beta, expected_standard_error = self.hase_fused(np.float64)
+        self.assertEqual(beta.dtype, np.float64)
+        self.assertLess(np.max(np.abs(beta - expected_beta) / expected_standard_error), 1e-3)
+        self.assertLess(np.max(np.abs(standard_error / expected_standard_error - 1)), 1e-6)
+
+
+class AExtendedTest(unittest.TestCase):
+
+    def test_matches_design_matrix(self):
+        random = np.random.RandomState(1)
+        covariates = np.column_stack([np.ones(100), random.normal(size=(100, 2))])
+        genotype = random.binomial(2, 0.3, size=(100, 5)).astype(float)
+        # The last variant is constant, so its A matrix is singular
+        genotype[:, -1] = 1
+        a_covariates = covariates.T.dot(covariates)
+        a_test = np.column_stack([covariates.T.dot(genotype).T, np.sum(genotype ** 2, axis=0)])
+
+        a_complete = get_a_extended(a_covariates, a_test)
+        for i in range(genotype.shape[1]):
+            design = np.column_stack([covariates, genotype[:, i]])
+            np.testing.assert_allclose(a_complete[i], design.T.dot(design))
+        a_invertible = get_a_inverse_extended(a_covariates, a_test, variable_rows_only=True)[1]
+        np.testing.assert_array_equal(a_invertible, [True] * 4 + [False])
+
+
+if __name__ == '__main__':
+    unittest.main()
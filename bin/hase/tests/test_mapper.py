@@ -0,0 +1,70 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hdgwas.tools import Mapper
+
+
+class KeyIndicesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mapper = Mapper()
+        self.mapper.keys = np.array(['rs3', 'rs1', 'rs2', 'rs1', 'rs10', 'rs2'], dtype=object)
+        self.mapper.n_keys = self.mapper.keys.shape[0]
+
+    def test_matches_dictionary_lookup(self):
+        ids = np.array(['rs1', 'rs2', 'rs3', 'rs10', 'rs4', 'rs', 'rs100000', ''], dtype=object)
+        key_index_dictionary = dict(zip(self.mapper.keys, range(self.mapper.n_keys)))
+        np.testing.assert_array_equal(
+            self.mapper.get_key_indices(ids),
+            [key_index_dictionary.get(variant_id, -1) for variant_id in ids])
+
+    def test_no_keys(self):
+        self.mapper.keys = np.array([], dtype=object)
+        self.mapper.n_keys = 0
+        np.testing.assert_array_equal(self.mapper.get_key_indices(np.array(['rs1'])), [-1])
+
+
+
+class MapperFolderTest(unittest.TestCase):
+
+    def setUp(self):
+        # Mapper folders are given with a trailing separator
+        self.folder = tempfile.mkdtemp() + os.sep
+        self.addCleanup(shutil.rmtree, self.folder)
+        keys = np.array(['rs{}'.format(i) for i in range(20)])
+        np.save(os.path.join(self.folder, 'keys_test.npy'), keys)
+        np.save(os.path.join(self.folder, 'values_test_A.npy'), np.arange(20))
+        np.save(os.path.join(self.folder, 'flip_test_A.npy'), np.ones(20, dtype=np.int8))
+        filter_path = os.path.join(self.folder, 'include.csv')
+        with open(filter_path, 'w') as filter_file:
+            filter_file.write('ID\nrs3\nrs11\nrs2\n')
+
+        self.mapper = Mapper()
+        self.mapper.genotype_names = ['A']
+        self.mapper.reference_name = 'test'
+        self.mapper.load_filter_include([filter_path])
+
+    def test_filters_without_reference_index(self):
+        # There is no reference index in the test environment
+        self.mapper.load(self.folder)
+        self.mapper.filter_values()
+        self.assertEqual(list(np.nonzero(self.mapper.values[:, 0] != -1)[0]), [2, 3, 11])
+
+    def test_key_order_is_renamed_into_place(self):
+        self.mapper.load(self.folder)
+        key_order = self.mapper.get_key_order()
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         ['flip_test_A.npy', 'include.csv', 'key_order_test.npy', 'keys_test.npy',
+                          'values_test_A.npy'])
+        np.testing.assert_array_equal(np.load(os.path.join(self.folder, 'key_order_test.npy')), key_order)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hdgwas.meta_classic import InverseVarianceAccumulator, SufficientStatisticsStore, STATISTICS_COLUMNS
+
+
+def two_pass_meta_analysis(effect_sizes, standard_error):
+    """
+    Meta-analysis of stacked (cohorts, variants, phenotypes) results, with
+    Cochran's Q calculated from the deviations of the meta-analysed effect
+    size, as the classic meta-analysis did before the accumulator.
+    """
+    one_divided_by_variance = 1 / standard_error ** 2
+    meta_analysed_effect_sizes = (
+        np.nansum(effect_sizes * one_divided_by_variance, axis=0)
+        / np.nansum(one_divided_by_variance, axis=0))
+    effect_size_deviations_from_mean = np.power(
+        effect_sizes - meta_analysed_effect_sizes, 2)
+    effect_size_deviations = np.nansum(
+        one_divided_by_variance * effect_size_deviations_from_mean, axis=0)
+    degrees_of_freedom = np.sum(~np.isnan(effect_size_deviations_from_mean), axis=0) - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        i_squared = (effect_size_deviations - degrees_of_freedom) / effect_size_deviations * 100
+    # A single cohort deviates from itself by rounding errors only, which
+    # gives an I2 of either NaN or 100
+    i_squared[degrees_of_freedom == 0] = np.nan
+    return meta_analysed_effect_sizes, i_squared
+
+
+class InverseVarianceAccumulatorTest(unittest.TestCase):
+
+    def accumulate(self, effect_sizes, standard_error):
+        accumulator = InverseVarianceAccumulator(effect_sizes.shape[1:])
+        for cohort in range(effect_sizes.shape[0]):
+            accumulator.add(effect_sizes[cohort], standard_error[cohort],
+                            np.ones(effect_sizes.shape[1:]))
+        return accumulator
+
+    def assert_i_squared_equal(self, effect_sizes, standard_error):
+        expected_effect_sizes, expected_i_squared = two_pass_meta_analysis(
+            effect_sizes, standard_error)
+        observed, actual_effect_sizes, _, actual_i_squared, _ = \
+            self.accumulate(effect_sizes, standard_error).get_results()
+        self.assertTrue(np.all(observed))
+        np.testing.assert_allclose(actual_effect_sizes, expected_effect_sizes.ravel(), rtol=1e-12)
+        np.testing.assert_allclose(actual_i_squared, expected_i_squared.ravel(), rtol=1e-6)
+
+    def test_single_cohort(self):
+        random = np.random.RandomState(1)
+        effect_sizes = random.normal(size=(1, 20, 3))
+        standard_error = random.uniform(0.01, 0.1, size=(1, 20, 3))
+        self.assert_i_squared_equal(effect_sizes, standard_error)
+        self.assertTrue(np.all(np.isnan(self.accumulate(effect_sizes, standard_error).get_results()[3])))
+
+    def test_near_identical_cohorts(self):
+        random = np.random.RandomState(2)
+        effect_sizes = random.normal(10, 1, size=(1, 20, 3)) + random.normal(0, 1e-6, size=(4, 20, 3))
+        standard_error = random.uniform(1e-4, 1e-3, size=(4, 20, 3))
+        self.assert_i_squared_equal(effect_sizes, standard_error)
+
+    def test_missing_cohorts(self):
+        random = np.random.RandomState(3)
+        effect_sizes = random.normal(size=(3, 20, 3))
+        effect_sizes[0, :5] = np.nan
+        effect_sizes[1:, 5:10] = np.nan
+        standard_error = random.uniform(0.01, 0.1, size=(3, 20, 3))
+        standard_error[np.isnan(effect_sizes)] = np.nan
+        self.assert_i_squared_equal(effect_sizes, standard_error)
+
+    def test_statistics(self):
+        random = np.random.RandomState(4)
+        effect_sizes = random.normal(1, 1e-3, size=(4, 20, 3))
+        standard_error = random.uniform(0.01, 0.1, size=(4, 20, 3))
+        expected = self.accumulate(effect_sizes, standard_error).get_results()
+
+        # Statistics of the first two cohorts merged with the others
+        observed, statistics = self.accumulate(effect_sizes[:2], standard_error[:2]).get_statistics()
+        accumulator = self.accumulate(effect_sizes[2:], standard_error[2:])
+        accumulator.add_statistics(np.nonzero(observed)[0], np.nonzero(observed)[1], statistics)
+        for expected_values, actual_values in zip(expected[1:], accumulator.get_results()[1:]):
+            np.testing.assert_allclose(actual_values, expected_values, rtol=1e-6)
+
+
+    def test_without(self):
+        random = np.random.RandomState(5)
+        effect_sizes = random.normal(size=(4, 20, 3))
+        effect_sizes[0, :5] = np.nan
+        # Associations of which the left out cohort is the only, or one of two
+        effect_sizes[1:, 5:8] = np.nan
+        effect_sizes[2:, 8:10] = np.nan
+        standard_error = random.uniform(0.01, 0.1, size=(4, 20, 3))
+        standard_error[np.isnan(effect_sizes)] = np.nan
+        sample_sizes = np.where(np.isnan(effect_sizes), 0, 100.0)
+        accumulator = InverseVarianceAccumulator(effect_sizes.shape[1:])
+        for cohort in range(effect_sizes.shape[0]):
+            accumulator.add(effect_sizes[cohort], standard_error[cohort], sample_sizes[cohort])
+
+        for left_out in range(effect_sizes.shape[0]):
+            others = [cohort for cohort in range(effect_sizes.shape[0]) if cohort != left_out]
+            expected = InverseVarianceAccumulator(effect_sizes.shape[1:])
+            for cohort in others:
+                expected.add(effect_sizes[cohort], standard_error[cohort], sample_sizes[cohort])
+            expected = expected.get_results()
+            actual = accumulator.without(
+                effect_sizes[left_out], standard_error[left_out], sample_sizes[left_out]).get_results()
+            np.testing.assert_array_equal(actual[0], expected[0])
+            for expected_values, actual_values in zip(expected[1:], actual[1:]):
+                np.testing.assert_allclose(actual_values, expected_values, rtol=1e-8, atol=1e-10)
+
+
+
+class SufficientStatisticsStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_update_with_duplicate_variant_names(self):
+        random = np.random.RandomState(6)
+        effect_sizes = random.normal(size=(4, 6, 2))
+        standard_error = random.uniform(0.01, 0.1, size=(4, 6, 2))
+        sample_sizes = np.full(effect_sizes.shape, 100.0)
+        # The second and fifth variant have the same name in the reference
+        variant_names = np.array(['rs1', 'rs2', 'rs3', 'rs4', 'rs2', 'rs5'], dtype=object)
+        reference_indices = np.arange(10, 16)
+        phenotype_names = np.array(['a', 'b'], dtype=object)
+
+        def accumulate(cohorts):
+            accumulator = InverseVarianceAccumulator(effect_sizes.shape[1:])
+            for cohort in cohorts:
+                accumulator.add(effect_sizes[cohort], standard_error[cohort], sample_sizes[cohort])
+            return accumulator
+
+        # Store the statistics of the first two cohorts
+        observed, statistics = accumulate([0, 1]).get_statistics()
+        variant_index, phenotype_index = np.nonzero(observed)
+        stored = pd.DataFrame(dict(zip(STATISTICS_COLUMNS, statistics)), columns=STATISTICS_COLUMNS)
+        stored.insert(0, "variant", variant_names[variant_index])
+        stored.insert(1, "variant_index", reference_indices[variant_index])
+        stored.insert(2, "phenotype", phenotype_names[phenotype_index])
+        os.makedirs(os.path.join(self.folder, SufficientStatisticsStore.folder))
+        stored.to_parquet(SufficientStatisticsStore.get_path(self.folder, (10, 16), 0))
+
+        # Update with the other cohorts, in a tile with the variants in a different order
+        order = np.array([5, 4, 3, 2, 1, 0])
+        update = InverseVarianceAccumulator(effect_sizes.shape[1:])
+        for cohort in [2, 3]:
+            update.add(effect_sizes[cohort][order], standard_error[cohort][order], sample_sizes[cohort][order])
+        chunk_statistics = SufficientStatisticsStore(
+            [os.path.join(self.folder, SufficientStatisticsStore.folder)]).load((10, 16), reference_indices[order])
+        chunk_statistics.add_to(update, phenotype_names)
+        self.assertEqual(chunk_statistics.get_unused().shape[0], 0)
+
+        expected = accumulate([0, 1, 2, 3]).get_results()
+        actual = update.get_results()
+        for expected_values, actual_values in zip(expected[1:], actual[1:]):
+            np.testing.assert_allclose(
+                actual_values.reshape(6, 2)[np.argsort(order)],
+                expected_values.reshape(6, 2), rtol=1e-8)
+
+
+if __name__ == '__main__':
+    unittest.main()
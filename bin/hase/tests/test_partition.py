@@ -0,0 +1,81 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import partition
+
+
+def read_dataset(path):
+    results = pq.ParquetDataset(path).read().to_pandas()
+    results = results[partition.PYARROW_SCHEMA.names]
+    results["phenotype"] = results["phenotype"].astype(str)
+    return results.sort_values(partition.SORT_COLUMNS).reset_index(drop=True)
+
+
+def glob_phenotypes(out):
+    return [os.path.join(out, folder, name)
+            for folder in os.listdir(out)
+            for name in os.listdir(os.path.join(out, folder))]
+
+
+class PartitionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        random = np.random.RandomState(0)
+        self.paths = []
+        for part in range(2):
+            n = 5000
+            results = pd.DataFrame({
+                "variant": np.array(['rs{}'.format(i) for i in random.permutation(n)], dtype=object),
+                "phenotype": np.array(['ENSG{:05d}'.format(i) for i in random.randint(0, 40, n)], dtype=object),
+                "beta": random.normal(size=n),
+                "standard_error": random.uniform(size=n),
+                "i_squared": random.uniform(size=n),
+                "sample_size": np.full(n, 100.0)}, columns=partition.PYARROW_SCHEMA.names)
+            path = os.path.join(self.folder, '{}_result.parquet'.format(part))
+            pq.write_table(pa.Table.from_pandas(results, partition.PYARROW_SCHEMA, preserve_index=False),
+                           path, row_group_size=700)
+            self.paths.append(path)
+
+    def write_dataset(self):
+        """
+        Writes the dataset as partition.py did before it streamed the results.
+        """
+        out = os.path.join(self.folder, 'expected')
+        results = pd.concat([pq.read_table(path).to_pandas() for path in self.paths])
+        pq.write_to_dataset(pa.Table.from_pandas(results, partition.PYARROW_SCHEMA),
+                            root_path=out, partition_cols=["phenotype"])
+        return out
+
+    def partition(self, *args):
+        out = os.path.join(self.folder, 'out')
+        self.assertEqual(partition.main(['--path'] + self.paths + ['--out', out] + list(args)), 0)
+        return out
+
+    def test_in_memory(self):
+        pd.testing.assert_frame_equal(read_dataset(self.partition('--buckets', '3')),
+                                      read_dataset(self.write_dataset()))
+
+    def test_spilled(self):
+        out = self.partition('--memory', '0', '--buckets', '4', '--threads', '2', '--row-group-rows', '50')
+        pd.testing.assert_frame_equal(read_dataset(out), read_dataset(self.write_dataset()))
+        self.assertFalse(os.path.exists(os.path.join(out, partition.STATE_FOLDER)))
+        # The results of every phenotype are sorted by variant
+        for phenotype_path in glob_phenotypes(out):
+            variants = pq.read_table(phenotype_path).column(0).to_pandas().values
+            self.assertTrue(np.all(variants[:-1] <= variants[1:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
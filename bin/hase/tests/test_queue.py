@@ -0,0 +1,130 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hdgwas.scheduler import ChunkQueue
+from hdgwas.tools import Mapper
+
+
+def make_mapper(queue, n_keys=120, chunk_size=10):
+    """
+    Mapper with two studies, in which only every third variant is
+    present in both, so that every chunk has less testable variants than
+    the chunk size.
+    """
+    mapper = Mapper()
+    mapper.chunk_size = chunk_size
+    mapper.n_keys = n_keys
+    mapper.n_study = 2
+    mapper.keys = np.array(['rs{}'.format(i) for i in range(n_keys)])
+    mapper.values = np.tile(np.arange(n_keys)[:, np.newaxis], (1, 2))
+    mapper.values[np.arange(n_keys) % 3 != 0, 1] = -1
+    mapper.queue = queue
+    return mapper
+
+
+class ChunkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def get_chunks(self, mapper):
+        chunk = mapper.chunk_pop()
+        if chunk is None:
+            return None
+        mapper.get(chunk_number=chunk)
+        return mapper.chunk_range, mapper.chunk_key_indices
+
+    def test_workers_do_not_analyse_tasks_of_others(self):
+        workers = []
+        for name in ('a', 'b'):
+            queue = ChunkQueue(self.folder, worker=name)
+            self.addCleanup(queue.close)
+            mapper = make_mapper(queue)
+            queue.create(mapper.get_queue_tasks(1))
+            workers.append((queue, mapper))
+
+        analysed = {'a': [], 'b': []}
+        active = list(workers)
+        while len(active) != 0:
+            # The workers claim tasks in turns, so that the tasks of a
+            # worker do not follow on from each other
+            for queue, mapper in list(active):
+                result = self.get_chunks(mapper)
+                if result is None:
+                    active.remove((queue, mapper))
+                    continue
+                chunk_range, key_indices = result
+                task = queue.tasks[queue.get_task(chunk_range)]
+                self.assertTrue(task[0] <= chunk_range[0] and chunk_range[1] <= task[1])
+                self.assertTrue(np.all((key_indices >= task[0]) & (key_indices < task[1])))
+                analysed[queue.worker].extend(key_indices)
+            for queue, mapper in workers:
+                queue.finish(queue.pop_completed())
+
+        self.assertEqual(len(np.intersect1d(analysed['a'], analysed['b'])), 0)
+        self.assertEqual(sorted(analysed['a'] + analysed['b']), list(range(0, 120, 3)))
+
+    def test_lost_task_does_not_affect_other_tasks(self):
+        queue = ChunkQueue(self.folder, timeout=1, worker='a')
+        self.addCleanup(queue.close)
+        queue.create([(0, 10), (10, 20), (20, 30)])
+        for task in range(3):
+            queue.claim()
+        self.assertEqual(queue.pop_completed(2), [0, 1])
+        # Another worker takes over the second task
+        with open(queue.get_claim_path(1, 1), 'w') as claim_file:
+            claim_file.write('b')
+        self.assertEqual(queue.get_lost_tasks([0]), [])
+        self.assertEqual(queue.get_lost_tasks([1]), [1])
+        queue.finish([0])
+        queue.release([1])
+        self.assertEqual(queue.pop_completed(), [2])
+        queue.finish([2])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'done'))), ['0', '2'])
+
+
+    def test_claim_taken_over_after_lost_task_check(self):
+        queues = {}
+        for name in ('a', 'b'):
+            queues[name] = ChunkQueue(self.folder, worker=name)
+            self.addCleanup(queues[name].close)
+            queues[name].create([(0, 10), (10, 20)])
+        self.assertEqual(queues['a'].claim(), (0, 10))
+        self.assertEqual(queues['a'].pop_completed(), [0])
+        self.assertEqual(queues['a'].get_lost_tasks([0]), [])
+
+        # The heartbeat of a stops, b takes over the task and completes it
+        # before a marks it done
+        os.utime(os.path.join(self.folder, 'workers', 'a'), (0, 0))
+        self.assertEqual(queues['b'].claim(), (0, 10))
+        self.assertTrue(queues['b'].finish([0]))
+
+        self.assertFalse(queues['a'].finish([0]))
+        with open(os.path.join(self.folder, 'done', '0')) as done_file:
+            self.assertEqual(done_file.read(), 'b')
+        queues['a'].release([0])
+        self.assertEqual(queues['a'].finished, 0)
+
+    def test_tasks_are_marked_done_together(self):
+        queue = ChunkQueue(self.folder, worker='a')
+        self.addCleanup(queue.close)
+        queue.create([(0, 10), (10, 20)])
+        queue.claim()
+        queue.claim()
+        # Another worker marked the second task done
+        with open(os.path.join(self.folder, 'done', '1'), 'w') as done_file:
+            done_file.write('b')
+        self.assertFalse(queue.finish([0, 1]))
+        self.assertEqual(os.listdir(os.path.join(self.folder, 'done')), ['1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
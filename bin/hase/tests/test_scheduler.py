@@ -0,0 +1,61 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hdgwas.scheduler import TileScheduler
+
+
+class PhenotypeChunks(object):
+    """
+    Phenotype chunks that can be iterated repeatedly, counting the chunks
+    that are read.
+    """
+
+    def __init__(self, n_chunks):
+        self.n_chunks = n_chunks
+        self.read = 0
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        for chunk in range(self.n_chunks):
+            with self.lock:
+                self.read += 1
+            yield chunk
+
+
+class TileSchedulerTest(unittest.TestCase):
+
+    def analyse(self, n_genotype_chunks, depth, stop_after=None):
+        phenotype_chunks = PhenotypeChunks(4)
+        scheduler = TileScheduler(iter(range(n_genotype_chunks)), phenotype_chunks, depth=depth)
+        tiles = []
+        try:
+            for genotype_chunk, phenotype_pass in scheduler:
+                tiles.extend((genotype_chunk, phenotype_chunk) for phenotype_chunk in phenotype_pass)
+                if genotype_chunk == stop_after:
+                    break
+        finally:
+            scheduler.close()
+        return tiles, phenotype_chunks.read
+
+    def test_reads_no_pass_beyond_the_last(self):
+        for depth in (0, 1, 3):
+            tiles, read = self.analyse(3, depth)
+            self.assertEqual(tiles, [(g, p) for g in range(3) for p in range(4)])
+            self.assertEqual(read, 12)
+
+    def test_no_genotype_chunks(self):
+        self.assertEqual(self.analyse(0, 1), ([], 0))
+
+    def test_stops_when_closed(self):
+        tiles, read = self.analyse(10, 2, stop_after=1)
+        self.assertEqual(len(tiles), 8)
+        # The passes of prefetched genotype chunks can have been started
+        self.assertTrue(read <= 4 * 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
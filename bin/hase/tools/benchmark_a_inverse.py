@@ -0,0 +1,74 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import basedir, PYTHON_PATH
+os.environ['HASEDIR']=basedir
+if PYTHON_PATH is not None:
+	for i in PYTHON_PATH: sys.path.insert(0,i)
+import argparse
+import numpy as np
+from hdgwas.tools import Timer
+from hdgwas.hdregression import A_covariates, A_tests, get_a_inverse_extended
+
+
+def determinant_inverse(a_covariates, variant_dependent_a):
+	"""
+	Previous implementation of get_a_inverse_extended: a determinant check
+	followed by a full inversion of every A matrix.
+	"""
+	n = a_covariates.shape[0]
+	k = n + variant_dependent_a.shape[2]
+	a_complete = np.zeros((variant_dependent_a.shape[0], k, k))
+	a_complete[..., 0:n, 0:n] = a_covariates
+	a_complete[..., :, n:k] = variant_dependent_a
+	a_complete = np.triu(a_complete) + np.triu(a_complete, 1).transpose((0, 2, 1))
+	a_invertible = np.linalg.det(a_complete) != 0
+	a_complete[a_invertible] = np.linalg.inv(a_complete[a_invertible])
+	return a_complete, a_invertible
+
+
+def simulate(n_samples, n_variants, n_covariates, seed=0):
+	random = np.random.RandomState(seed)
+	covariates = random.normal(size=(n_samples, n_covariates))
+	genotype = random.binomial(2, 0.3, size=(n_variants, n_samples)).astype(np.float64)
+	return A_covariates(covariates), A_tests(covariates, genotype)[:, :, np.newaxis]
+
+
+def main(argv=None):
+	if argv is None:
+		argv=sys.argv[1:]
+
+	parser = argparse.ArgumentParser(description='Benchmark inversion of the A matrices of a variant chunk')
+	parser.add_argument('-samples', type=int, default=1000, help='number of samples')
+	parser.add_argument('-variants', type=int, default=5000, help='number of variants in the chunk')
+	parser.add_argument('-covariates', type=int, nargs='+', default=[5, 10, 15, 20, 25, 30],
+						help='numbers of covariates (k) to benchmark')
+	parser.add_argument('-repeats', type=int, default=3, help='number of repeats per k')
+	args = parser.parse_args(argv)
+	print(args)
+
+	methods = [('determinant', determinant_inverse),
+			   ('blockwise', get_a_inverse_extended),
+			   ('blockwise_rows', lambda a, b: get_a_inverse_extended(a, b, variable_rows_only=True))]
+
+	print('covariates\t' + '\t'.join(name for name, _ in methods) + '\tmax_relative_difference')
+	for n_covariates in args.covariates:
+		a_covariates, a_tests = simulate(args.samples, args.variants, n_covariates)
+		seconds = []
+		results = []
+		for name, method in methods:
+			timings = []
+			for _ in range(args.repeats):
+				with Timer() as t:
+					result = method(a_covariates, a_tests)
+				timings.append(t.secs)
+			seconds.append(np.min(timings))
+			results.append(result)
+		reference, blockwise = results[0][0], results[1][0]
+		difference = np.max(np.abs(blockwise - reference)) / np.max(np.abs(reference))
+		print('{}\t'.format(n_covariates + 1) + '\t'.join('{:.4f}'.format(s) for s in seconds)
+			  + '\t{:.2e}'.format(difference))
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,106 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import basedir, PYTHON_PATH
+os.environ['HASEDIR']=basedir
+if PYTHON_PATH is not None:
+	for i in PYTHON_PATH: sys.path.insert(0,i)
+import argparse
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from hdgwas.tools import Timer
+from hdgwas.hdregression import A_covariates, A_tests, B_covariates, C_matrix
+from hdgwas.meta_classic import CohortAnalyser
+
+
+def simulate_cohorts(n_cohorts, n_samples, n_variants, n_phenotypes, n_covariates, seed=0):
+	"""
+	Simulates genotype and phenotype chunks for a number of cohorts, together with
+	the partial derivatives of every cohort, and returns initialized CohortAnalysers.
+	"""
+	random = np.random.RandomState(seed)
+	genotype = random.binomial(2, 0.3, size=(n_variants, n_cohorts * n_samples)).astype(np.float64)
+	phenotype = random.normal(size=(n_cohorts * n_samples, n_phenotypes))
+	phenotype_names = np.array(['phenotype_{}'.format(i) for i in range(n_phenotypes)])
+	variant_names = np.array(['variant_{}'.format(i) for i in range(n_variants)])
+
+	cohorts = []
+	for study_index in range(n_cohorts):
+		samples = np.arange(study_index * n_samples, (study_index + 1) * n_samples)
+		covariates = random.normal(size=(n_samples, n_covariates))
+		cohort = CohortAnalyser(study_index, 'cohort_{}'.format(study_index),
+								{'genotype': samples, 'phenotype': samples}, n_samples)
+		cohort.set_partial_derivatives(
+			A_tests(covariates, genotype[:, samples])[:, :, np.newaxis],
+			B_covariates(covariates, phenotype[samples]),
+			C_matrix(phenotype[samples]),
+			A_covariates(covariates))
+		cohort.set_partial_derivatives_phenotype_index({k: i for i, k in enumerate(phenotype_names)})
+		cohort.set_variant_names(variant_names)
+		cohort.set_observed_maf(np.full(n_variants, 0.3))
+		cohort.set_variant_indices(np.arange(n_variants))
+		cohort.finalize_partial_derivatives()
+		cohort.set_phenotype_names(phenotype_names)
+		cohort.set_phenotype_indices(np.arange(n_phenotypes))
+		cohorts.append(cohort)
+	return cohorts, genotype, phenotype
+
+
+def _identical(a, b):
+	return ((a == b) | (np.isnan(a) & np.isnan(b))).all()
+
+
+def analyse(cohorts, genotype, phenotype, threads):
+	def analyse_cohort(cohort):
+		cohort.analyse(genotype, phenotype)
+		return cohort.analyser.t_stat.copy(), cohort.analyser.standard_error.copy()
+
+	if threads == 1:
+		return [analyse_cohort(cohort) for cohort in cohorts]
+	pool = ThreadPool(threads)
+	try:
+		return pool.map(analyse_cohort, cohorts)
+	finally:
+		pool.close()
+		pool.join()
+
+
+def main(argv=None):
+	if argv is None:
+		argv=sys.argv[1:]
+
+	parser = argparse.ArgumentParser(description='Benchmark cohort-parallel classic meta-analysis')
+	parser.add_argument('-cohorts', type=int, default=40, help='number of cohorts')
+	parser.add_argument('-samples', type=int, default=500, help='number of samples per cohort')
+	parser.add_argument('-variants', type=int, default=500, help='number of variants in the genotype chunk')
+	parser.add_argument('-phenotypes', type=int, default=5000, help='number of phenotypes in the phenotype chunk')
+	parser.add_argument('-covariates', type=int, default=20, help='number of covariates per cohort')
+	parser.add_argument('-threads', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+						help='thread counts to benchmark')
+	parser.add_argument('-repeats', type=int, default=3, help='number of repeats per thread count')
+	args = parser.parse_args(argv)
+	print(args)
+
+	cohorts, genotype, phenotype = simulate_cohorts(
+		args.cohorts, args.samples, args.variants, args.phenotypes, args.covariates)
+
+	serial = analyse(cohorts, genotype, phenotype, 1)
+	baseline = None
+
+	print('threads\tseconds\tspeedup\tidentical')
+	for threads in args.threads:
+		timings = []
+		for _ in range(args.repeats):
+			with Timer() as t:
+				results = analyse(cohorts, genotype, phenotype, threads)
+			timings.append(t.secs)
+		identical = all(_identical(a[0], b[0]) and _identical(a[1], b[1])
+						for a, b in zip(serial, results))
+		seconds = np.min(timings)
+		if baseline is None:
+			baseline = seconds
+		print('{}\t{:.3f}\t{:.2f}\t{}'.format(threads, seconds, baseline / seconds, identical))
+
+
+if __name__ == '__main__':
+	sys.exit(main())
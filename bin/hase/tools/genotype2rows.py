@@ -0,0 +1,27 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import PYTHON_PATH
+if PYTHON_PATH is not None:
+	for i in PYTHON_PATH: sys.path.insert(0,i)
+import argparse
+from hdgwas.tools import Timer
+from hdgwas.data import RowStore
+
+
+if __name__=='__main__':
+
+	parser = argparse.ArgumentParser(description='Script to convert the genotype/*.h5 files of converted genotype data '
+												 'to a row-addressable store, from which HASE reads only the requested variants')
+	parser.add_argument("-g", "--genotype",nargs='+', type=str, required=True, help="path/paths to genotype data folder")
+	parser.add_argument('-study_name', type=str, required=True,nargs='+', help=' Name for saved genotype data, without ext')
+	args = parser.parse_args()
+	print args
+
+	if len(args.genotype)!=len(args.study_name):
+		raise ValueError('Number of genotype folders and study names should be equal')
+
+	for path, name in zip(args.genotype, args.study_name):
+		with Timer() as t:
+			RowStore.convert(path, name)
+		print ('Time to convert {} is {} s'.format(path, t.secs))
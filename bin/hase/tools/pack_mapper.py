@@ -0,0 +1,32 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import *
+if PYTHON_PATH is not None:
+	for i in PYTHON_PATH: sys.path.insert(0,i)
+import argparse
+from hdgwas.tools import pack_mapper, Timer
+
+
+def main(argv=None):
+	if argv is None:
+		argv=sys.argv[1:]
+
+	parser = argparse.ArgumentParser(description='Script to pack a mapper folder into memory-mappable files. '
+												 'The mapper is loaded from the packed files when these contain all studies of an analysis.')
+	parser.add_argument("-mapper", required=True, type=str, help="path to mapper folder")
+	parser.add_argument('-ref_name', type=str, default='1000Gp1v3_ref', help='Reference panel name')
+	parser.add_argument('-study_name', type=str, nargs='+', default=None, help='Study names to pack, by default all studies in the mapper folder')
+	parser.add_argument("-o", "--out", type=str, default=None, help="path to save the packed mapper, by default the mapper folder")
+	args = parser.parse_args(argv)
+
+	if args.out is not None and not os.path.isdir(args.out):
+		os.makedirs(args.out)
+
+	with Timer() as t:
+		path = pack_mapper(args.mapper, args.ref_name, study_names=args.study_name, out=args.out)
+	print('Packed mapper saved to {} in {}s'.format(path, t.secs))
+
+
+if __name__=='__main__':
+	sys.exit(main())
@@ -0,0 +1,89 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import basedir, PYTHON_PATH
+os.environ['HASEDIR']=basedir
+if PYTHON_PATH is not None:
+	for i in PYTHON_PATH: sys.path.insert(0,i)
+import argparse
+import glob
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ['beta', 'standard_error']
+
+
+def read_results(folder):
+	"""
+	Reads all parquet result files of a classic meta-analysis run into one data frame.
+	"""
+	files = sorted(glob.glob(os.path.join(folder, '*.parquet')))
+	if len(files) == 0:
+		raise ValueError('There are no parquet files in {}'.format(folder))
+	results = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+	results.columns = [c.decode() if isinstance(c, bytes) else c for c in results.columns]
+	return results
+
+
+def compare(reference, test, columns=COLUMNS):
+	"""
+	Matches the results on variant and phenotype and returns for every column
+	the maximum absolute and relative difference of the test run to the reference run,
+	and the maximum absolute difference in units of the reference standard error.
+	Relative differences of estimates close to zero are large by nature, the
+	difference in standard errors tells whether they matter for the test statistic.
+	"""
+	merged = reference.merge(test, on=['variant', 'phenotype'], suffixes=('_reference', '_test'))
+	differences = []
+	for column in columns:
+		x = merged[column + '_reference'].values
+		y = merged[column + '_test'].values
+		standard_error = merged['standard_error_reference'].values
+		missing = np.isnan(x) != np.isnan(y)
+		observed = ~np.isnan(x) & ~np.isnan(y)
+		absolute = np.abs(x[observed] - y[observed])
+		with np.errstate(divide='ignore', invalid='ignore'):
+			relative = absolute / np.abs(x[observed])
+			standardized = absolute / standard_error[observed]
+		relative = relative[np.isfinite(relative)]
+		standardized = standardized[np.isfinite(standardized)]
+		differences.append((column,
+							np.max(absolute) if len(absolute) else np.nan,
+							np.max(relative) if len(relative) else np.nan,
+							np.max(standardized) if len(standardized) else np.nan,
+							np.sum(missing)))
+	return merged.shape[0], differences
+
+
+def main(argv=None):
+	if argv is None:
+		argv=sys.argv[1:]
+
+	parser = argparse.ArgumentParser(
+		description='Compares the results of a reduced precision classic meta-analysis (-precision float32) '
+					'with the float64 results of the same dataset')
+	parser.add_argument('-reference', type=str, required=True, help='result folder of the float64 run')
+	parser.add_argument('-test', type=str, required=True, help='result folder of the float32 run')
+	parser.add_argument('-tol', type=float, default=1e-3,
+						help='maximum accepted difference in units of the reference standard error, default 1e-3')
+	args = parser.parse_args(argv)
+	print(args)
+
+	reference = read_results(args.reference)
+	test = read_results(args.test)
+	matched, differences = compare(reference, test)
+	print('Matched {} of {} reference results'.format(matched, reference.shape[0]))
+
+	passed = matched == reference.shape[0]
+	print('column\tmax_abs_diff\tmax_rel_diff\tmax_diff_in_se\tmissing_mismatches')
+	for column, absolute, relative, standardized, missing in differences:
+		print('{}\t{:.3e}\t{:.3e}\t{:.3e}\t{}'.format(column, absolute, relative, standardized, missing))
+		passed = passed and missing == 0 and not standardized > args.tol
+
+	print('PASSED' if passed else 'FAILED')
+	return 0 if passed else 1
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -25,6 +25,12 @@ import os
 import sys
 import argparse
 import glob
+import json
+import shutil
+import uuid
+import zlib
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
@@ -47,64 +53,499 @@ __description__ = "{} is a program developed and maintained by {}. " \
 
 
 # Constants
-MAX_SIZE = 1*10**8
+PARTITION_COLUMN = "phenotype"
+SORT_COLUMNS = ["phenotype", "variant"]
+STATE_FOLDER = "_partition_state"
+JOURNAL = "journal.json"
+OUTPUT_FILE = "part-{}.parquet"
+SPILL_ROW_GROUP_ROWS = 65536
+PHENOTYPE_DICTIONARY = "phenotypes.parquet"
+
+PYARROW_SCHEMA = pa.schema(
+    [("variant", pa.string()),
+     ("phenotype", pa.string()),
+     ("beta", pa.float64()),
+     ("standard_error", pa.float64()),
+     ("i_squared", pa.float64()),
+     ("sample_size", pa.float64())])
+
 
 # Classes
+class Journal(object):
+    """
+    Progress of a repartitioning run, kept in a JSON file so that an
+    interrupted run can resume.
+
+    The journal lists the spills that are complete, the input row groups
+    that these contain, and the buckets of which the output is complete.
+    It also names the output files of the run, so that a resumed run
+    replaces its own files, and other runs into the same output do not.
+    """
+
+    def __init__(self, path, inputs):
+        self.path = path
+        self.state = {"inputs": inputs, "run": uuid.uuid4().hex[:12],
+                      "spills": 0, "row_groups": [], "buckets": []}
+        if os.path.exists(path):
+            with open(path) as journal_file:
+                state = json.load(journal_file)
+            if state["inputs"] != inputs:
+                raise ValueError(
+                    "Journal {} belongs to other input files, remove it to start over".format(path))
+            self.state = state
+            print("Resuming after {} spills and {} finished buckets".format(
+                state["spills"], len(state["buckets"])))
+        else:
+            self.save()
+
+    @property
+    def spills(self):
+        return self.state["spills"]
+
+    @property
+    def output_file(self):
+        return OUTPUT_FILE.format(self.state["run"])
+
+    def spilled_row_groups(self):
+        return set((path, index) for path, index in self.state["row_groups"])
+
+    def finished_buckets(self):
+        return set(self.state["buckets"])
+
+    def add_spill(self, row_groups):
+        self.state["spills"] += 1
+        self.state["row_groups"].extend([path, index] for path, index in row_groups)
+        self.save()
+
+    def add_bucket(self, bucket):
+        self.state["buckets"].append(int(bucket))
+        self.save()
+
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as journal_file:
+            json.dump(self.state, journal_file)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.rename(temporary_path, self.path)
+
+
+class BucketBuffers(object):
+    """
+    Buffers the results per phenotype bucket. When the buffers exceed the
+    memory budget, all of them are spilled to a numbered spill folder.
+
+    The results are buffered as Arrow record batches, split by bucket with
+    take, so that the memory budget covers what is actually held and no
+    pandas copies are made. Spilled buckets are sorted by phenotype and
+    variant, so that the spills of a bucket can be merged while reading
+    them a row group at a time.
+    """
+
+    def __init__(self, state_path, buckets, memory_budget, journal):
+        self.state_path = state_path
+        self.buckets = buckets
+        self.memory_budget = memory_budget
+        self.journal = journal
+        self.batches = [list() for _ in range(buckets)]
+        self.row_groups = list()
+        self.buffered_bytes = 0
+
+    def add(self, table, row_group):
+        for batch in table.to_batches():
+            phenotypes = batch.column(PYARROW_SCHEMA.get_field_index(PARTITION_COLUMN)).to_pandas()
+            bucket_per_row = get_buckets(np.asarray(phenotypes), self.buckets)
+            order = np.argsort(bucket_per_row, kind="mergesort")
+            # The buckets are slices of a single batch ordered by bucket
+            batch = take(batch, order)
+            bounds = np.flatnonzero(np.diff(bucket_per_row[order])) + 1
+            for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(order)]])):
+                if end > start:
+                    self.batches[bucket_per_row[order[start]]].append(batch.slice(start, end - start))
+            self.buffered_bytes += batch.nbytes
+        self.row_groups.append(row_group)
+        if self.buffered_bytes > self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        """
+        Writes the buffered results of every bucket to a new spill folder,
+        and records the spill in the journal.
+        """
+        spill_path = get_spill_path(self.state_path, self.journal.spills)
+        print("Spilling {} MB to {}".format(self.buffered_bytes // 1024 ** 2, spill_path))
+        # Remove what an interrupted run left of this spill
+        for path in (spill_path, spill_path + ".tmp"):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        os.makedirs(spill_path + ".tmp")
+        for bucket in range(self.buckets):
+            results = self.pop_sorted(bucket)
+            if results is None:
+                continue
+            pq.write_table(
+                pa.Table.from_batches([results]),
+                os.path.join(spill_path + ".tmp", "{}.parquet".format(bucket)),
+                row_group_size=SPILL_ROW_GROUP_ROWS)
+        os.rename(spill_path + ".tmp", spill_path)
+        self.journal.add_spill(self.row_groups)
+
+        self.row_groups = list()
+        self.buffered_bytes = 0
+
+    def pop_sorted(self, bucket):
+        """
+        Removes the buffered results of a bucket, and returns these as a
+        single record batch sorted by phenotype and variant.
+        """
+        batches = self.batches[bucket]
+        self.batches[bucket] = list()
+        if len(batches) == 0:
+            return None
+        batch = pa.RecordBatch.from_arrays(
+            [pa.concat_arrays([part.column(index) for part in batches])
+             for index in range(len(PYARROW_SCHEMA.names))],
+            PYARROW_SCHEMA.names)
+        del batches
+        # Sort on the codes of the key columns, in the order of their names
+        codes = [pd.factorize(np.asarray(batch.column(PYARROW_SCHEMA.get_field_index(name)).to_pandas()),
+                              sort=True)[0]
+                 for name in SORT_COLUMNS]
+        return take(batch, np.lexsort(codes[::-1]))
+
+    def get_runs(self, bucket):
+        """
+        Returns the sorted runs of a bucket, from the spills and the
+        buffer. Every run is an iterator over sorted data frames.
+        """
+        runs = list()
+        for spill in range(self.journal.spills):
+            spill_file = os.path.join(get_spill_path(self.state_path, spill), "{}.parquet".format(bucket))
+            if os.path.exists(spill_file):
+                runs.append(read_spill(spill_file))
+        results = self.pop_sorted(bucket)
+        if results is not None:
+            runs.append(read_batch(results))
+        return runs
+
+    def remove(self, bucket):
+        for spill in range(self.journal.spills):
+            spill_file = os.path.join(get_spill_path(self.state_path, spill), "{}.parquet".format(bucket))
+            if os.path.exists(spill_file):
+                os.remove(spill_file)
+
 
 # Functions
+def get_buckets(phenotypes, buckets):
+    """
+    Assigns phenotypes to buckets by the CRC32 hash of their names.
+    """
+    codes, names = pd.factorize(phenotypes)
+    hashes = np.array([zlib.crc32(name if isinstance(name, bytes) else str(name).encode("utf-8")) & 0xffffffff
+                       for name in names], dtype=np.int64)
+    return (hashes % buckets)[codes]
+
+
+def take(batch, indices):
+    """
+    Returns the rows of a record batch at the indices.
+    """
+    indices = pa.array(np.asarray(indices, dtype=np.int64))
+    return pa.RecordBatch.from_arrays([column.take(indices) for column in batch.columns], batch.schema.names)
+
+
+def get_spill_path(state_path, spill):
+    return os.path.join(state_path, "spill_{}".format(spill))
+
+
+def get_row_groups(paths):
+    return [(path, index)
+            for path in paths
+            for index in range(pq.ParquetFile(path).num_row_groups)]
+
+
+def is_indexed(path):
+    """
+    Results written with the indexed schema have int32 variant and
+    phenotype codes instead of names.
+    """
+    schema = pq.ParquetFile(path).schema.to_arrow_schema()
+    return any(pa.types.is_integer(schema[schema.get_field_index(name)].type)
+               for name in ("variant", "phenotype"))
+
+
+def read_dictionaries(paths, phenotype_dictionary, mapper):
+    """
+    Reads the names of the variant and phenotype codes, if any of the
+    input files has indexed results.
+
+    :param paths: input files
+    :param phenotype_dictionary: phenotype dictionary of the run, by
+    default the one next to the first indexed input file
+    :param mapper: mapper folder of the run
+    :return: dictionary with an array of names per column, or None
+    """
+    indexed = [path for path in paths if is_indexed(path)]
+    if len(indexed) == 0:
+        return None
+    if phenotype_dictionary is None:
+        phenotype_dictionary = os.path.join(os.path.dirname(indexed[0]), PHENOTYPE_DICTIONARY)
+    if not os.path.exists(phenotype_dictionary):
+        raise ValueError("{} has indexed results, specify the phenotype dictionary of the run "
+                         "with --phenotype-dictionary".format(indexed[0]))
+    if mapper is None:
+        raise ValueError("{} has indexed results, specify the mapper folder of the run "
+                         "with --mapper".format(indexed[0]))
+    keys = glob.glob(os.path.join(mapper, "keys_*"))
+    if len(keys) != 1:
+        raise ValueError("There should be a single reference keys file in folder {}".format(mapper))
+
+    phenotypes = pq.read_table(phenotype_dictionary).to_pandas()
+    if not np.array_equal(phenotypes["phenotype_index"].values, np.arange(phenotypes.shape[0])):
+        raise ValueError("Phenotype dictionary {} is not complete".format(phenotype_dictionary))
+    return {"variant": np.load(keys[0]).astype(object),
+            "phenotype": phenotypes["phenotype"].values.astype(object)}
+
+
+def decode(table, dictionaries):
+    """
+    Replaces the variant and phenotype codes of indexed results by their
+    names. Columns with names are left as they are.
+    """
+    for name, names in dictionaries.items():
+        index = table.schema.get_field_index(name)
+        if index == -1 or not pa.types.is_integer(table.schema[index].type):
+            continue
+        codes = table.column(index).to_pandas().values
+        table = table.set_column(index, pa.field(name, pa.string()),
+                                 pa.array(names[codes], type=pa.string()))
+    return table
+
+
+def read_spill(path):
+    spill_file = pq.ParquetFile(path)
+    for index in range(spill_file.num_row_groups):
+        yield spill_file.read_row_group(index, use_threads=False).to_pandas()
+
+
+def read_batch(batch):
+    """
+    Returns a sorted record batch as a run, a data frame of at most
+    SPILL_ROW_GROUP_ROWS rows at a time.
+    """
+    for start in range(0, batch.num_rows, SPILL_ROW_GROUP_ROWS):
+        yield batch.slice(start, SPILL_ROW_GROUP_ROWS).to_pandas()
+
+
+def merge_runs(runs):
+    """
+    Merges runs of results that are sorted by phenotype and variant,
+    holding a single data frame per run at a time.
+
+    :param runs: iterators over sorted data frames
+    :return: iterator over sorted data frames
+    """
+    current = [[next(run, None), run] for run in runs]
+    while True:
+        # Skip exhausted runs and empty frames
+        for entry in current:
+            while entry[0] is not None and entry[0].shape[0] == 0:
+                entry[0] = next(entry[1], None)
+        current = [entry for entry in current if entry[0] is not None]
+        if len(current) == 0:
+            return
+
+        # None of the runs has rows before the smallest last row of the
+        # current frames, so rows up to this one are complete.
+        bound = min((frame[SORT_COLUMNS[0]].values[-1], frame[SORT_COLUMNS[1]].values[-1])
+                    for frame, _ in current)
+        pieces = list()
+        for entry in current:
+            frame = entry[0]
+            phenotypes, variants = frame[SORT_COLUMNS[0]].values, frame[SORT_COLUMNS[1]].values
+            rows = np.count_nonzero(
+                (phenotypes < bound[0]) | ((phenotypes == bound[0]) & (variants <= bound[1])))
+            pieces.append(frame.iloc[:rows])
+            entry[0] = frame.iloc[rows:]
+        yield pd.concat(pieces).sort_values(SORT_COLUMNS, kind="mergesort")
+
+
+def read_row_group(row_group, dictionaries=None):
+    path, index = row_group
+    table = pq.ParquetFile(path).read_row_group(index, columns=PYARROW_SCHEMA.names, use_threads=False)
+    if dictionaries is not None:
+        table = decode(table, dictionaries)
+    if not table.schema.equals(PYARROW_SCHEMA):
+        table = table.cast(PYARROW_SCHEMA)
+    return table
+
+
+def read_row_groups(row_groups, threads, dictionaries=None):
+    """
+    Reads the row groups in order. With more than one thread, the row
+    groups are decoded in parallel, a window of one row group per thread
+    at a time.
+    """
+    read = partial(read_row_group, dictionaries=dictionaries)
+    if threads <= 1:
+        for row_group in row_groups:
+            yield row_group, read(row_group)
+        return
+    pool = ThreadPool(threads)
+    try:
+        for start in range(0, len(row_groups), threads):
+            window = row_groups[start:start + threads]
+            for row_group, table in zip(window, pool.map(read, window)):
+                yield row_group, table
+    finally:
+        pool.close()
+        pool.join()
+
+
+class PhenotypeWriter(object):
+    """
+    Writes sorted results to the folder of every phenotype, in row groups
+    of at most row_group_rows rows. Files are written under a temporary
+    name and renamed, so a file in the output is always complete.
+    """
+
+    schema = pa.schema([field for field in PYARROW_SCHEMA if field.name != PARTITION_COLUMN])
+
+    def __init__(self, out, output_file, row_group_rows):
+        self.out = out
+        self.output_file = output_file
+        self.row_group_rows = row_group_rows
+        self.phenotype = None
+        self.path = None
+        self.writer = None
+        self.frames = list()
+        self.rows = 0
+        self.written = 0
+
+    def write(self, results):
+        """
+        Adds results sorted by phenotype and variant, that follow on the
+        results written before.
+        """
+        phenotypes = results[PARTITION_COLUMN].values
+        bounds = np.flatnonzero(phenotypes[1:] != phenotypes[:-1]) + 1
+        for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(phenotypes)]])):
+            if phenotypes[start] != self.phenotype:
+                self.close()
+                self.open(phenotypes[start])
+            self.frames.append(results.iloc[start:end])
+            self.rows += end - start
+            while self.rows >= self.row_group_rows:
+                self.flush(self.row_group_rows)
+
+    def open(self, phenotype):
+        phenotype_path = os.path.join(self.out, "{}={}".format(PARTITION_COLUMN, phenotype))
+        if not os.path.exists(phenotype_path):
+            os.makedirs(phenotype_path)
+        self.phenotype = phenotype
+        self.path = os.path.join(phenotype_path, self.output_file)
+        self.writer = pq.ParquetWriter(self.path + ".tmp", self.schema)
+
+    def flush(self, rows):
+        """
+        Writes the first rows of the buffered results as a row group.
+        """
+        results = pd.concat(self.frames)
+        self.writer.write_table(pa.Table.from_pandas(
+            results.iloc[:rows].drop(columns=PARTITION_COLUMN), self.schema, preserve_index=False))
+        self.frames = [results.iloc[rows:]]
+        self.rows -= rows
+        self.written += rows
+
+    def close(self):
+        if self.writer is None:
+            return
+        if self.rows > 0:
+            self.flush(self.rows)
+        self.writer.close()
+        os.rename(self.path + ".tmp", self.path)
+        self.phenotype = None
+        self.writer = None
+        self.frames = list()
+
+
+def write_bucket(runs, out, output_file, row_group_rows):
+    """
+    Merges the sorted runs of a bucket into the folder of every phenotype.
+
+    :return: number of results written
+    """
+    writer = PhenotypeWriter(out, output_file, row_group_rows)
+    for results in merge_runs(runs):
+        writer.write(results)
+    writer.close()
+    return writer.written
+
 
 # Main
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
     # Process input
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        description="Partitions meta-analysis results into a dataset with a folder per phenotype.")
     parser.add_argument('--path', nargs='+')
     parser.add_argument('--out')
+    parser.add_argument('--memory', type=int, default=4096,
+                        help="memory budget in MB of the buffered results, default 4096")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="number of threads decoding the input, default 1")
+    parser.add_argument('--buckets', type=int, default=64,
+                        help="number of phenotype buckets the results are spilled to, default 64")
+    parser.add_argument('--row-group-rows', type=int, default=1000000,
+                        help="maximum number of rows per row group of the output, default 1000000")
+    parser.add_argument('--phenotype-dictionary',
+                        help="phenotype dictionary of indexed results, "
+                             "by default {} in the folder of the results".format(PHENOTYPE_DICTIONARY))
+    parser.add_argument('--mapper',
+                        help="mapper folder of the run, to decode the variants of indexed results")
 
     args = parser.parse_args(argv)
     # Perform method
 
-    results_list = list()
-
-    print("hi")
-
-    pyarrow_schema = pa.schema(
-            [("variant", pa.string()),
-             ("phenotype", pa.string()),
-             ("beta", pa.float64()),
-             ("standard_error", pa.float64()),
-             ("i_squared", pa.float64()),
-             ("sample_size", pa.float64())])
-
-    #    for file_name in glob.glob(os.path.join(args.path, "*.parquet")):
-    for file_name in args.path:
-        print("Reading file " + file_name)
-        results_list.append(pq.ParquetFile(file_name).read().to_pandas())
-
-        # Output
+    # The phenotype dictionary of indexed results is not a result file
+    inputs = [os.path.abspath(path) for path in args.path
+              if os.path.basename(path) != PHENOTYPE_DICTIONARY]
+    dictionaries = read_dictionaries(inputs, args.phenotype_dictionary, args.mapper)
 
-        sum1 = sum([len(results) for results in results_list])
-        print(sum1)
-        if sum1 > MAX_SIZE:
-            print("Writing results")
-            concatenate = pd.concat(results_list)
-            results_list = list()
+    state_path = os.path.join(args.out, STATE_FOLDER)
+    if not os.path.exists(state_path):
+        os.makedirs(state_path)
+    journal = Journal(os.path.join(state_path, JOURNAL), inputs)
+    buffers = BucketBuffers(state_path, args.buckets, args.memory * 1024 ** 2, journal)
 
-            pq.write_to_dataset(
-                table=pa.Table.from_pandas(concatenate, pyarrow_schema),
-                root_path=args.out,
-                partition_cols=["phenotype"]
-            )
+    # Stream the row groups of the input into the bucket buffers,
+    # skipping row groups that are in a finished spill
+    spilled = journal.spilled_row_groups()
+    row_groups = [row_group for row_group in get_row_groups(inputs) if row_group not in spilled]
+    for row_group, table in read_row_groups(row_groups, args.threads, dictionaries):
+        print("Reading row group {1} of file {0}".format(*row_group))
+        buffers.add(table, row_group)
 
-    concatenate = pd.concat(results_list)
+    # Once something was spilled, spill the rest as well, so that the
+    # journal covers all input before buckets are written
+    if journal.spills > 0 and len(buffers.row_groups) > 0:
+        buffers.spill()
 
-    pq.write_to_dataset(
-        table=pa.Table.from_pandas(concatenate, pyarrow_schema),
-        root_path=args.out,
-        partition_cols=["phenotype"]
-    )
+    # Write the buckets one at a time
+    finished = journal.finished_buckets()
+    for bucket in range(args.buckets):
+        if bucket in finished:
+            continue
+        runs = buffers.get_runs(bucket)
+        if len(runs) > 0:
+            written = write_bucket(runs, args.out, journal.output_file, args.row_group_rows)
+            print("Written bucket {} with {} results".format(bucket, written))
+        if journal.spills > 0:
+            journal.add_bucket(bucket)
+            buffers.remove(bucket)
 
+    shutil.rmtree(state_path)
     return 0
 
 
@@ -5,14 +5,15 @@ process Combine {
 
     input:
       path partitioned
-      val phenotype
+      val phenotypes
       path out
 
     shell:
     '''
     python2 !{baseDir}/bin/combine.py \
-    --path !{parquet} \
-    --pheno !{phenotype} \
+    --path !{partitioned} \
+    --pheno !{phenotypes.join(' ')} \
     --out !{out} \
+    --threads !{task.cpus}
     '''
 }
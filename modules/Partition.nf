@@ -13,6 +13,7 @@ process Partition {
     '''
     python2 !{baseDir}/bin/partition.py \
     --path !{parquet} \
-    --out "partitioned"
+    --out "partitioned" \
+    --threads !{task.cpus}
     '''
 }
@@ -56,6 +56,7 @@ process PerCohortAnalysis {
     -node !{nr_chunks} !{chunk} \
     -th !{th} \
     -mapper_chunk 500 \
+    -threads !{task.cpus} \
     -ref_name 1000G-30x_ref \
     -cluster "y" \
     -snp_id_inc ${snp_inclusion} \